@@ -0,0 +1,132 @@
+#!/usr/bin/python3
+"""
+    Compare the two ways of loading the Component Contribution preprocessing
+    matrices: decompressing the NPZ file into private memory ('npz') vs.
+    memory-mapping the uncompressed .npy files ('mmap').
+
+    Each mode runs in a fresh interpreter, which reports the time it took to
+    import the module, to load the data, and to compute the first
+    uncertainty, and then forks a few workers that each compute an
+    uncertainty. For every process we report the RSS and PSS (proportional
+    set size, where shared pages are split between the processes sharing
+    them), so the sum of PSS values is the real memory cost of the pool.
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+
+MODES = ('npz', 'mmap')
+
+
+def MakeParser():
+    parser = argparse.ArgumentParser(
+        description=('Benchmark loading of the CC preprocessing matrices'))
+    parser.add_argument('--workers', type=int, default=4,
+                        help='number of forked worker processes')
+    parser.add_argument('--child', choices=MODES, default=None,
+                        help=argparse.SUPPRESS)
+    return parser
+
+
+def ReadMemoryKb():
+    """Returns (RSS, PSS) of the current process in kB."""
+    rss = pss = None
+    with open('/proc/self/status') as fp:
+        for line in fp:
+            if line.startswith('VmRSS:'):
+                rss = int(line.split()[1])
+    try:
+        with open('/proc/self/smaps_rollup') as fp:
+            for line in fp:
+                if line.startswith('Pss:'):
+                    pss = int(line.split()[1])
+    except IOError:
+        pass
+    return rss, pss
+
+
+def FirstUncertainty(data):
+    """Computes a quadratic form touching all of C1, C2 and C3."""
+    import numpy
+    x = numpy.matrix(numpy.ones((data.Nc, 1)))
+    g = numpy.matrix(numpy.ones((data.Ng, 1)))
+    q = x.T * data.C1 * x + x.T * data.C2 * g + g.T * data.C3 * g
+    return q[0, 0]
+
+
+_DATA = None
+
+
+def _Worker(_):
+    FirstUncertainty(_DATA)
+    return ReadMemoryKb()
+
+
+def RunChild(mode, n_workers):
+    global _DATA
+    t0 = time.time()
+    from gibbs import cc_preprocess
+    t_import = time.time() - t0
+
+    t0 = time.time()
+    _DATA = cc_preprocess.PreprocessingData.FromFiles(mmap=(mode == 'mmap'))
+    t_load = time.time() - t0
+
+    t0 = time.time()
+    FirstUncertainty(_DATA)
+    t_first = time.time() - t0
+    rss, pss = ReadMemoryKb()
+
+    ctx = multiprocessing.get_context('fork')
+    with ctx.Pool(n_workers) as pool:
+        workers = pool.map(_Worker, range(n_workers), chunksize=1)
+
+    result = {'mode': mode,
+              'import_sec': t_import,
+              'load_sec': t_load,
+              'first_uncertainty_sec': t_first,
+              'parent_rss_kb': rss,
+              'parent_pss_kb': pss,
+              'worker_rss_kb': [w[0] for w in workers],
+              'worker_pss_kb': [w[1] for w in workers]}
+    print(json.dumps(result))
+
+
+def main():
+    args = MakeParser().parse_args()
+    if args.child:
+        RunChild(args.child, args.workers)
+        return
+
+    from gibbs import cc_preprocess
+    if not os.path.isdir(cc_preprocess.CC_PREPROCESS_DIRNAME):
+        logging.info('> Writing uncompressed preprocessing data to %s' %
+                     cc_preprocess.CC_PREPROCESS_DIRNAME)
+        cc_preprocess.WriteUncompressed()
+
+    print('%-5s %9s %9s %9s %12s %12s' % ('mode', 'import', 'load',
+                                         '1st unc.', 'sum(RSS) MB',
+                                         'sum(PSS) MB'))
+    for mode in MODES:
+        cmd = [sys.executable, os.path.abspath(__file__),
+               '--child', mode, '--workers', str(args.workers)]
+        out = subprocess.check_output(cmd, cwd=os.path.dirname(cmd[1]))
+        res = json.loads(out.decode().strip().splitlines()[-1])
+        rss = res['parent_rss_kb'] + sum(res['worker_rss_kb'])
+        pss = None
+        if res['parent_pss_kb'] is not None:
+            pss = res['parent_pss_kb'] + sum(res['worker_pss_kb'])
+        print('%-5s %8.3fs %8.3fs %8.3fs %12.1f %12s' %
+              (mode, res['import_sec'], res['load_sec'],
+               res['first_uncertainty_sec'], rss / 1024.0,
+               '%.1f' % (pss / 1024.0) if pss is not None else 'n/a'))
+
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.INFO)
+    main()
@@ -167,3 +167,8 @@ STATIC_ROOT = '/var/www/html/equilibrator/static'
 
 MEDIA_URL = 'http://127.0.0.1:8000/media/'
 
+# Rendered reaction and compound pages are cached in memory (per process)
+# and, if RESPONSE_CACHE_DIR is set, in files shared by all the processes.
+RESPONSE_CACHE_SIZE = 2000
+RESPONSE_CACHE_DIR = os.environ.get('EQUILIBRATOR_RESPONSE_CACHE_DIR', None)
+
@@ -23,11 +23,13 @@ urlpatterns = [
 #    path('gibbs/', include('gibbs.urls')),
     path('', TemplateView.as_view(template_name='main.html'), name='index'),
     path(r'compound_image', views.CompoundImage),
+    path(r'compound_images', views.CompoundImagesJson),
     path(r'compound', views.CompoundPage),
     path(r'download', views.DownloadPage),
     path(r'enzyme', views.EnzymePage),
     path(r'reaction', views.ReactionPage),
     path(r'graph_reaction', views.ReactionGraph),
+    path(r'graph_reaction_json', views.ReactionCurveJson),
     path(r'data_refs', views.RefsPage),
     path(r'search', views.ResultsPage),
     path(r'suggest', views.SuggestJson),
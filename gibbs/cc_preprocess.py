@@ -0,0 +1,349 @@
+import logging
+import os
+import shutil
+from collections import namedtuple
+import numpy
+from scipy.sparse import csr_matrix
+from util import singleton
+
+RELPATH = os.path.dirname(os.path.realpath(__file__))
+CC_PREPROCESS_FNAME = os.path.join(RELPATH, '../data/cc_preprocess.npz')
+
+# An uncompressed copy of the NPZ file, one .npy file per array. Unlike the
+# (zipped) NPZ, these can be memory-mapped, so forked web workers share the
+# same physical pages instead of each holding a private copy.
+CC_PREPROCESS_DIRNAME = os.path.join(RELPATH, '../data/cc_preprocess')
+
+# Negative eigenvalues of the covariance (relative to the largest one) which
+# are larger than this are attributed to round-off errors
+NEGATIVE_EIGENVALUE_RTOL = 1e-8
+
+MATRIX_NAMES = ('C1', 'C2', 'C3', 'G1', 'G2', 'G3', 'S')
+ARRAY_NAMES = MATRIX_NAMES + ('cids',)
+
+
+def WriteUncompressed(npz_fname=CC_PREPROCESS_FNAME,
+                      dirname=CC_PREPROCESS_DIRNAME):
+    """Write the arrays in the NPZ file as separate .npy files.
+
+    The directory is written to a temporary location first and then
+    renamed, so that a running server never sees a partial copy.
+
+    Args:
+        npz_fname: the compressed preprocessing file.
+        dirname: the directory to write the .npy files to.
+    """
+    npz = numpy.load(npz_fname)
+    tmp_dirname = dirname + '.tmp'
+    if os.path.exists(tmp_dirname):
+        shutil.rmtree(tmp_dirname)
+    os.makedirs(tmp_dirname)
+    for name in ARRAY_NAMES:
+        numpy.save(os.path.join(tmp_dirname, name + '.npy'), npz[name])
+
+    if os.path.exists(dirname):
+        shutil.rmtree(dirname)
+    os.rename(tmp_dirname, dirname)
+
+
+def LoadArrays(mmap=True,
+               npz_fname=CC_PREPROCESS_FNAME,
+               dirname=CC_PREPROCESS_DIRNAME):
+    """Load the raw preprocessing arrays.
+
+    Args:
+        mmap: if True, memory-map the uncompressed .npy files (if they
+              exist). Otherwise, decompress everything from the NPZ file.
+
+    Returns:
+        A dictionary mapping array names to numpy arrays.
+    """
+    if mmap and os.path.isdir(dirname):
+        logging.debug('memory-mapping CC preprocessing data from %s' %
+                      dirname)
+        arrays = {}
+        for name in MATRIX_NAMES:
+            arrays[name] = numpy.load(os.path.join(dirname, name + '.npy'),
+                                      mmap_mode='r')
+        # the list of KEGG IDs is small, no need to map it
+        arrays['cids'] = numpy.load(os.path.join(dirname, 'cids.npy'))
+        return arrays
+
+    if mmap:
+        logging.warning('%s does not exist, falling back to %s. Run '
+                        'cc_preprocess.WriteUncompressed() to share the '
+                        'matrices between worker processes.' %
+                        (dirname, npz_fname))
+
+    npz = numpy.load(npz_fname)
+    return {name: npz[name] for name in ARRAY_NAMES}
+
+
+class PreprocessingData(object):
+    """
+        The Component Contribution preprocessing matrices.
+
+        C1, C2 and C3 are the blocks of the covariance matrix used for
+        calculating the uncertainty of reaction energies, G1, G2 and G3 are
+        used for analyzing the contribution of each training reaction,
+        and S is the stoichiometric matrix of the training set.
+    """
+
+    def __init__(self, arrays):
+        # asmatrix does not copy the data, so memory-mapped arrays stay
+        # mapped (and shared).
+        for name in MATRIX_NAMES:
+            setattr(self, name, numpy.asmatrix(arrays[name]))
+        self.cids = arrays['cids']
+        self.Nc = self.C1.shape[0]
+        self.Ng = self.C3.shape[0]
+        assert self.C1.shape[0] == self.C1.shape[1]
+        assert self.C1.shape[1] == self.C2.shape[0]
+        assert self.C2.shape[1] == self.C3.shape[0]
+        assert self.C3.shape[0] == self.C3.shape[1]
+        self._covariance_sqrt = None
+
+    @staticmethod
+    def FromFiles(mmap=True):
+        return PreprocessingData(LoadArrays(mmap=mmap))
+
+    def GetCovarianceSqrt(self):
+        """
+            Returns a matrix L such that L*L' is the covariance of (x, g)
+            vectors, i.e. the symmetric block matrix [C1, C2/2; C2'/2, C3].
+
+            C2 is halved because it appears only once in the uncertainty of
+            a single reaction (x'*C1*x + x'*C2*g + g'*C3*g). Columns that
+            correspond to zero eigenvalues are dropped, and a warning is
+            logged if the covariance has a significant negative eigenvalue
+            (i.e. it is not positive semi-definite). The factorization is
+            computed once and cached.
+        """
+        if self._covariance_sqrt is None:
+            C = numpy.vstack([numpy.hstack([self.C1, self.C2 / 2.0]),
+                              numpy.hstack([self.C2.T / 2.0, self.C3])])
+            eigvals, eigvecs = numpy.linalg.eigh(C)
+            tolerance = 1e-12 * max(eigvals.max(), 1.0)
+            if eigvals.min() < -NEGATIVE_EIGENVALUE_RTOL * max(
+                    eigvals.max(), 1.0):
+                logging.warning('the CC covariance is not positive '
+                                'semi-definite (smallest eigenvalue %.3g, '
+                                'largest %.3g), dropping %d negative '
+                                'eigenvalues' %
+                                (eigvals.min(), eigvals.max(),
+                                 (eigvals < -tolerance).sum()))
+            keep = eigvals > tolerance
+            self._covariance_sqrt = numpy.matrix(numpy.multiply(
+                eigvecs[:, keep], numpy.sqrt(eigvals[keep])))
+        return self._covariance_sqrt
+
+
+# The non-zero support of a reaction's (x, g) vectors: x_ind are indices of
+# compounds in the CC training set and g_ind are indices of groups.
+SparseReactionVector = namedtuple('SparseReactionVector',
+                                  ['x_ind', 'x_val', 'g_ind', 'g_val'])
+
+
+class CompoundVectorStore(object):
+    """
+        A sparse mapping of compounds to their (x, g) vectors.
+
+        Each compound is a row of one CSR matrix with Nc + Ng columns. The
+        first Nc columns hold the compound's index in the CC training set
+        (if it has one), and the last Ng columns hold its group vector
+        (used only for compounds that are not in the training set).
+    """
+
+    def __init__(self, Nc, Ng, rows):
+        """
+            Args:
+                Nc: the number of compounds in the CC training set.
+                Ng: the number of groups.
+                rows: an iterable of (kegg_id, index, sparse_gv) tuples,
+                      where sparse_gv is a list of (group index, count) pairs.
+        """
+        self.Nc = Nc
+        self.Ng = Ng
+        self.kegg_id_to_row = {}
+        self._missing = set()
+
+        indptr = [0]
+        indices = []
+        data = []
+        for kegg_id, index, sparse_gv in rows:
+            self.kegg_id_to_row[kegg_id] = len(indptr) - 1
+            if index is not None:
+                indices.append(index)
+                data.append(1.0)
+            elif sparse_gv is not None:
+                for g_ind, g_count in sparse_gv:
+                    indices.append(Nc + g_ind)
+                    data.append(g_count)
+            else:
+                self._missing.add(kegg_id)
+            indptr.append(len(indices))
+
+        self.M = csr_matrix((numpy.array(data, dtype=float),
+                             numpy.array(indices, dtype=numpy.int32),
+                             numpy.array(indptr, dtype=numpy.int32)),
+                            shape=(len(indptr) - 1, Nc + Ng))
+        self.M.sum_duplicates()
+
+    def HasCompound(self, kegg_id):
+        return kegg_id in self.kegg_id_to_row
+
+    def ReactionVector(self, sparse):
+        """
+            Returns the SparseReactionVector of a reaction.
+
+            Args:
+                sparse: a dictionary mapping KEGG IDs to coefficients.
+                        All the compounds must be in this store.
+        """
+        kegg_ids = list(sparse.keys())
+        for kegg_id in kegg_ids:
+            if kegg_id in self._missing:
+                raise Exception('could not find index nor group vector for %s'
+                                % kegg_id)
+
+        rows = [self.kegg_id_to_row[kegg_id] for kegg_id in kegg_ids]
+        coeffs = numpy.array([sparse[kegg_id] for kegg_id in kegg_ids],
+                             dtype=float)
+        v = csr_matrix(coeffs.reshape(1, -1)) * self.M[rows, :]
+        v.eliminate_zeros()
+        return SplitSparseVector(v.indices, v.data, self.Nc)
+
+    def ReactionMatrix(self, S, kegg_ids):
+        """
+            Returns the (x, g) vectors of many reactions at once.
+
+            Args:
+                S: a stoichiometric matrix (dense or sparse) with compounds
+                   on the rows and reactions on the columns.
+                kegg_ids: the KEGG IDs of the rows of S.
+
+            Returns:
+                A two tuple (V, is_valid). V is a sparse matrix with one row
+                per reaction and Nc + Ng columns. is_valid is a boolean array
+                which is False for reactions with a compound that is not in
+                the store or that has neither an index nor a group vector.
+        """
+        S = csr_matrix(S)
+        known = numpy.array([self.HasCompound(k) and k not in self._missing
+                             for k in kegg_ids], dtype=bool)
+        known_ind = numpy.nonzero(known)[0]
+        unknown_ind = numpy.nonzero(~known)[0]
+
+        is_valid = numpy.ones(S.shape[1], dtype=bool)
+        if unknown_ind.size > 0:
+            n_unknown = numpy.asarray(abs(S[unknown_ind, :]).sum(axis=0))
+            is_valid = n_unknown.ravel() == 0
+
+        rows = [self.kegg_id_to_row[kegg_ids[i]] for i in known_ind]
+        V = csr_matrix(S[known_ind, :].T * self.M[rows, :])
+        V.eliminate_zeros()
+        return V, is_valid
+
+
+def SplitSparseVector(indices, data, Nc):
+    """Splits a sparse (x, g) vector into a SparseReactionVector."""
+    indices = numpy.asarray(indices)
+    data = numpy.asarray(data, dtype=float)
+    is_x = indices < Nc
+    return SparseReactionVector(indices[is_x], data[is_x],
+                                indices[~is_x] - Nc, data[~is_x])
+
+
+def QuadraticForm(data, v):
+    """
+        Computes x'*C1*x + x'*C2*g + g'*C3*g using only the rows and columns
+        in the support of the SparseReactionVector v.
+    """
+    C1 = numpy.asarray(data.C1[numpy.ix_(v.x_ind, v.x_ind)])
+    C2 = numpy.asarray(data.C2[numpy.ix_(v.x_ind, v.g_ind)])
+    C3 = numpy.asarray(data.C3[numpy.ix_(v.g_ind, v.g_ind)])
+    return (v.x_val.dot(C1).dot(v.x_val) +
+            v.x_val.dot(C2).dot(v.g_val) +
+            v.g_val.dot(C3).dot(v.g_val))
+
+
+def BatchQuadraticForm(data, V, chunk_size=1000):
+    """
+        Computes QuadraticForm for many reactions at once, i.e. the
+        diagonals of X'*C1*X + X'*C2*G + G'*C3*G.
+
+        Args:
+            data: a PreprocessingData object.
+            V: a sparse matrix with one (x, g) row per reaction.
+            chunk_size: the number of reactions handled together (bounds
+                        the size of the dense intermediate matrices).
+
+        Returns:
+            A 1D array with one value per reaction.
+    """
+    V = csr_matrix(V)
+    X = V[:, :data.Nc]
+    G = V[:, data.Nc:]
+    q = numpy.zeros(V.shape[0])
+    for i in range(0, V.shape[0], chunk_size):
+        x = X[i:i + chunk_size, :]
+        g = G[i:i + chunk_size, :]
+        q_chunk = (x.multiply(x * data.C1).sum(axis=1) +
+                   g.multiply(x * data.C2).sum(axis=1) +
+                   g.multiply(g * data.C3).sum(axis=1))
+        q[i:i + chunk_size] = numpy.asarray(q_chunk).ravel()
+    return q
+
+
+def BatchGroupContributionWeights(data, V, chunk_size=1000):
+    """
+        Returns the sum of absolute group contribution weights (i.e. of
+        x'*G2 + g'*G3) for each row of V.
+    """
+    V = csr_matrix(V)
+    X = V[:, :data.Nc]
+    G = V[:, data.Nc:]
+    w = numpy.zeros(V.shape[0])
+    for i in range(0, V.shape[0], chunk_size):
+        weights_gc = (X[i:i + chunk_size, :] * data.G2 +
+                      G[i:i + chunk_size, :] * data.G3)
+        w[i:i + chunk_size] = numpy.abs(numpy.asarray(weights_gc)).sum(axis=1)
+    return w
+
+
+def CovarianceSqrt(data, V):
+    """
+        Returns the square root of the joint covariance of many reactions.
+
+        Args:
+            data: a PreprocessingData object.
+            V: a sparse matrix with one (x, g) row per reaction.
+
+        Returns:
+            A square matrix A (reactions x reactions) where A*A' is the
+            covariance matrix of the reaction energies.
+    """
+    B = csr_matrix(V) * data.GetCovarianceSqrt()
+    U, s, _ = numpy.linalg.svd(B, full_matrices=False)
+    n_reactions = V.shape[0]
+    A = numpy.matrix(numpy.zeros((n_reactions, n_reactions)))
+    A[:, :s.size] = numpy.multiply(U, s)
+    return A
+
+
+@singleton.Singleton
+class _LazyPreprocessingData(object):
+    """
+        Holds the single PreprocessingData object of this process.
+
+        Nothing is read from disk until the first call to Get().
+    """
+    def __init__(self):
+        self.data = PreprocessingData.FromFiles(mmap=True)
+
+
+def Get():
+    """
+        Convenience method to get the (lazily loaded) PreprocessingData.
+    """
+    return _LazyPreprocessingData().data
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import logging
+from collections import namedtuple
 from util import constants
 import numpy
 
@@ -285,6 +286,10 @@ def CreateConditions(name, all_ids=None, all_phases=None, all_ratios=None):
 ###############################################################################
 
 
+# The conditions of a Legendre transform, used as a cache key
+TransformKey = namedtuple('TransformKey', ['pH', 'pMg', 'ionic_strength'])
+
+
 class AqueousParams(object):
 
     def __init__(self,
@@ -342,6 +347,14 @@ class AqueousParams(object):
                              self.e_reduction_potential, self.max_priority,
                              self.mode)
 
+    def Key(self):
+        """
+            Returns a hashable (frozen) key of the conditions that affect
+            the transformed formation energies, i.e. pH, pMg and I.
+        """
+        return TransformKey(float(self.pH), float(self.pMg),
+                            float(self.ionic_strength))
+
     def __str__(self):
         return 'pH = %.2g, pMg = %.2g, I = %.2g M, Ered = %g, MaxPriority=%d' % \
             (self.pH, self.pMg, self.ionic_strength,
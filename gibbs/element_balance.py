@@ -0,0 +1,283 @@
+from collections import namedtuple
+import numpy
+from scipy.sparse import csr_matrix
+
+
+class ElementMatrix(object):
+    """
+        The elemental composition and electron count of many compounds.
+
+        Each compound is a row of one CSR matrix with a column per element,
+        so the atom (or electron) balance of any number of reactions is a
+        single sparse product with their stoichiometric matrix. Formulas are
+        parsed once, when the matrix is built.
+    """
+
+    def __init__(self, rows):
+        """
+            Args:
+                rows: an iterable of (kegg_id, atom_bag, num_electrons)
+                      tuples. atom_bag is a dictionary mapping elements to
+                      counts, or None if the formula is unknown (or has
+                      wildcards). num_electrons can also be None.
+        """
+        rows = list(rows)
+        self.elements = sorted(set().union(
+            *[atom_bag for _, atom_bag, _ in rows if atom_bag]))
+        element_to_col = {e: i for i, e in enumerate(self.elements)}
+
+        self.kegg_id_to_row = {}
+        has_atom_bag = []
+        num_electrons = []
+        indptr = [0]
+        indices = []
+        data = []
+        for kegg_id, atom_bag, electrons in rows:
+            self.kegg_id_to_row[kegg_id] = len(indptr) - 1
+            has_atom_bag.append(bool(atom_bag))
+            num_electrons.append(numpy.nan if electrons is None
+                                 else electrons)
+            for element, count in (atom_bag or {}).items():
+                indices.append(element_to_col[element])
+                data.append(count)
+            indptr.append(len(indices))
+
+        self.has_atom_bag = numpy.array(has_atom_bag, dtype=bool)
+        self.num_electrons = numpy.array(num_electrons, dtype=float)
+        self.M = csr_matrix((numpy.array(data, dtype=float),
+                             numpy.array(indices, dtype=numpy.int32),
+                             numpy.array(indptr, dtype=numpy.int32)),
+                            shape=(len(indptr) - 1, len(self.elements)))
+
+    def HasCompound(self, kegg_id):
+        return kegg_id in self.kegg_id_to_row
+
+    def HasAtomBag(self, kegg_id):
+        return self.has_atom_bag[self.kegg_id_to_row[kegg_id]]
+
+    def _Rows(self, kegg_ids):
+        return numpy.array([self.kegg_id_to_row[k] for k in kegg_ids],
+                           dtype=int)
+
+    def AtomDiffs(self, S, kegg_ids):
+        """
+            Returns the net atom counts of many reactions at once.
+
+            Args:
+                S: a stoichiometric matrix (dense or sparse) with compounds
+                   on the rows and reactions on the columns.
+                kegg_ids: the KEGG IDs of the rows of S. All the compounds
+                          must be in this matrix.
+
+            Returns:
+                A two tuple (D, has_formulas). D is a dense array with one
+                row per reaction and one column per element (see
+                self.elements), holding the number of atoms missing from
+                the left side, i.e. minus the atoms consumed by the reaction.
+                has_formulas is a boolean array which is False for reactions
+                with a compound whose formula is unknown.
+        """
+        S = csr_matrix(S)
+        rows = self._Rows(kegg_ids)
+        D = -numpy.asarray((S.T * self.M[rows, :]).todense())
+        no_formula = ~self.has_atom_bag[rows]
+        n_no_formula = numpy.asarray(abs(S[no_formula, :]).sum(axis=0))
+        return D, n_no_formula.ravel() == 0
+
+    def ElectronDiffs(self, S, kegg_ids):
+        """
+            Returns the net electron count of many reactions at once.
+
+            Args:
+                S: a stoichiometric matrix (dense or sparse) with compounds
+                   on the rows and reactions on the columns.
+                kegg_ids: the KEGG IDs of the rows of S. All the compounds
+                          must be in this matrix.
+
+            Returns:
+                A 1D array with one value per reaction, which is NaN for
+                reactions with a compound whose electron count is unknown.
+        """
+        S = csr_matrix(S)
+        electrons = self.num_electrons[self._Rows(kegg_ids)]
+        unknown = numpy.isnan(electrons)
+        d = numpy.asarray(S.T * numpy.where(unknown, 0.0, electrons))
+        n_unknown = numpy.asarray(abs(S[unknown, :]).sum(axis=0)).ravel()
+        return numpy.where(n_unknown == 0, d.ravel(), numpy.nan)
+
+    def AtomDiffDict(self, d, tolerance=1e-6):
+        """
+            Converts one row of the AtomDiffs() array to a dictionary mapping
+            elements to counts, dropping those that are very close to 0.
+        """
+        return {self.elements[i]: float(d[i])
+                for i in numpy.nonzero(numpy.abs(d) > tolerance)[0]}
+
+
+# A compound (or a set of compounds, like the NAD+/NADH pair) that can be
+# added to a reaction to balance it. sparse maps KEGG IDs to coefficients in
+# one unit of the cofactor. balances is ATOMS or ELECTRONS, and if integral
+# is True only whole units are suggested.
+Cofactor = namedtuple('Cofactor', ['name', 'sparse', 'balances', 'integral'])
+
+ATOMS = 'atoms'
+ELECTRONS = 'electrons'
+
+DEFAULT_COFACTORS = (
+    Cofactor('water', {'C00001': 1}, ATOMS, False),
+    Cofactor('coa', {'C00010': 1}, ATOMS, True),
+    Cofactor('pi', {'C00009': 1}, ATOMS, True),
+    Cofactor('co2', {'C00011': 1}, ATOMS, True),
+    Cofactor('ammonia', {'C00014': 1}, ATOMS, True),
+    Cofactor('nad', {'C00003': 1, 'C00004': -1}, ELECTRONS, False))
+
+
+class CofactorBalancer(object):
+    """
+        Finds how many units of each cofactor balance a reaction.
+
+        The composition of all the cofactors is a small dense matrix A (one
+        row per element and one for electrons). Given the imbalance b of a
+        reaction, the multiple of each cofactor is the least squares
+        solution of A[:, j] * k = -b (over the rows it balances), and it is
+        suggested only if it balances the reaction exactly. All cofactors
+        (and any number of reactions) are solved in one pass.
+    """
+
+    # Hydrogens are always ignored, ala Alberty.
+    IGNORED_ELEMENTS = ('H',)
+    OTHER = '*'
+    ELECTRON = 'e-'
+
+    def __init__(self, element_matrix, cofactors=DEFAULT_COFACTORS,
+                 tolerance=0.01):
+        """
+            Args:
+                element_matrix: an ElementMatrix with all the cofactors.
+                cofactors: a list of Cofactor tuples. Cofactors with compounds
+                           that are not in the matrix (or whose formula or
+                           electron count is unknown) are skipped.
+                tolerance: the largest imbalance considered balanced.
+        """
+        self.tolerance = tolerance
+        compositions = []
+        self.cofactors = []
+        for cofactor in cofactors:
+            composition = self._Composition(element_matrix, cofactor)
+            if composition is not None:
+                self.cofactors.append(cofactor)
+                compositions.append(composition)
+
+        elements = sorted(set().union(*[c for c, _ in compositions]) -
+                          set(self.IGNORED_ELEMENTS))
+        # an element that is in none of the cofactors cannot be balanced, so
+        # all such elements share one row
+        self.rows = elements + [self.OTHER, self.ELECTRON]
+        self._row_index = {r: i for i, r in enumerate(self.rows)}
+
+        self.A = numpy.zeros((len(self.rows), len(self.cofactors)))
+        self.mask = numpy.zeros(self.A.shape, dtype=bool)
+        for j, (cofactor, (atom_bag, electrons)) in enumerate(
+                zip(self.cofactors, compositions)):
+            if cofactor.balances == ATOMS:
+                self.mask[:-1, j] = True
+                for element in elements:
+                    self.A[self._row_index[element], j] = \
+                        atom_bag.get(element, 0)
+            else:
+                self.mask[-1, j] = True
+                self.A[-1, j] = electrons
+        self._is_integral = numpy.array([c.integral for c in self.cofactors],
+                                        dtype=bool)
+
+    @staticmethod
+    def _Composition(element_matrix, cofactor):
+        """
+            Returns (atom_bag, electrons) of one unit of the cofactor, or None
+            if it cannot be computed.
+        """
+        atom_bag = {}
+        electrons = 0
+        for kegg_id, coeff in cofactor.sparse.items():
+            if not element_matrix.HasCompound(kegg_id):
+                return None
+            row = element_matrix.kegg_id_to_row[kegg_id]
+            if cofactor.balances == ATOMS:
+                if not element_matrix.has_atom_bag[row]:
+                    return None
+                m = element_matrix.M[row, :]
+                for i, count in zip(m.indices, m.data):
+                    element = element_matrix.elements[i]
+                    atom_bag[element] = atom_bag.get(element, 0) + \
+                        coeff * count
+            else:
+                if numpy.isnan(element_matrix.num_electrons[row]):
+                    return None
+                electrons += coeff * element_matrix.num_electrons[row]
+
+        if not any(atom_bag.get(e, 0) for e in atom_bag
+                   if e not in CofactorBalancer.IGNORED_ELEMENTS) and \
+                not electrons:
+            return None
+        return atom_bag, electrons
+
+    def ImbalanceVector(self, atom_diff, electron_diff):
+        """
+            Converts the output of Reaction._GetAtomDiff (atoms missing from
+            the left side) and _GetElectronDiff into an imbalance row, i.e.
+            the net amount produced by the reaction.
+        """
+        b = numpy.zeros(len(self.rows))
+        for element, count in atom_diff.items():
+            if element in self.IGNORED_ELEMENTS:
+                continue
+            i = self._row_index.get(element)
+            if i is None:
+                b[self._row_index[self.OTHER]] += abs(count)
+            else:
+                b[i] -= count
+        b[-1] = electron_diff
+        return b
+
+    def Solve(self, B):
+        """
+            Args:
+                B: the imbalance of one reaction (a vector) or of many
+                   (one row per reaction), see ImbalanceVector.
+
+            Returns:
+                An array with one column per cofactor (and one row per
+                reaction, if B is 2D) holding the number of units that
+                balance the reaction, or NaN if the cofactor cannot
+                balance it. The multiple is 0 if the reaction is already
+                balanced.
+        """
+        B = numpy.asarray(B, dtype=float)
+        B2 = numpy.atleast_2d(B)
+        W = self.A * self.mask
+        K = -B2.dot(W) / (W ** 2).sum(axis=0)
+
+        # the remaining imbalance, on the rows each cofactor balances
+        R = B2[:, :, numpy.newaxis] * self.mask + \
+            K[:, numpy.newaxis, :] * W
+        ok = numpy.all(numpy.abs(R) < self.tolerance, axis=1)
+        ok &= ~self._is_integral | \
+            (numpy.abs(K - numpy.round(K)) < self.tolerance)
+        K = numpy.where(ok, K, numpy.nan)
+        K[:, self._is_integral] = numpy.round(K[:, self._is_integral])
+        return K.reshape(B.shape[:-1] + (len(self.cofactors),))
+
+    def SolveDict(self, b):
+        """
+            Same as Solve() for a single reaction, returning a dictionary
+            mapping cofactor names to multiples (or None).
+        """
+        k = self.Solve(b)
+        return {c.name: None if numpy.isnan(x) else float(x)
+                for c, x in zip(self.cofactors, k)}
+
+    def GetCofactor(self, name):
+        for cofactor in self.cofactors:
+            if cofactor.name == name:
+                return cofactor
+        return None
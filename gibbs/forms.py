@@ -127,6 +127,26 @@ class ReactionGraphForm(ReactionForm):
         lambda self: self._GetWithDefault('vary_is', False))
 
 
+class ReactionCurveForm(ReactionForm):
+    vary = forms.ChoiceField(required=False,
+                             choices=[('ph', 'pH'),
+                                      ('pmg', 'pMg'),
+                                      ('is', 'ionic strength')])
+    grid_min = forms.FloatField(required=False)
+    grid_max = forms.FloatField(required=False)
+    grid_steps = forms.IntegerField(required=False, min_value=2,
+                                    max_value=1000)
+
+    # Convenience accessors for clean data with defaults.
+    cleaned_vary = property(lambda self: self._GetWithDefault('vary', 'ph'))
+    cleaned_grid_min = property(
+        lambda self: self._GetWithDefault('grid_min', None))
+    cleaned_grid_max = property(
+        lambda self: self._GetWithDefault('grid_max', None))
+    cleaned_grid_steps = property(
+        lambda self: self._GetWithDefault('grid_steps', None))
+
+
 class CompoundForm(BaseReactionForm):
 
     compoundId = forms.CharField(max_length=50)
@@ -1,6 +1,7 @@
 import logging
 import re
 import pyparsing
+from util import lru_cache
 
 ELEMENTS = ['H', 'He', 'Li', 'Be', 'B', 'C', 'N', 'O', 'F', 'Ne', 'Na',
             'Mg', 'Al', 'Si', 'P', 'S', 'Cl', 'Ar', 'K', 'Ca', 'Sc', 'Ti',
@@ -16,6 +17,77 @@ ELEMENTS = ['H', 'He', 'Li', 'Be', 'B', 'C', 'N', 'O', 'F', 'Ne', 'Na',
             'Cm', 'Bk', 'Cf', 'Es', 'Fm', 'Md', 'No',
             'R']  # R is not an alkane group, not an element but we allow it...
 
+_ELEMENT_SET = frozenset(ELEMENTS)
+_MAX_ELEMENT_LENGTH = max(map(len, ELEMENTS))
+
+# the multiplier of the atoms inside a (...)n block
+N_BLOCK_COEFF = 100
+
+
+class _TokenizerError(Exception):
+    pass
+
+
+def _ReadElement(formula, i):
+    """Returns the longest element symbol starting at formula[i]."""
+    for length in range(_MAX_ELEMENT_LENGTH, 0, -1):
+        el = formula[i:i + length]
+        if len(el) == length and el in _ELEMENT_SET:
+            return el
+    raise _TokenizerError('no element at position %d' % i)
+
+
+def _ReadCount(formula, i):
+    """Returns a two tuple (count, next position), count is 1 if missing."""
+    j = i
+    while j < len(formula) and formula[j].isdigit():
+        j += 1
+    if j == i:
+        return 1, i
+    return int(formula[i:j]), j
+
+
+def TokenizeAtomBag(formula):
+    """Parses a formula in a single pass.
+
+    Accepts the same grammar as FormulaParser, i.e. a sequence of elements
+    with optional counts and (...)n blocks, but only if it spans the whole
+    string (pyparsing also skips whitespace and ignores trailing text).
+
+    Returns:
+        A dictionary mapping atoms to counts.
+
+    Raises:
+        _TokenizerError if the formula does not match the grammar exactly.
+    """
+    atom_bag = {}
+    i = 0
+    n = len(formula)
+    if n == 0:
+        raise _TokenizerError('empty formula')
+    while i < n:
+        if formula[i] == '(':
+            block = []
+            i += 1
+            while i < n and formula[i] != ')':
+                el = _ReadElement(formula, i)
+                count, i = _ReadCount(formula, i + len(el))
+                block.append((el, count))
+            if not block or formula[i:i + 2] != ')n':
+                raise _TokenizerError('invalid block ending at %d' % i)
+            i += 2
+            for el, count in block:
+                atom_bag[el] = atom_bag.get(el, 0) + N_BLOCK_COEFF * count
+        else:
+            el = _ReadElement(formula, i)
+            count, i = _ReadCount(formula, i + len(el))
+            atom_bag[el] = atom_bag.get(el, 0) + count
+
+        # an element symbol followed by a lowercase letter is ambiguous
+        if i < n and formula[i].islower():
+            raise _TokenizerError('unexpected %s at %d' % (formula[i], i))
+    return atom_bag
+
 
 class _ElementAndCoeff(object):
 
@@ -38,7 +110,10 @@ class _Block(object):
 
 class FormulaParser(object):
 
-    def __init__(self):
+    def __init__(self, cache_size=50000):
+        # atom bags by formula, see GetAtomBag
+        self._cache = lru_cache.LRUCache(max_size=cache_size)
+
         element = pyparsing.oneOf(ELEMENTS)
         coeff = pyparsing.Word(pyparsing.nums)
         optional_coeff = pyparsing.Optional(coeff)
@@ -69,17 +144,31 @@ class FormulaParser(object):
         return _Block(block[1:-1])
 
     def GetAtomBag(self, formula):
-        """Returns a dictionary mapping atoms to counts for the formula."""
+        """Returns a dictionary mapping atoms to counts for the formula.
+
+        Results are cached by formula (callers get their own copy).
+        """
         if not formula:
             logging.error('Invalid formula %s', formula)
             return None
 
+        atom_bag = self._cache.Get(formula)
+        if atom_bag is None:
+            try:
+                atom_bag = TokenizeAtomBag(formula)
+            except _TokenizerError:
+                atom_bag = self.ParseAtomBag(formula)
+            self._cache.Set(formula, atom_bag)
+        return dict(atom_bag)
+
+    def ParseAtomBag(self, formula):
+        """Returns the atom bag of the formula, using the pyparsing grammar."""
         atom_bag = {}
         results = self.formula_parser.parseString(formula)
         for item in results:
             if item.IsBlock():
                 for el in item.elements:
-                    coeff = 100*el.coeff
+                    coeff = N_BLOCK_COEFF*el.coeff
                     atom_bag[el.el] = atom_bag.setdefault(el.el, 0) + coeff
             else:
                 atom_bag[item.el] = atom_bag.setdefault(item.el, 0) + \
@@ -0,0 +1,164 @@
+import numpy
+from scipy.special import logsumexp
+from util import constants
+
+# Debye-Huckel constants (at 25C)
+DEBYE_HUCKEL_A = 2.91482
+DEBYE_HUCKEL_B = 1.6
+
+
+def _AsGrid(pH, pMg, ionic_strength):
+    """Broadcast the conditions against each other.
+
+    Returns:
+        A three tuple of float arrays with the same shape (which is ()
+        if all the conditions are scalars).
+    """
+    return numpy.broadcast_arrays(numpy.asarray(pH, dtype=float),
+                                  numpy.asarray(pMg, dtype=float),
+                                  numpy.asarray(ionic_strength, dtype=float))
+
+
+class SpeciesArrays(object):
+    """The species of one compound, packed into arrays.
+
+    Computes the Legendre transform of all the species at once, and for any
+    number of conditions (pH, pMg and ionic strength can be arrays of any
+    shape, as long as they broadcast together).
+    """
+
+    def __init__(self, nH, z, nMg, dG0_f, phases):
+        """Initialize.
+
+        Args:
+            nH: the number of hydrogens in each species.
+            z: the net charge of each species.
+            nMg: the number of Mg2+ ions bound to each species.
+            dG0_f: the standard formation energy of each species (kJ/mol).
+            phases: the phase name of each species.
+        """
+        self.nH = numpy.array(nH, dtype=float)
+        self.z = numpy.array(z, dtype=float)
+        self.nMg = numpy.array(nMg, dtype=float)
+        self.dG0_f = numpy.array(dG0_f, dtype=float)
+        self.phases = numpy.array(phases, dtype=object)
+        assert self.nH.shape == self.z.shape == self.nMg.shape == \
+            self.dG0_f.shape == self.phases.shape
+
+    @staticmethod
+    def FromSpecies(species):
+        """Packs a list of Specie objects (or similar)."""
+        species = list(species)
+        return SpeciesArrays(
+            [s.number_of_hydrogens for s in species],
+            [s.net_charge for s in species],
+            [s.number_of_mgs for s in species],
+            [s.formation_energy for s in species],
+            [s.phase for s in species])
+
+    def __len__(self):
+        return self.nH.size
+
+    def HasPhase(self, phase):
+        return bool((self.phases == phase).any())
+
+    def Transform(self, pH, pMg, ionic_strength, mask=None):
+        """Transform the species to the given conditions.
+
+        Args:
+            pH, pMg, ionic_strength: scalars or arrays of conditions.
+            mask: (optional) a boolean array selecting the species.
+
+        Returns:
+            An array of shape (number of species,) + (shape of conditions)
+            with the transformed formation energies (dG0').
+        """
+        pH, pMg, ionic_strength = _AsGrid(pH, pMg, ionic_strength)
+        nH, z, nMg, dG0_f = self.nH, self.z, self.nMg, self.dG0_f
+        if mask is not None:
+            nH, z, nMg, dG0_f = nH[mask], z[mask], nMg[mask], dG0_f[mask]
+
+        # add a trailing axis for each dimension of the conditions
+        expand = (slice(None),) + (numpy.newaxis,) * pH.ndim
+        nH, z, nMg, dG0_f = nH[expand], z[expand], nMg[expand], dG0_f[expand]
+
+        sqrt_I = numpy.sqrt(ionic_strength)
+        dG_prime = dG0_f + numpy.where(nH > 0, nH, 0) * constants.RTlog10 * pH
+        dG_prime -= DEBYE_HUCKEL_A * (z ** 2 - nH) * sqrt_I / \
+            (1 + DEBYE_HUCKEL_B * sqrt_I)
+        dG_prime += numpy.where(nMg > 0, nMg, 0) * \
+            (constants.RTlog10 * pMg - constants.MG_FORMATION_ENERGY)
+        return dG_prime
+
+    def DeltaG0Prime(self, pH, pMg, ionic_strength,
+                     phase=constants.DEFAULT_PHASE):
+        """The transformed formation energy of the compound.
+
+        In the aqueous phase, all the species are in equilibrium and the
+        result is -RT*log(sum(exp(-dG0'_i/RT))). In any other phase there
+        must be exactly one species.
+
+        Returns:
+            The dG0' in the given conditions, with the shape of the
+            (broadcast) conditions, or None if there are no species
+            in this phase.
+
+        Raises:
+            ValueError: if there are several non-aqueous species.
+        """
+        mask = self.phases == phase
+        n_species = mask.sum()
+        if n_species == 0:
+            return None
+        if phase != constants.AQUEOUS_PHASE_NAME and n_species > 1:
+            raise ValueError('only aqueous phase can have multiple species')
+
+        transforms = self.Transform(pH, pMg, ionic_strength, mask=mask)
+        if n_species == 1:
+            return transforms[0]
+        return -constants.RT * logsumexp(-transforms / constants.RT, axis=0)
+
+
+def ReactionDeltaG0Prime(reactants, pH, pMg, ionic_strength):
+    """The transformed Gibbs energy of a reaction.
+
+    The species of all the reactants are transformed in a single pass, and
+    then reduced (with logsumexp) separately for each reactant.
+
+    Args:
+        reactants: a list of (coeff, SpeciesArrays, phase) tuples.
+        pH, pMg, ionic_strength: scalars or arrays of conditions.
+
+    Returns:
+        An array with the shape of the (broadcast) conditions, or None if
+        one of the reactants has no species in the requested phase.
+
+    Raises:
+        ValueError: if a reactant has several non-aqueous species.
+    """
+    masks = []
+    for coeff, species, phase in reactants:
+        mask = species.phases == phase
+        n_species = mask.sum()
+        if n_species == 0:
+            return None
+        if phase != constants.AQUEOUS_PHASE_NAME and n_species > 1:
+            raise ValueError('only aqueous phase can have multiple species')
+        masks.append(mask)
+
+    merged = SpeciesArrays(
+        *[numpy.concatenate([getattr(species, name)[mask]
+                             for (_, species, _), mask in zip(reactants,
+                                                              masks)])
+          for name in ('nH', 'z', 'nMg', 'dG0_f', 'phases')])
+    transforms = merged.Transform(pH, pMg, ionic_strength)
+
+    dG0_r_prime = numpy.zeros(transforms.shape[1:])
+    start = 0
+    for (coeff, _, _), mask in zip(reactants, masks):
+        end = start + mask.sum()
+        dG0_f_prime = -constants.RT * logsumexp(
+            -transforms[start:end] / constants.RT, axis=0)
+        dG0_r_prime += coeff * dG0_f_prime
+        start = end
+    return dG0_r_prime
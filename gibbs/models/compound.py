@@ -1,5 +1,6 @@
 #!/usr/bin/python
 
+import copy
 import json
 import logging
 import numpy
@@ -9,13 +10,22 @@ import base64
 from django.http import Http404
 from django.db import models
 from django.utils.text import slugify
-from django.apps import apps
 from util import constants
+from util import data_version
+from util import lru_cache
 from .. import formula_parser
 from .. import conditions
+from .. import legendre
+from .. import snapshot
+from .. import thumbnail_store
 from util.thumbnail import InChI2Thumbnail
 
 
+# A cache of compound dG0' values, see Compound.DeltaG0Prime. Most requests
+# concern a few hundred cofactors in default conditions.
+DG0_PRIME_CACHE = lru_cache.LRUCache(max_size=20000)
+
+
 class CommonName(models.Model):
     """
         A common name of a compound.
@@ -154,31 +164,9 @@ class Specie(models.Model):
         """
             Transform this individual estimate to difference conditions.
         """
-
-        sqrt_I = numpy.sqrt(aq_params.ionic_strength)
-        pH = aq_params.pH
-        pMg = aq_params.pMg
-        nH = self.number_of_hydrogens
-        nMg = self.number_of_mgs
-        z = self.net_charge
-        dG = self.formation_energy
-        dG_prime = dG
-
-        # add the potential related to the pH
-        if nH > 0:
-            dG_prime += nH * constants.RTlog10 * pH
-
-        # add the potential related to the ionic strength
-        dG_prime -= 2.91482 * (z ** 2 - nH) * sqrt_I / (1 + 1.6 * sqrt_I)
-
-        # add the potential related to the Mg ions
-        if nMg > 0:
-            dG_prime += nMg * \
-                  (constants.RTlog10 * pMg - constants.MG_FORMATION_ENERGY)
-
-        logging.debug('nH = %d, z = %d, dG0 = %.1f --> dG0\' = %.1f' %
-                      (nH, z, dG, dG_prime))
-        return dG_prime
+        transforms = legendre.SpeciesArrays.FromSpecies([self]).Transform(
+            aq_params.pH, aq_params.pMg, aq_params.ionic_strength)
+        return float(transforms[0])
 
     def __unicode__(self):
         return self.kegg_id
@@ -212,6 +200,7 @@ class SpeciesGroup(models.Model):
     def __init__(self, *args, **kwargs):
         super(SpeciesGroup, self).__init__(*args, **kwargs)
         self._all_species = None
+        self._species_arrays = None
 
     def __str__(self):
         s = "KEGG ID = %s\npriority = %d\nformation_energy_source = %s\n" % \
@@ -225,6 +214,13 @@ class SpeciesGroup(models.Model):
         return self._all_species
     all_species = property(GetSpecies)
 
+    def GetSpeciesArrays(self):
+        """Gets the species packed as a legendre.SpeciesArrays, caching."""
+        if self._species_arrays is None:
+            self._species_arrays = legendre.SpeciesArrays.FromSpecies(
+                self.all_species)
+        return self._species_arrays
+
     def GetPhaseSpecies(self, phase=constants.DEFAULT_PHASE):
         """
             Get a list of all species corresponding to a certain phase
@@ -243,8 +239,11 @@ class SpeciesGroup(models.Model):
         """
             Stash the transformed species formation energy in each one.
         """
-        for species in self.all_species:
-            species.transformed_energy = species.Transform(aq_params)
+        transforms = self.GetSpeciesArrays().Transform(
+            aq_params.pH, aq_params.pMg, aq_params.ionic_strength)
+        self._all_species = [copy.copy(s) for s in self.all_species]
+        for species, dg0_prime in zip(self.all_species, transforms):
+            species.transformed_energy = float(dg0_prime)
 
     def DeltaG0Prime(self, aq_params,
                      phase=constants.DEFAULT_PHASE):
@@ -259,39 +258,22 @@ class SpeciesGroup(models.Model):
             Returns:
                 The estimated delta G in the given conditions or None.
         """
-        species = self.GetPhaseSpecies(phase)
-
-        if not species:
+        species_arrays = self.GetSpeciesArrays()
+        if not species_arrays.HasPhase(phase):
             logging.warning('No data for this compound (%s) in this '
                             'phase (%s) and priority (%d)' %
                             (self.kegg_id, phase, self.priority))
             return None
 
-        logging.debug('Calculating dG0\' for %s' % (self.kegg_id))
-        if phase == constants.DEFAULT_PHASE:
-            # Compute per-species transforms, scaled down by R*T.
-            scaled_transforms = [(-s.Transform(aq_params) / constants.RT)
-                                 for s in species]
-
-            # Numerical issues: taking a sum of exp(v) for |v| quite large.
-            # Use the fact that we take a log later to offset all values by a
-            # constant (the minimum value).
-            total = scaled_transforms[0]
-            for i in range(1, len(scaled_transforms)):
-                total = numpy.logaddexp(total, scaled_transforms[i])
-            dg0_prime = -constants.RT * total
-        else:
-            if len(species) > 1:
-                logging.error('only aqueous phase can have multiple species')
-                raise Http404
-            else:
-                # compounds which are not in solution do not need to be
-                # transformed since they have only one specie and there is no
-                # equilibrium between pseudoisomers in that phase
-                dg0_prime = species[0].Transform(aq_params)
-
-        logging.debug('total: dG0\' = %.1f' % dg0_prime)
-        return dg0_prime
+        try:
+            dg0_prime = species_arrays.DeltaG0Prime(
+                aq_params.pH, aq_params.pMg, aq_params.ionic_strength, phase)
+        except ValueError as e:
+            logging.error(str(e))
+            raise Http404
+
+        logging.debug('%s: dG0\' = %.1f' % (self.kegg_id, dg0_prime))
+        return float(dg0_prime)
 
     def GetSourceReferenceLink(self):
         source_name = self.formation_energy_source
@@ -366,25 +348,37 @@ class Compound(models.Model):
     def __init__(self, *args, **kwargs):
         super(Compound, self).__init__(*args, **kwargs)
         self._all_species_groups = None
+        self._species_group_index = None
         self._species_group_to_use = None
         self._priority = None
 
+    def GetSpeciesGroupIndex(self):
+        """
+            Get a dictionary mapping each priority to its species group,
+            built once from all_species_groups.
+        """
+        if self._species_group_index is None:
+            index = {}
+            for sg in self.all_species_groups:
+                index.setdefault(sg.priority, sg)
+            self._species_group_index = index
+        return self._species_group_index
+
     def GetSpeciesGroupPriorities(self):
         """
             Get the priorities of species groups available.
         """
-        return [sg.priority for sg in self.all_species_groups]
+        return sorted(self.GetSpeciesGroupIndex().keys())
 
     def SetSpeciesGroupPriority(self, priority):
         """
             Set the priority of the species group to use.
         """
-        for sg in self.species_groups.all():
-            if sg.priority == priority:
-                self._species_group_to_use = sg
-                logging.debug('Setting priority for %s to %d' %
-                              (self.kegg_id, priority))
-                break
+        sg = self.GetSpeciesGroupIndex().get(priority)
+        if sg is not None:
+            self._species_group_to_use = sg
+            logging.debug('Setting priority for %s to %d' %
+                          (self.kegg_id, priority))
 
     def SetHighestPriority(self):
         """
@@ -443,8 +437,26 @@ class Compound(models.Model):
         if not sg:
             return None
 
-        dg0_prime = sg.DeltaG0Prime(aq_params, phase)
-        return dg0_prime
+        key = self.DeltaG0PrimeKey(aq_params, phase)
+        if key is None:
+            return sg.DeltaG0Prime(aq_params, phase)
+        return DG0_PRIME_CACHE.GetOrCompute(
+            key, lambda: sg.DeltaG0Prime(aq_params, phase))
+
+    def DeltaG0PrimeKey(self, aq_params, phase=None):
+        """
+            Returns a hashable key for caching the dG0' of this compound,
+            i.e. (kegg_id, priority, phase, pH, pMg, I, data version).
+
+            Returns None if the species group used is not stored in the
+            database (its species might change, so it cannot be cached).
+        """
+        sg = self._species_group
+        if sg is None or sg.pk is None:
+            return None
+        phase = phase or self.GetDefaultPhaseName()
+        return (self.kegg_id, sg.priority, phase) + aq_params.Key() + \
+            (data_version.Get(),)
 
     def WriteStructureThumbnail(self):
         self.thumbnail = 'error'
@@ -498,6 +510,18 @@ class Compound(models.Model):
 
         return '/compound_image?compoundId=%s' % self.kegg_id
 
+    def HasThumbnail(self):
+        """
+            Returns True if the compound has a structure thumbnail.
+
+            The exported thumbnail index is used when it exists, so that
+            the thumbnail column (which the snapshot defers) is not loaded.
+        """
+        thumbnails = thumbnail_store.Get()
+        if len(thumbnails):
+            return thumbnails.GetDigest(self.kegg_id) is not None
+        return bool(self.thumbnail) and self.thumbnail != 'error'
+
     def GetHtmlFormattedFormula(self):
         """Returns the chemical formula with HTML formatted subscripts."""
         if not self.formula:
@@ -601,7 +625,7 @@ class Compound(models.Model):
 
     def HasSpeciesGroups(self):
         """Returns true if this compound has any species groups."""
-        return self.species_groups.count() > 0
+        return len(self.GetSpeciesGroupIndex()) > 0
 
     def GetUniqueSpeciesGroups(self):
         """Iterator of unique species groups."""
@@ -663,6 +687,7 @@ class Compound(models.Model):
     link = property(GetLink)
     kegg_link = property(GetKeggLink)
     small_image_url = property(GetSmallImageUrl)
+    has_thumbnail = property(HasThumbnail)
     all_common_names = property(_GetAllCommonNames)
     all_species = property(GetSpecies)
     all_species_groups = property(GetSpeciesGroups)
@@ -677,6 +702,10 @@ class Compound(models.Model):
 
     def StashTransformedSpeciesEnergies(self, aq_params):
         """Stash the transformed species formation energy in each one."""
+        # the species groups might be shared with other compound objects
+        # (see gibbs.snapshot), so the energies are stashed in copies
+        self._all_species_groups = [copy.copy(sg)
+                                    for sg in self.all_species_groups]
         for sg in self.all_species_groups:
             sg.StashTransformedSpeciesEnergies(aq_params)
 
@@ -779,9 +808,8 @@ class CompoundWithCoeff(models.Model):
         if 'compound' in d:
             compound = d['compound']
         else:
-            try:
-                compound = apps.get_model('gibbs.Compound').objects.get(kegg_id=kegg_id)
-            except Exception:
+            compound = snapshot.Get().GetCompound(kegg_id)
+            if compound is None:
                 return None
 
         coeff = d.get('coeff', 1)
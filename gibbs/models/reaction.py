@@ -4,45 +4,79 @@ import hashlib
 import logging
 import numpy
 import urllib
-import os
 import json
-from scipy.sparse import csr_matrix
+from scipy.sparse import csr_matrix, csc_matrix
 from django.db import models
 from django.apps import apps
 from util import constants
+from util import data_version
+from util import lru_cache
 from .. import conditions
+from .. import cc_preprocess
+from .. import legendre
+from .. import reaction_index
+from .. import snapshot
 from .compound import CommonName, CompoundWithCoeff
 
 
+# A cache of reaction dG0' values, see Reaction.DeltaG0Prime.
+DG0_PRIME_CACHE = lru_cache.LRUCache(max_size=20000)
+
+
 class Preprocessing(object):
-    relpath = os.path.dirname(os.path.realpath(__file__))
-    cc_preprocess_fname = os.path.join(relpath, '../../data/cc_preprocess.npz')
-    cc_preprocess = numpy.load(cc_preprocess_fname)
-
-    C1 = numpy.matrix(cc_preprocess['C1'])
-    C2 = numpy.matrix(cc_preprocess['C2'])
-    C3 = numpy.matrix(cc_preprocess['C3'])
-    G1 = numpy.matrix(cc_preprocess['G1'])
-    G2 = numpy.matrix(cc_preprocess['G2'])
-    G3 = numpy.matrix(cc_preprocess['G3'])
-    S = numpy.matrix(cc_preprocess['S'])
-    cids = cc_preprocess['cids']
-    Nc = C1.shape[0]
-    Ng = C3.shape[0]
-    assert C1.shape[0] == C1.shape[1]
-    assert C1.shape[1] == C2.shape[0]
-    assert C2.shape[1] == C3.shape[0]
-    assert C3.shape[0] == C3.shape[1]
-    assert C3.shape[0] == C3.shape[1]
+    """
+        Component Contribution calculations (uncertainty and analysis).
+
+        The preprocessing matrices are loaded on first use (see
+        gibbs.cc_preprocess), not when this module is imported.
+    """
+
+    # a CompoundVectorStore of all the compounds, built on first use and
+    # rebuilt when the compound snapshot is reloaded
+    _compound_vectors = None
+    _compound_vectors_snapshot = None
+
+    # the reaction strings of the CC training reactions, built on first use
+    _training_reaction_strings = None
+
+    # the number of training reactions returned by Analyze()
+    ANALYZE_TOP_K = 50
+
+    @staticmethod
+    def Data():
+        return cc_preprocess.Get()
+
+    @staticmethod
+    def CompoundVectors():
+        """
+            Returns the (x, g) vectors of all the compounds in the database,
+            in a single sparse matrix. The group vectors are parsed only once.
+        """
+        snap = snapshot.Get()
+        if Preprocessing._compound_vectors_snapshot is not snap:
+            cc = Preprocessing.Data()
+            rows = [(kegg_id,
+                     int(index) if index >= 0 else None,
+                     json.loads(gv) if gv else None)
+                    for kegg_id, index, gv in zip(snap.kegg_ids,
+                                                  snap.cc_index,
+                                                  snap.group_vectors)]
+            Preprocessing._compound_vectors = \
+                cc_preprocess.CompoundVectorStore(cc.Nc, cc.Ng, rows)
+            Preprocessing._compound_vectors_snapshot = snap
+            logging.debug('Compiled the CC vectors of %d compounds' %
+                          len(rows))
+        return Preprocessing._compound_vectors
 
     @staticmethod
     def GetCompoundVectors(compound):
         # x is the stoichiometric vector of the reaction, only for the
         # compounds that appeared in the original training set for CC
-        x = numpy.matrix(numpy.zeros((Preprocessing.Nc, 1)))
+        cc = Preprocessing.Data()
+        x = numpy.matrix(numpy.zeros((cc.Nc, 1)))
 
         # g is the group incidence vector of all the other compounds
-        g = numpy.matrix(numpy.zeros((Preprocessing.Ng, 1)))
+        g = numpy.matrix(numpy.zeros((cc.Ng, 1)))
         logging.debug(compound.compound.kegg_id)
         i = compound.compound.index
         gv = compound.compound.sparse_gv
@@ -62,10 +96,11 @@ class Preprocessing(object):
     def GetReactionVectors(reactants):
         # x is the stoichiometric vector of the reaction, only for the
         # compounds that appeared in the original training set for CC
-        x_reaction = numpy.matrix(numpy.zeros((Preprocessing.Nc, 1)))
+        cc = Preprocessing.Data()
+        x_reaction = numpy.matrix(numpy.zeros((cc.Nc, 1)))
 
         # g is the group incidence vector of all the other compounds
-        g_reaction = numpy.matrix(numpy.zeros((Preprocessing.Ng, 1)))
+        g_reaction = numpy.matrix(numpy.zeros((cc.Ng, 1)))
         for x, g in map(Preprocessing.GetCompoundVectors, reactants):
             x_reaction += x
             g_reaction += g
@@ -74,11 +109,97 @@ class Preprocessing(object):
         logging.debug('g = %s' % csr_matrix(g_reaction))
         return x_reaction, g_reaction
 
+    @staticmethod
+    def GetSparseReactionVector(reactants):
+        """
+            Returns the SparseReactionVector of a list of CompoundWithCoeff.
+        """
+        sparse = {}
+        for c in reactants:
+            sparse[c.compound.kegg_id] = \
+                sparse.get(c.compound.kegg_id, 0) + c.coeff
+
+        store = Preprocessing.CompoundVectors()
+        if all(map(store.HasCompound, sparse.keys())):
+            return store.ReactionVector(sparse)
+
+        # some compounds are not in the database, use their own fields
+        x, g = Preprocessing.GetReactionVectors(reactants)
+        xg = numpy.vstack([x, g]).A1
+        indices = numpy.nonzero(xg)[0]
+        return cc_preprocess.SplitSparseVector(indices, xg[indices],
+                                               x.shape[0])
+
+    @staticmethod
+    def SparseDeltaGUncertainty(v):
+        """
+            Same as DeltaGUncertainty, for a SparseReactionVector.
+        """
+        return float(numpy.sqrt(
+            cc_preprocess.QuadraticForm(Preprocessing.Data(), v)))
+
+    @staticmethod
+    def SparseIsUsingGroupContributions(v):
+        """
+            Same as IsUsingGroupContributions, for a SparseReactionVector.
+        """
+        cc = Preprocessing.Data()
+        weights_gc = (v.x_val.dot(numpy.asarray(cc.G2[v.x_ind, :])) +
+                      v.g_val.dot(numpy.asarray(cc.G3[v.g_ind, :])))
+        sum_w_gc = numpy.abs(weights_gc).sum()
+        logging.debug('sum(w_gc) = %.2g' % sum_w_gc)
+        return sum_w_gc > 1e-5
+
+    @staticmethod
+    def DeltaGUncertaintyBatch(S, kegg_ids):
+        """
+            Computes the uncertainty of many reactions at once.
+
+            Args:
+                S: a stoichiometric matrix with compounds on the rows and
+                   reactions on the columns.
+                kegg_ids: the KEGG IDs of the rows of S.
+
+            Returns:
+                A two tuple (std, is_using_gc) of arrays with one value per
+                reaction. std is NaN for reactions that cannot be handled in
+                the batch (see CompoundVectorStore.ReactionMatrix).
+        """
+        cc = Preprocessing.Data()
+        V, is_valid = Preprocessing.CompoundVectors().ReactionMatrix(
+            S, kegg_ids)
+        std = numpy.sqrt(cc_preprocess.BatchQuadraticForm(cc, V))
+        std[~is_valid] = numpy.nan
+        is_using_gc = cc_preprocess.BatchGroupContributionWeights(cc, V) > 1e-5
+        return std, is_using_gc
+
+    @staticmethod
+    def DeltaGCovarianceSqrt(S, kegg_ids):
+        """
+            Computes the square root of the joint covariance of many
+            reactions (see cc_preprocess.CovarianceSqrt).
+
+            Args:
+                S: a stoichiometric matrix with compounds on the rows and
+                   reactions on the columns.
+                kegg_ids: the KEGG IDs of the rows of S.
+
+            Raises:
+                ValueError: if one of the reactions cannot be estimated.
+        """
+        V, is_valid = Preprocessing.CompoundVectors().ReactionMatrix(
+            S, kegg_ids)
+        if not is_valid.all():
+            raise ValueError('cannot compute the covariance of reactions '
+                             'with compounds that have no estimate')
+        return cc_preprocess.CovarianceSqrt(Preprocessing.Data(), V)
+
     @staticmethod
     def DeltaGUncertainty(x, g):
-        return float(numpy.sqrt(x.T * Preprocessing.C1 * x +
-                             x.T * Preprocessing.C2 * g +
-                             g.T * Preprocessing.C3 * g))
+        cc = Preprocessing.Data()
+        return float(numpy.sqrt(x.T * cc.C1 * x +
+                                x.T * cc.C2 * g +
+                                g.T * cc.C3 * g))
 
     @staticmethod
     def WriteCompoundAndCoeff(kegg_id, coeff):
@@ -101,27 +222,65 @@ class Preprocessing(object):
         return "%s %s %s" % (' + '.join(left), '<=>', ' + '.join(right))
 
     @staticmethod
-    def Analyze(x, g):
-        weights_rc = x.T * Preprocessing.G1
-        weights_gc = x.T * Preprocessing.G2 + g.T * Preprocessing.G3
+    def TrainingReactionStrings():
+        """
+            Returns the list of reaction strings of the training reactions
+            (the columns of S). Computed once per process.
+        """
+        if Preprocessing._training_reaction_strings is None:
+            cc = Preprocessing.Data()
+            S = csc_matrix(cc.S)
+            strings = []
+            for j in range(S.shape[1]):
+                col = slice(S.indptr[j], S.indptr[j + 1])
+                d = dict(zip((cc.cids[i] for i in S.indices[col]),
+                             S.data[col]))
+                strings.append(Preprocessing.DictToReactionString(d))
+            Preprocessing._training_reaction_strings = strings
+        return Preprocessing._training_reaction_strings
+
+    @staticmethod
+    def _TopContributions(weights_rc, weights_gc, top_k):
+        """
+            Returns the top_k training reactions sorted by the absolute
+            value of their total weight.
+        """
         weights = weights_rc + weights_gc
+        abs_weights = numpy.abs(weights)
+        if top_k is not None and top_k < weights.size:
+            top = numpy.argpartition(-abs_weights, top_k)[:top_k]
+        else:
+            top = numpy.arange(weights.size)
+        top = top[numpy.argsort(-abs_weights[top], kind='mergesort')]
 
-        res = []
-        for j in range(Preprocessing.S.shape[1]):
-            d = {Preprocessing.cids[i]: Preprocessing.S[i, j]
-                 for i in range(Preprocessing.Nc)
-                 if Preprocessing.S[i, j] != 0}
-            r_string = Preprocessing.DictToReactionString(d)
-            res.append({'w': weights[0, j],
-                        'w_rc': weights_rc[0, j].round(4),
-                        'w_gc': weights_gc[0, j].round(4),
-                        'reaction_string': r_string})
-        res.sort(key=lambda d: abs(d['w']), reverse=True)
-        return res
+        strings = Preprocessing.TrainingReactionStrings()
+        return [{'w': weights[j],
+                 'w_rc': weights_rc[j].round(4),
+                 'w_gc': weights_gc[j].round(4),
+                 'reaction_string': strings[j]} for j in top]
+
+    @staticmethod
+    def Analyze(x, g, top_k=ANALYZE_TOP_K):
+        cc = Preprocessing.Data()
+        weights_rc = numpy.asarray(x.T * cc.G1).ravel()
+        weights_gc = numpy.asarray(x.T * cc.G2 + g.T * cc.G3).ravel()
+        return Preprocessing._TopContributions(weights_rc, weights_gc, top_k)
+
+    @staticmethod
+    def SparseAnalyze(v, top_k=ANALYZE_TOP_K):
+        """
+            Same as Analyze, for a SparseReactionVector.
+        """
+        cc = Preprocessing.Data()
+        weights_rc = v.x_val.dot(numpy.asarray(cc.G1[v.x_ind, :]))
+        weights_gc = (v.x_val.dot(numpy.asarray(cc.G2[v.x_ind, :])) +
+                      v.g_val.dot(numpy.asarray(cc.G3[v.g_ind, :])))
+        return Preprocessing._TopContributions(weights_rc, weights_gc, top_k)
 
     @staticmethod
     def IsUsingGroupContributions(x, g):
-        weights_gc = x.T * Preprocessing.G2 + g.T * Preprocessing.G3
+        cc = Preprocessing.Data()
+        weights_gc = x.T * cc.G2 + g.T * cc.G3
         sum_w_gc = sum(numpy.abs(weights_gc).flat)
         logging.debug('sum(w_gc) = %.2g' % sum_w_gc)
         return sum_w_gc > 1e-5
@@ -140,6 +299,10 @@ class ReactantFormulaMissingError(Exception):
 class Reaction(models.Model):
     """A reaction."""
 
+    # the hashes of ATP hydrolysis and CO2 hydration, see
+    # GetSpecialReactionWarning
+    _special_hashes = None
+
     def __init__(self, reactants=None, aq_params=None):
         """Construction.
 
@@ -160,7 +323,9 @@ class Reaction(models.Model):
         self.is_using_gc = False
 
         # used only as cache, no need to copy while cloning
-        self._catalyzing_enzymes = None
+        self._ClearCache()
+        self._cofactor_multiples = None
+        self._cofactor_multiples_key = None
 
     def SetAqueousParams(self, aq_params):
         self._dg0_prime = None
@@ -195,15 +360,14 @@ class Reaction(models.Model):
 
         # The chosen priority will be the highest number which is common
         # to all reactants.
-        priorities = [c.compound.GetSpeciesGroupPriorities()
-                      for c in self.reactants]
-        priorities = list(filter(lambda l: len(l) > 0, priorities))
+        indices = [c.compound.GetSpeciesGroupIndex() for c in self.reactants]
+        max_priorities = [max(index) for index in indices if index]
 
         # Someone is missing data!
-        if priorities == []:
+        if max_priorities == []:
             return 0
         else:
-            return min([max(l) for l in priorities] + [max_priority])
+            return min(max_priorities + [max_priority])
 
     def _SetCompoundPriorities(self):
         """
@@ -217,6 +381,7 @@ class Reaction(models.Model):
         """Swap the sides of this reaction."""
         for c in self.reactants:
             c.coeff = -c.coeff
+        self._ClearCache()
 
     def GetSubstrates(self):
         s = [c for c in self.reactants if c.coeff < 0]
@@ -243,7 +408,24 @@ class Reaction(models.Model):
         return apps.get_model('gibbs.StoredReaction').HashReaction(s)
 
     def GetHash(self):
-        return Reaction._GetHash(self.GetSparseRepresentation())
+        if self._hash is None:
+            self._hash = Reaction._GetHash(self.GetSparseRepresentation())
+        return self._hash
+
+    def _ClearCache(self):
+        """Must be called whenever the reactants change."""
+        self._hash = None
+        self._catalyzing_enzymes = None
+
+    @staticmethod
+    def _GetSpecialHashes():
+        """Returns the hashes of ATP hydrolysis and CO2 hydration."""
+        if Reaction._special_hashes is None:
+            atp_sparse = {'C00002': -1, 'C00001': -1, 'C00008': 1, 'C00009': 1}
+            co2_sparse = {'C00011': -1, 'C00001': -1, 'C01353': 1}
+            Reaction._special_hashes = (Reaction._GetHash(atp_sparse),
+                                        Reaction._GetHash(co2_sparse))
+        return Reaction._special_hashes
 
     def GetSpecialReactionWarning(self):
 
@@ -251,11 +433,7 @@ class Reaction(models.Model):
             return '</br><a href="/static/classic_rxns/faq.html#%s">Learn more &raquo;</a>' % faq_mark
 
         my_hash = self.GetHash()
-
-        atp_sparse = {'C00002': -1, 'C00001': -1, 'C00008': 1, 'C00009': 1}
-        co2_sparse = {'C00011': -1, 'C00001': -1, 'C01353': 1}
-        atp_hash = Reaction._GetHash(atp_sparse)
-        co2_hash = Reaction._GetHash(co2_sparse)
+        atp_hash, co2_hash = Reaction._GetSpecialHashes()
 
         if my_hash == atp_hash:
             return ("The &Delta;G' of ATP hydrolysis is highly affected " +
@@ -286,38 +464,20 @@ class Reaction(models.Model):
         else:
             return False
 
-    def _GetAllStoredReactions(self):
-        """
-            Find all stored reactions matching this compound (using the hash)
-        """
-        logging.debug('looking for stored reactions matching this one')
-        my_hash = self.GetHash()
-
-        matching_stored_reactions = apps.get_model(
-            'gibbs.StoredReaction').objects.select_related().filter(
-            reaction_hash=my_hash)
-        logging.debug('my hash = %s (%d matches)' %
-                      (my_hash, len(matching_stored_reactions)))
-
-        return matching_stored_reactions
-
     @property
     def stored_reaction_id(self):
-        stored_rxns = self._GetAllStoredReactions()
-        if not stored_rxns:
+        kegg_ids = reaction_index.Get().Get(self.GetHash()).kegg_ids
+        if not kegg_ids:
             return None
-        return stored_rxns[0].kegg_id
+        return kegg_ids[0]
 
     def _GetCatalyzingEnzymes(self):
         """
             Get all the enzymes catalyzing this reaction.
         """
         if self._catalyzing_enzymes is None:
-            logging.debug('looking for enzymes catalyzing this reaction')
-            self._catalyzing_enzymes = set()
-            for stored_reaction in self._GetAllStoredReactions():
-                enzymes = stored_reaction.enzyme_set.all()
-                self._catalyzing_enzymes.update(enzymes)
+            self._catalyzing_enzymes = reaction_index.Get().GetEnzymes(
+                self.GetHash())
         return list(self._catalyzing_enzymes)
 
     def ToJson(self):
@@ -396,10 +556,7 @@ class Reaction(models.Model):
             A properly set-up Reaction object or None if there's an error.
         """
         kegg_ids = [d['kegg_id'] for d in compound_list]
-        comps = apps.get_model('gibbs.Compound').objects.prefetch_related(
-            'species_groups', 'species_groups__species',
-            'common_names').filter(kegg_id__in=kegg_ids)
-        kegg_id_to_compound = {c.kegg_id: c for c in comps}
+        kegg_id_to_compound = snapshot.Get().GetCompounds(kegg_ids)
         for d in compound_list:
             d['compound'] = kegg_id_to_compound[d['kegg_id']]
         if fetch_db_names:
@@ -408,10 +565,63 @@ class Reaction(models.Model):
         reactants = list(map(CompoundWithCoeff.FromDict, compound_list))
         return Reaction(reactants, aq_params=aq_params)
 
+    @staticmethod
+    def _CollectionsMatrix(collections):
+        """
+            Returns a two tuple (S, kegg_ids) where S is a sparse matrix with
+            compounds on the rows (in the order of kegg_ids) and one column
+            per collection of CompoundWithCoeff. Coefficients of repeated
+            compounds are summed.
+        """
+        kegg_id_to_index = {}
+        rows, cols, coeffs = [], [], []
+        for j, collection in enumerate(collections):
+            for compound_w_coeff in collection:
+                kegg_id = compound_w_coeff.compound.kegg_id
+                rows.append(kegg_id_to_index.setdefault(
+                    kegg_id, len(kegg_id_to_index)))
+                cols.append(j)
+                coeffs.append(float(compound_w_coeff.coeff))
+        kegg_ids = sorted(kegg_id_to_index, key=kegg_id_to_index.get)
+        S = csr_matrix((coeffs, (rows, cols)),
+                       shape=(len(kegg_ids), len(collections)))
+        return S, kegg_ids
+
+    @staticmethod
+    def _IsInElementMatrix(collection):
+        elements = snapshot.Get().element_matrix
+        return all(elements.HasCompound(c.compound.kegg_id)
+                   for c in collection)
+
     @staticmethod
     def _GetCollectionAtomDiff(collection):
         """Get the net atom counts from the collection.
 
+        Uses the element matrix of the compound snapshot, unless some
+        of the compounds are not in it.
+
+        Args:
+            collection: an iterable of CompoundWithCoeff instances.
+        """
+        collection = list(collection)
+        if not Reaction._IsInElementMatrix(collection):
+            return Reaction._ParseCollectionAtomDiff(collection)
+
+        elements = snapshot.Get().element_matrix
+        for compound_w_coeff in collection:
+            c = compound_w_coeff.compound
+            if not elements.HasAtomBag(c.kegg_id):
+                logging.warning('Failed to fetch atom bag for %s', c.formula)
+                raise ReactantFormulaMissingError(c)
+
+        S, kegg_ids = Reaction._CollectionsMatrix([collection])
+        D, _ = elements.AtomDiffs(S, kegg_ids)
+        return elements.AtomDiffDict(D[0, :])
+
+    @staticmethod
+    def _ParseCollectionAtomDiff(collection):
+        """Get the net atom counts by parsing the formula of each compound.
+
         Args:
             collection: an iterable of CompoundWithCoeff instances.
         """
@@ -441,18 +651,28 @@ class Reaction(models.Model):
         Args:
             collection: an iterable of CompoundWithCoeff instances.
         """
-        electron_diff = 0
-        for compound_w_coeff in collection:
-            c = compound_w_coeff.compound
-            coeff = compound_w_coeff.coeff
-
-            electrons = c.num_electrons
-            if electrons is None:
-                logging.warning('Compound %s has unknown electron count',
-                                c.kegg_id)
+        collection = list(collection)
+        if Reaction._IsInElementMatrix(collection):
+            elements = snapshot.Get().element_matrix
+            S, kegg_ids = Reaction._CollectionsMatrix([collection])
+            electron_diff = elements.ElectronDiffs(S, kegg_ids)[0]
+            if numpy.isnan(electron_diff):
+                logging.warning('A compound in %s has unknown electron count',
+                                ', '.join(kegg_ids))
                 return 0
+        else:
+            electron_diff = 0
+            for compound_w_coeff in collection:
+                c = compound_w_coeff.compound
+                coeff = compound_w_coeff.coeff
+
+                electrons = c.num_electrons
+                if electrons is None:
+                    logging.warning('Compound %s has unknown electron count',
+                                    c.kegg_id)
+                    return 0
 
-            electron_diff += coeff * electrons
+                electron_diff += coeff * electrons
 
         # ignore the differences if they are very close to 0
         if abs(electron_diff) > 1e-6:
@@ -512,17 +732,25 @@ class Reaction(models.Model):
         return other.GetHyperlink(query)
 
     def GetBalanceWithCoALink(self, query=None):
-        """Returns a link to balance this reaction with water."""
+        """Returns a link to balance this reaction with CoA."""
         other = self.Clone()
         other.TryBalanceWithCoA()
         return other.GetHyperlink(query)
 
     def GetBalanceWithPiLink(self, query=None):
-        """Returns a link to balance this reaction with water."""
+        """Returns a link to balance this reaction with Pi."""
         other = self.Clone()
         other.TryBalanceWithPi()
         return other.GetHyperlink(query)
 
+    def GetBalanceLinks(self, query=None, names=None):
+        """
+            Returns a dictionary mapping cofactor names to links to this
+            reaction balanced with that cofactor (see GetBalancedVariants).
+        """
+        return {name: other.GetHyperlink(query)
+                for name, other in self.GetBalancedVariants(names).items()}
+
     def GetBalanceElectronsLink(self, query=None):
         """
             Returns a link to the same reaction,
@@ -556,16 +784,27 @@ class Reaction(models.Model):
                          'balance_with_pi_link': None}
         if not self._is_formation_reaction:
             try:
-                if not self.IsBalanced():
+                is_balanced = self.IsBalanced()
+                is_electron_balanced = self.IsElectronBalanced()
+                # all the cofactors are solved for in one pass, but links
+                # are made only for those the page shows
+                names = []
+                if not is_balanced:
+                    names += ['water', 'coa', 'pi']
+                if not is_electron_balanced:
+                    names.append('nad')
+                links = self.GetBalanceLinks(query, names) if names else {}
+                if not is_balanced:
                     template_data.update({'balance_with_water_link':
-                                          self.GetBalanceWithWaterLink(query),
+                                          links.get('water'),
                                           'balance_with_coa_link':
-                                          self.GetBalanceWithCoALink(query),
+                                          links.get('coa'),
                                           'balance_with_pi_link':
-                                          self.GetBalanceWithPiLink(query)})
-                if not self.IsElectronBalanced():
+                                          links.get('pi')})
+                if not is_electron_balanced:
                     template_data.update({'balance_electrons_link':
-                                         self.GetBalanceElectronsLink(query)})
+                                          links.get('nad') or
+                                          self.GetBalanceElectronsLink(query)})
             except ReactantFormulaMissingError:
                 pass
 
@@ -675,6 +914,50 @@ class Reaction(models.Model):
         """
         return self._GetElectronDiff() == 0
 
+    @staticmethod
+    def AreBalanced(reactions):
+        """
+            Same as calling IsBalanced() and IsElectronBalanced() for every
+            reaction in the list, but computed with one sparse product.
+
+            Args:
+                reactions: a list of Reaction objects.
+
+            Returns:
+                A two tuple of boolean arrays (is_balanced,
+                is_electron_balanced), with one value per reaction.
+        """
+        is_balanced = numpy.zeros(len(reactions), dtype=bool)
+        is_electron_balanced = numpy.zeros(len(reactions), dtype=bool)
+        in_matrix = [Reaction._IsInElementMatrix(r.reactants)
+                     for r in reactions]
+
+        # reactions with compounds that are not in the snapshot
+        for i, rxn in enumerate(reactions):
+            if not in_matrix[i]:
+                is_balanced[i] = rxn.IsBalanced()
+                is_electron_balanced[i] = rxn.IsElectronBalanced()
+
+        ind = numpy.nonzero(in_matrix)[0]
+        if ind.size == 0:
+            return is_balanced, is_electron_balanced
+
+        elements = snapshot.Get().element_matrix
+        S, kegg_ids = Reaction._CollectionsMatrix(
+            [reactions[i].reactants for i in ind])
+        D, has_formulas = elements.AtomDiffs(S, kegg_ids)
+        # Always ignore hydrogens, ala Alberty.
+        if 'H' in elements.elements:
+            D[:, elements.elements.index('H')] = 0
+        is_balanced[ind] = has_formulas & numpy.all(numpy.abs(D) < 0.01,
+                                                   axis=1)
+
+        # unknown electron counts are considered balanced, as in
+        # _GetCollectionElectronDiff
+        e = elements.ElectronDiffs(S, kegg_ids)
+        is_electron_balanced[ind] = numpy.isnan(e) | (numpy.abs(e) <= 1e-6)
+        return is_balanced, is_electron_balanced
+
     def StandardizeHalfReaction(self):
         """Checks if the reaction is a half-reaction (excess electrons).
 
@@ -720,86 +1003,58 @@ class Reaction(models.Model):
             assert delta_electrons != 0
             return numpy.abs(dg_u / (constants.F*delta_electrons))
 
-    def _ExtraPis(self):
-        # TODO probably could write a generic version of this.
-        atom_diff = self._GetAtomDiff()
-
-        if not atom_diff:
-            return None
-
-        # Pi = P O4
-        # Ignore hydrogen as usual.
-        atom_diff.pop('H', 0)
-
-        os = atom_diff.pop('O', 0)
-        ps = atom_diff.pop('P', 0)
-
-        n_pis = numpy.array([ps / 1.0, os / 4.0])
-
-        # Don't need any other elements
-        pi_completes = self._IsBalanced(atom_diff)
-        # Stoichiometry right for pi
-        pi_completes &= numpy.all(n_pis == n_pis.astype(numpy.int))
-        pi_completes &= numpy.all(n_pis ==
-                               numpy.ones(n_pis.size) * n_pis[0])
-
-        extra_pis = int(n_pis[0])
-        if not pi_completes or not extra_pis:
-            return None
-
-        # Number of missing Pis
-        return extra_pis
-
-    def _ExtraCoAs(self):
-        atom_diff = self._GetAtomDiff()
-
-        if not atom_diff:
-            return None
-
-        # CoA = C21 H36 N7 016 P3 S
-        # Ignore hydrogen as usual.
-        atom_diff.pop('H', 0)
-
-        cs = atom_diff.pop('C', 0)
-        os = atom_diff.pop('O', 0)
-        ns = atom_diff.pop('N', 0)
-        ps = atom_diff.pop('P', 0)
-        ss = atom_diff.pop('S', 0)
-
-        n_coas = numpy.array([cs / 21.0, os / 16.0, ns / 7.0, ps / 3.0, ss / 1.0])
-
-        # Don't need any other elements
-        coa_completes = self._IsBalanced(atom_diff)
-        # Stoichiometry right for CoA
-        coa_completes &= numpy.all(n_coas == n_coas.astype(numpy.int))
-        coa_completes &= numpy.all(n_coas ==
-                                numpy.ones(n_coas.size) * n_coas[0])
-
-        extra_coas = int(n_coas[0])
-        if not coa_completes or not extra_coas:
-            return None
-
-        # Number of missing CoAs
-        return extra_coas
+    def _GetCofactorMultiples(self):
+        """
+            Returns a dictionary mapping cofactor names (see
+            element_balance.DEFAULT_COFACTORS) to the number of units that
+            balance this reaction (0 if it is already balanced), or to None
+            if the cofactor cannot balance it.
 
-    def _ExtraWaters(self):
-        atom_diff = self._GetAtomDiff()
+            The atom and electron imbalance is computed once, and all the
+            cofactors are solved for together. The result is kept until the
+            reactants change.
 
-        if not atom_diff:
-            return None
+            Raises:
+                ReactantFormulaMissingError.
+        """
+        key = tuple((c.compound.kegg_id, c.coeff) for c in self.reactants)
+        if self._cofactor_multiples_key != key:
+            balancer = snapshot.Get().cofactor_balancer
+            b = balancer.ImbalanceVector(self._GetAtomDiff(),
+                                         self._GetElectronDiff())
+            self._cofactor_multiples = balancer.SolveDict(b)
+            self._cofactor_multiples_key = key
+        return self._cofactor_multiples
 
-        # Ignore hydrogen.
-        atom_diff.pop('H', 0)
+    def _ExtraCofactor(self, name):
+        """
+            Returns the number of units of a cofactor that balance this
+            reaction, or None if it cannot or if none are needed.
+        """
+        return self._GetCofactorMultiples().get(name) or None
 
-        # Omit oxygen for checking balancedness.
-        oxy_count = atom_diff.pop('O', 0)
+    def _AddCofactor(self, name, how_many):
+        cofactor = snapshot.Get().cofactor_balancer.GetCofactor(name)
+        for kegg_id, coeff in cofactor.sparse.items():
+            self._AddCompound(kegg_id, coeff * how_many)
+        self._Dedup()
 
-        # If it's not balanced without oxygen, can't balance with water.
-        if not self._IsBalanced(atom_diff):
-            return None
+    def GetBalancedVariants(self, names=None):
+        """
+            Returns a dictionary mapping cofactor names to a copy of this
+            reaction balanced by adding that cofactor, for all the cofactors
+            that can balance it.
 
-        # Requires this many waters to balance (1 O per).
-        return oxy_count
+            Args:
+                names: (optional) consider only these cofactors.
+        """
+        variants = {}
+        for name, multiple in self._GetCofactorMultiples().items():
+            if multiple and (names is None or name in names):
+                other = self.Clone()
+                other._AddCofactor(name, multiple)
+                variants[name] = other
+        return variants
 
     def _FindCompoundIndex(self, kegg_id):
         """
@@ -826,7 +1081,7 @@ class Reaction(models.Model):
             self.reactants += [CompoundWithCoeff.FromId(how_many, kegg_id)]
 
         # clear the cache since the reaction has changed
-        self._catalyzing_enzymes = None
+        self._ClearCache()
 
     def _ReplaceCompound(self, from_id, to_id):
         """
@@ -855,7 +1110,7 @@ class Reaction(models.Model):
             self._Dedup()
 
         # clear the cache since the reaction has changed
-        self._catalyzing_enzymes = None
+        self._ClearCache()
 
     def _Dedup(self):
         """
@@ -870,6 +1125,7 @@ class Reaction(models.Model):
                 c.coeff = 0
 
         self.reactants = list(filter(lambda x: x.coeff != 0, self.reactants))
+        self._ClearCache()
 
         # always make sure that H2O is the last reactant (so that it will
         # appear last in the chemical formula)
@@ -887,83 +1143,57 @@ class Reaction(models.Model):
         """
         self.reactants = list(filter(lambda c: c.compound.kegg_id not in
                                      ['C00080', 'C05359'], self.reactants))
+        self._ClearCache()
 
-    def TryBalanceWithWater(self):
-        """Try to balance the reaction with water.
-
-        Returns:
-            True if the reaction is balanced already or with
-            additional waters on either side.
-        """
-        extra_waters = self._ExtraWaters()
-        if extra_waters is None:
-            # cannot balance the reaction with H2O only
-            return False
-        if extra_waters != 0:
-            self._AddCompound('C00001', extra_waters)
-            self._Dedup()
-        return True
+    def TryBalanceWithCofactor(self, name):
+        """Try to balance the reaction with a cofactor.
 
-    def TryBalanceWithCoA(self):
-        """Try to balance the reaction with water.
+        Args:
+            name: the name of the cofactor (see
+                  element_balance.DEFAULT_COFACTORS).
 
         Returns:
             True if the reaction is balanced already or with
-            additional waters on either side.
+            additional cofactors on either side.
         """
-        extra_coas = self._ExtraCoAs()
-        if extra_coas is None:
-            # cannot balance the reaction with CoA only
+        multiple = self._GetCofactorMultiples().get(name)
+        if multiple is None:
+            # cannot balance the reaction with this cofactor only
             return False
-        if extra_coas != 0:
-            self._AddCompound('C00010', extra_coas)
-            self._Dedup()
+        if multiple != 0:
+            self._AddCofactor(name, multiple)
         return True
 
-    def TryBalanceWithPi(self):
-        """Try to balance the reaction with water.
+    def TryBalanceWithWater(self):
+        """Try to balance the reaction with water."""
+        return self.TryBalanceWithCofactor('water')
 
-        TODO write a generic version of this?
+    def TryBalanceWithCoA(self):
+        """Try to balance the reaction with CoA."""
+        return self.TryBalanceWithCofactor('coa')
 
-        Returns:
-            True if the reaction is balanced already or with
-            additional waters on either side.
-        """
-        extra_pis = self._ExtraPis()
-        if extra_pis is None:
-            # cannot balance the reaction with Pi only
-            return False
-        if extra_pis != 0:
-            self._AddCompound('C00009', extra_pis)
-            self._Dedup()
-        return True
+    def TryBalanceWithPi(self):
+        """Try to balance the reaction with Pi."""
+        return self.TryBalanceWithCofactor('pi')
 
-    def CanBalanceWithWater(self):
-        """Returns True if balanced with or without water."""
+    def CanBalanceWithCofactor(self, name):
+        """Returns True if adding the cofactor balances the reaction."""
         try:
-            extra_waters = self._ExtraWaters()
+            return self._ExtraCofactor(name) is not None
         except ReactantFormulaMissingError:
             return True
 
-        return extra_waters is not None
+    def CanBalanceWithWater(self):
+        """Returns True if balanced with water."""
+        return self.CanBalanceWithCofactor('water')
 
     def CanBalanceWithCoA(self):
-        """Returns True if balanced with or without CoA."""
-        try:
-            extra_coas = self._ExtraCoAs()
-        except ReactantFormulaMissingError:
-            return True
-
-        return extra_coas is not None
+        """Returns True if balanced with CoA."""
+        return self.CanBalanceWithCofactor('coa')
 
     def CanBalanceWithPi(self):
-        """Returns True if balanced with or without Pi."""
-        try:
-            extra_pis = self._ExtraPis()
-        except ReactantFormulaMissingError:
-            return True
-
-        return extra_pis is not None
+        """Returns True if balanced with Pi."""
+        return self.CanBalanceWithCofactor('pi')
 
     def BalanceElectrons(self,
                          acceptor_id='C00003',           # NAD+
@@ -1021,14 +1251,36 @@ class Reaction(models.Model):
 
         Returns:
             The DeltaG0' for this reaction, or None if data was missing.
+            If _dg0_prime was set explicitly (e.g. from a user-provided
+            equilibrium constant), it is returned regardless of conditions.
         """
         if self._dg0_prime is not None:
-            logging.debug("Using cached dG0'")
+            logging.debug("Using the given dG0'")
             return self._dg0_prime
 
-        logging.debug('Aqueous Params = ' + str(self.aq_params))
         aqp = aq_params or self.aq_params
-        c_dg0_prime_list = [c.DeltaG0Prime(aqp) for c in self.reactants]
+        logging.debug('Aqueous Params = ' + str(aqp))
+        key = self._DeltaG0PrimeKey(aqp)
+        if key is None:
+            return self._ComputeDeltaG0Prime(aqp)
+        return DG0_PRIME_CACHE.GetOrCompute(
+            key, lambda: self._ComputeDeltaG0Prime(aqp))
+
+    def _DeltaG0PrimeKey(self, aq_params):
+        """
+            Returns a hashable key for caching the dG0' of this reaction, or
+            None if one of the compounds cannot be cached.
+        """
+        keys = []
+        for c in self.reactants:
+            key = c.compound.DeltaG0PrimeKey(aq_params, c.GetPhaseName())
+            if key is None:
+                return None
+            keys.append((c.coeff,) + key)
+        return tuple(sorted(keys))
+
+    def _ComputeDeltaG0Prime(self, aq_params):
+        c_dg0_prime_list = [c.DeltaG0Prime(aq_params) for c in self.reactants]
 
         # find all the IDs of compounds that have no known formation energy
         # if there are any such compounds, print and error message and
@@ -1040,8 +1292,65 @@ class Reaction(models.Model):
             logging.warning("Failed to get formation energy for: " +
                             ', '.join(unknown_kegg_ids))
             return None
-        self._dg0_prime = sum(c_dg0_prime_list)
-        return self._dg0_prime
+        return sum(c_dg0_prime_list)
+
+    def DeltaG0PrimeGrid(self, pH, pMg, ionic_strength):
+        """Compute the DeltaG0' of this reaction for many conditions.
+
+        Args:
+            pH, pMg, ionic_strength: scalars or arrays that broadcast
+                together (see legendre.SpeciesArrays).
+
+        Returns:
+            An array of DeltaG0' values with the shape of the conditions,
+            or None if data was missing.
+        """
+        reactants = []
+        for c in self.reactants:
+            sg = c.compound._species_group
+            if sg is None:
+                return None
+            reactants.append((c.coeff, sg.GetSpeciesArrays(),
+                              c.GetPhaseName()))
+        return legendre.ReactionDeltaG0Prime(reactants, pH, pMg,
+                                             ionic_strength)
+
+    def DeltaGPrimeCurve(self, vary, values):
+        """Compute DeltaG0' and DeltaG' while varying one condition.
+
+        Args:
+            vary: the condition to vary: 'ph', 'pmg' or 'is'.
+            values: the values of this condition; the others are taken
+                from aq_params.
+
+        Returns:
+            A two tuple of arrays (DeltaG0', DeltaG') or None if data was
+            missing.
+        """
+        conds = {'ph': self.aq_params.pH,
+                 'pmg': self.aq_params.pMg,
+                 'is': self.aq_params.ionic_strength}
+        assert vary in conds
+        conds[vary] = numpy.asarray(values, dtype=float)
+        dg0_prime = self.DeltaG0PrimeGrid(conds['ph'], conds['pmg'],
+                                          conds['is'])
+        if dg0_prime is None:
+            return None
+        return dg0_prime, dg0_prime + self._GetConcentrationCorrection()
+
+    def CanonicalKey(self):
+        """
+            Returns a hashable key which is equal for reactions with the same
+            reactants (regardless of their order), phases, concentrations and
+            species group priorities in the current data version.
+        """
+        reactants = []
+        for c in self.reactants:
+            sg = c.compound._species_group
+            priority = sg.priority if sg is not None else None
+            reactants.append((c.compound.kegg_id, c.coeff, c.GetPhaseName(),
+                              c.phase.Value(), priority))
+        return tuple(sorted(reactants)) + (data_version.Get(),)
 
     def DeltaGmPrime(self):
         """Compute the DeltaGm' for a reaction (i.e. at 1 mM).
@@ -1129,12 +1438,12 @@ class Reaction(models.Model):
         if self._GetMaxCommonPriority() != 1:
             return None
         if self._uncertainty is None:
-            x, g = Preprocessing.GetReactionVectors(self.reactants)
-            s_cc = Preprocessing.DeltaGUncertainty(x, g)
+            v = Preprocessing.GetSparseReactionVector(self.reactants)
+            s_cc = Preprocessing.SparseDeltaGUncertainty(v)
             logging.debug('s_cc = %g' % s_cc)
             self._uncertainty = 1.96*s_cc
 
-            if Preprocessing.IsUsingGroupContributions(x, g):
+            if Preprocessing.SparseIsUsingGroupContributions(v):
                 logging.debug('reaction is using GC')
                 self.is_using_gc = True
             else:
@@ -1143,6 +1452,78 @@ class Reaction(models.Model):
 
         return self._uncertainty
 
+    @staticmethod
+    def _StoichiometricMatrix(reactions):
+        """
+            Returns a two tuple (S, kegg_ids) where S is a sparse matrix with
+            compounds on the rows (in the order of kegg_ids) and the
+            reactions on the columns.
+        """
+        sparses = [r.GetSparseRepresentation() for r in reactions]
+        kegg_ids = sorted(set().union(*sparses))
+        kegg_id_to_index = {k: i for i, k in enumerate(kegg_ids)}
+        rows, cols, coeffs = [], [], []
+        for j, sparse in enumerate(sparses):
+            for kegg_id, coeff in sparse.items():
+                rows.append(kegg_id_to_index[kegg_id])
+                cols.append(j)
+                coeffs.append(coeff)
+        S = csr_matrix((coeffs, (rows, cols)),
+                       shape=(len(kegg_ids), len(reactions)))
+        return S, kegg_ids
+
+    @staticmethod
+    def DeltaGUncertainties(reactions):
+        """
+            Same as calling DeltaGUncertainty() for every reaction in the
+            list, but computed in one batch.
+
+            Args:
+                reactions: a list of Reaction objects.
+
+            Returns:
+                A list of uncertainties (or None where DeltaGUncertainty()
+                would return None or fail).
+        """
+        S, kegg_ids = Reaction._StoichiometricMatrix(reactions)
+        std, is_using_gc = Preprocessing.DeltaGUncertaintyBatch(S, kegg_ids)
+
+        res = []
+        for rxn, s_cc, using_gc in zip(reactions, std, is_using_gc):
+            if rxn._GetMaxCommonPriority() != 1:
+                res.append(None)
+                continue
+            if rxn._uncertainty is None and not numpy.isnan(s_cc):
+                rxn._uncertainty = 1.96*s_cc
+                rxn.is_using_gc = bool(using_gc)
+            try:
+                res.append(rxn.DeltaGUncertainty())
+            except Exception as e:
+                logging.debug(str(e))
+                res.append(None)
+        return res
+
+    @staticmethod
+    def DeltaGCovarianceSqrt(reactions):
+        """
+            Returns the square root of the covariance matrix of the
+            standard Gibbs energies of a list of reactions, i.e. a square
+            matrix A such that A*A' is the covariance (in units of
+            (kJ/mol)^2). The diagonal of A*A' matches the squared
+            uncertainty returned by DeltaGUncertainty() (divided by 1.96).
+
+            Returns None if any of the reactions is not estimated by
+            Component Contribution (see DeltaGUncertainty).
+        """
+        if any(r._GetMaxCommonPriority() != 1 for r in reactions):
+            return None
+        S, kegg_ids = Reaction._StoichiometricMatrix(reactions)
+        try:
+            return Preprocessing.DeltaGCovarianceSqrt(S, kegg_ids)
+        except ValueError as e:
+            logging.debug(str(e))
+            return None
+
     def ExtraAtoms(self):
         try:
             diff = self._GetAtomDiff()
@@ -1210,8 +1591,8 @@ class Reaction(models.Model):
         return zip(source_names, urls)
 
     def GetComponentContributionAnalysis(self):
-        x, g = Preprocessing.GetReactionVectors(self.reactants)
-        return Preprocessing.Analyze(x, g)
+        v = Preprocessing.GetSparseReactionVector(self.reactants)
+        return Preprocessing.SparseAnalyze(v)
 
     substrates = property(GetSubstrates)
     products = property(GetProducts)
@@ -1281,10 +1662,13 @@ class StoredReaction(models.Model):
         return sparse
 
     @staticmethod
-    def _CompoundToString(kegg_id, coeff):
+    def _CompoundToString(kegg_id, coeff, snap=None):
         try:
-            compound = apps.get_model('gibbs.Compound').objects.get(
-                kegg_id=kegg_id)
+            if snap is None:
+                compound = apps.get_model('gibbs.Compound').objects.get(
+                    kegg_id=kegg_id)
+            else:
+                compound = snap.GetCompound(kegg_id)
             name = compound.FirstName()
         except Exception as e:
             logging.warning('Cannot find the name for %s' % kegg_id)
@@ -1296,19 +1680,23 @@ class StoredReaction(models.Model):
         else:
             return "%g %s" % (coeff, name)
 
-    def ToString(self):
+    def ToString(self, snap=None):
         """
             String representation.
+
+            Args:
+                snap: (optional) a CompoundSnapshot to take the compound names
+                      from, instead of querying each one.
         """
-        # TODO: need to replace the KEGG IDs with the common names of the
-        #       compounds
         left = []
         right = []
         for coeff, kegg_id in json.loads(self.reactants):
             if coeff < 0:
-                left.append(StoredReaction._CompoundToString(kegg_id, -coeff))
+                left.append(StoredReaction._CompoundToString(kegg_id, -coeff,
+                                                             snap))
             elif coeff > 0:
-                right.append(StoredReaction._CompoundToString(kegg_id, coeff))
+                right.append(StoredReaction._CompoundToString(kegg_id, coeff,
+                                                              snap))
         return "%s = %s" % (' + '.join(left), ' + '.join(right))
 
     @staticmethod
@@ -1358,32 +1746,63 @@ class StoredReaction(models.Model):
     def GetHash(self):
         return StoredReaction.HashReaction(self.GetSparseRepresentation())
 
-    def GenerateHash(self):
+    def GenerateHash(self, snap=None):
         self.reaction_hash = self.GetHash()
-        self.reaction_string = self.ToString()
-        self.link = self.Link()
+        self.reaction_string = self.ToString(snap)
+        self.link = self.Link(snap)
+
+    @staticmethod
+    def GenerateHashes(stored_reactions):
+        """
+            Calls GenerateHash() for many reactions, loading all the
+            compounds they use at once.
+
+            Returns:
+                The reactions for which it succeeded.
+        """
+        stored_reactions = list(stored_reactions)
+        kegg_ids = set()
+        for r in stored_reactions:
+            kegg_ids.update(kegg_id for _, kegg_id in json.loads(r.reactants))
+        snap = snapshot.CompoundSnapshot(kegg_ids=kegg_ids)
+
+        res = []
+        for r in stored_reactions:
+            try:
+                r.GenerateHash(snap)
+                res.append(r)
+            except Exception as e:
+                logging.warning('Missing data for reaction %s', r.kegg_id)
+                logging.warning(e)
+        return res
 
     def __str__(self):
         """String representation."""
         return self.ToString()
 
-    def Link(self):
+    def Link(self, snap=None):
         """
             Returns a link to this reaction's page.
         """
         try:
-            rxn = self.ToReaction()
-            return rxn.GetHyperlink(self.ToString())
+            rxn = self.ToReaction(snap=snap)
+            return rxn.GetHyperlink(self.ToString(snap))
         except AttributeError:
             raise Exception('Cannot find one of the compounds in the database')
 
-    def ToReaction(self, priority=1, aq_params=None):
+    def ToReaction(self, priority=1, aq_params=None, snap=None):
         """
-            returns a list of CSV rows with the following columns:
-            kegg ID, dG0_prime, pH, ionic_strength, T, Note
+            Returns this reaction as a Reaction object, with compounds taken
+            from snap (the process-wide snapshot by default).
         """
-        reactants = [CompoundWithCoeff.FromId(coeff, kegg_id)
-                     for coeff, kegg_id in json.loads(self.reactants)]
+        if snap is None:
+            reactants = [CompoundWithCoeff.FromId(coeff, kegg_id)
+                         for coeff, kegg_id in json.loads(self.reactants)]
+        else:
+            reactants = [CompoundWithCoeff.FromDict(
+                             {'kegg_id': kegg_id, 'coeff': coeff,
+                              'compound': snap.GetCompound(kegg_id)})
+                         for coeff, kegg_id in json.loads(self.reactants)]
         rxn = Reaction(reactants)
         return rxn
 
@@ -1422,14 +1841,11 @@ class Enzyme(models.Model):
             % self.ec
 
     def AllReactions(self):
-        """Returns all the reactions (unique by the 'hash')."""
-        rxns = []
-        hashes = set()
-        for r in self.reactions.all():
-            if r.GetHash() not in hashes:
-                rxns.append(r)
-                hashes.add(r.GetHash())
-        return rxns
+        """
+            Returns all the reactions (unique by the 'hash'), as a tuple of
+            reaction_index.EnzymeReaction.
+        """
+        return reaction_index.Get().GetEnzymeReactions(self.ec)
 
     def FirstName(self):
         """The first name in the list of names."""
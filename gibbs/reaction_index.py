@@ -0,0 +1,125 @@
+import logging
+import threading
+import time
+from collections import namedtuple
+from django.apps import apps
+from util import data_version
+
+
+# The stored reactions with the same hash: their KEGG reaction IDs (ordered
+# by their database ID), and the EC numbers of the enzymes catalyzing them.
+HashEntry = namedtuple('HashEntry', ['kegg_ids', 'ec_numbers'])
+
+_EMPTY_ENTRY = HashEntry((), ())
+
+# A stored reaction as shown on the enzyme pages.
+EnzymeReaction = namedtuple('EnzymeReaction', ['kegg_id', 'reaction_hash',
+                                               'reaction_string', 'link'])
+
+
+class ReactionHashIndex(object):
+    """
+        An in-process map from reaction hashes (see StoredReaction.GetHash)
+        to the stored reactions and enzymes that match them.
+
+        Like the compound snapshot, it is loaded once per process and
+        reloaded only when the data version stamp changes. The Enzyme
+        objects (with their common names) are shared between requests and
+        must not be modified.
+
+        It also holds the reactions of every enzyme, deduplicated by hash,
+        with their strings and links, so that enzyme pages are rendered
+        without querying the reactions.
+    """
+
+    def __init__(self, version=None):
+        self.version = version
+        Enzyme = apps.get_model('gibbs.Enzyme')
+        StoredReaction = apps.get_model('gibbs.StoredReaction')
+
+        # EC numbers are not unique, so the reactions of all the enzyme
+        # rows with the same EC are merged, and the first row is shown
+        self._enzymes = {}
+        enzyme_id_to_ec = {}
+        for enzyme in Enzyme.objects.prefetch_related('common_names'):
+            self._enzymes.setdefault(enzyme.ec, enzyme)
+            enzyme_id_to_ec[enzyme.id] = enzyme.ec
+
+        stored_reaction_to_ecs = {}
+        for enzyme_id, stored_reaction_id in \
+                Enzyme.reactions.through.objects.values_list(
+                    'enzyme_id', 'storedreaction_id'):
+            ec = enzyme_id_to_ec.get(enzyme_id)
+            if ec is not None:
+                stored_reaction_to_ecs.setdefault(
+                    stored_reaction_id, []).append(ec)
+
+        kegg_ids = {}
+        ec_numbers = {}
+        enzyme_reactions = {}
+        for stored_reaction_id, kegg_id, reaction_hash, reaction_string, \
+                link in StoredReaction.objects.order_by('id').values_list(
+                    'id', 'kegg_id', 'reaction_hash', 'reaction_string',
+                    'link'):
+            kegg_ids.setdefault(reaction_hash, []).append(kegg_id)
+            ecs = ec_numbers.setdefault(reaction_hash, [])
+            reaction = EnzymeReaction(kegg_id, reaction_hash,
+                                      reaction_string, link)
+            for ec in stored_reaction_to_ecs.get(stored_reaction_id, []):
+                if ec not in ecs:
+                    ecs.append(ec)
+                # keep the first reaction with each hash
+                enzyme_reactions.setdefault(ec, {}).setdefault(
+                    reaction_hash, reaction)
+
+        self._entries = {h: HashEntry(tuple(kegg_ids[h]),
+                                      tuple(ec_numbers[h]))
+                         for h in kegg_ids}
+        # dictionaries keep the insertion (i.e. database ID) order
+        self._enzyme_reactions = {ec: tuple(reactions.values())
+                                  for ec, reactions in
+                                  enzyme_reactions.items()}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def Get(self, reaction_hash):
+        """Returns the HashEntry of a hash (which is empty if unknown)."""
+        return self._entries.get(reaction_hash, _EMPTY_ENTRY)
+
+    def GetEnzymes(self, reaction_hash):
+        """Returns the (shared) Enzyme objects catalyzing the reaction."""
+        return [self._enzymes[ec] for ec in self.Get(reaction_hash).ec_numbers]
+
+    def GetEnzyme(self, ec):
+        """Returns the (shared) Enzyme object with this EC, or None."""
+        return self._enzymes.get(ec)
+
+    def GetEnzymeReactions(self, ec):
+        """
+            Returns the reactions of an enzyme (a tuple of EnzymeReaction),
+            unique by their hash.
+        """
+        return self._enzyme_reactions.get(ec, ())
+
+
+_index = None
+_lock = threading.Lock()
+
+
+def Get():
+    """
+        Returns the index of the current data version, loading it on first
+        use and whenever init_db was run since it was loaded.
+    """
+    global _index
+    version = data_version.Get()
+    if _index is None or _index.version != version:
+        with _lock:
+            if _index is None or _index.version != version:
+                t0 = time.time()
+                _index = ReactionHashIndex(version)
+                logging.info('Loaded an index of %d reaction hashes (data '
+                             'version %s) in %.1f sec' %
+                             (len(_index), version, time.time() - t0))
+    return _index
@@ -0,0 +1,126 @@
+import copy
+import logging
+import threading
+import time
+import numpy
+from django.apps import apps
+from util import data_version
+from . import element_balance
+
+
+class CompoundSnapshot(object):
+    """
+        A read-only, in-process copy of all the compounds in the database,
+        together with their species groups, species and common names.
+
+        Compound data changes only when init_db runs, so instead of
+        prefetching the same rows for every request, each process loads
+        them once and reloads only when the data version stamp changes
+        (see util.data_version).
+
+        The Compound objects held by the snapshot are shared between
+        requests and must not be modified; GetCompound() returns a shallow
+        copy which has its own species group priority.
+    """
+
+    def __init__(self, version=None, kegg_ids=None):
+        """
+            Args:
+                version: the data version of the snapshot.
+                kegg_ids: (optional) load only these compounds.
+        """
+        self.version = version
+        # the (large) thumbnails are served from thumbnail_store instead
+        compounds = apps.get_model('gibbs.Compound').objects.defer(
+            'thumbnail').prefetch_related(
+            'species_groups', 'species_groups__species',
+            'species_groups__formation_energy_source', 'common_names')
+        if kegg_ids is not None:
+            compounds = compounds.filter(kegg_id__in=list(kegg_ids))
+        self._compounds = list(compounds)
+
+        for c in self._compounds:
+            species_groups = list(c.species_groups.all())
+            for sg in species_groups:
+                sg._all_species = list(sg.species.all())
+                sg.GetSpeciesArrays()
+            c._all_species_groups = species_groups
+            c.GetSpeciesGroupIndex()
+
+        self.kegg_ids = [c.kegg_id for c in self._compounds]
+        self.kegg_id_to_row = {k: i for i, k in enumerate(self.kegg_ids)}
+        self.formulas = [c.formula for c in self._compounds]
+        self.num_electrons = numpy.array(
+            [numpy.nan if c.num_electrons is None else c.num_electrons
+             for c in self._compounds], dtype=float)
+        self.cc_index = numpy.array(
+            [-1 if c.index is None else c.index for c in self._compounds],
+            dtype=int)
+        self.group_vectors = [c.group_vector for c in self._compounds]
+        self.element_matrix = element_balance.ElementMatrix(
+            (c.kegg_id, self._GetAtomBag(c), c.num_electrons)
+            for c in self._compounds)
+        self.cofactor_balancer = element_balance.CofactorBalancer(
+            self.element_matrix)
+
+    @staticmethod
+    def _GetAtomBag(compound):
+        try:
+            return compound.GetAtomBag()
+        except Exception as e:
+            logging.warning('Cannot parse the formula of %s (%s): %s' %
+                            (compound.kegg_id, compound.formula, str(e)))
+            return None
+
+    def __len__(self):
+        return len(self._compounds)
+
+    def HasCompound(self, kegg_id):
+        return kegg_id in self.kegg_id_to_row
+
+    def GetCompound(self, kegg_id):
+        """
+            Returns a private (shallow) copy of a compound, or None if
+            there is no compound with this KEGG ID.
+        """
+        row = self.kegg_id_to_row.get(kegg_id)
+        if row is None:
+            return None
+        compound = copy.copy(self._compounds[row])
+        compound._species_group_to_use = None
+        compound._priority = None
+        return compound
+
+    def GetCompounds(self, kegg_ids):
+        """
+            Returns a dictionary mapping KEGG IDs to (copies of) Compounds.
+            KEGG IDs that are not in the snapshot are skipped.
+        """
+        kegg_id_to_compound = {}
+        for kegg_id in set(kegg_ids):
+            compound = self.GetCompound(kegg_id)
+            if compound is not None:
+                kegg_id_to_compound[kegg_id] = compound
+        return kegg_id_to_compound
+
+
+_snapshot = None
+_lock = threading.Lock()
+
+
+def Get():
+    """
+        Returns the snapshot of the current data version, loading it on
+        first use and whenever init_db was run since it was loaded.
+    """
+    global _snapshot
+    version = data_version.Get()
+    if _snapshot is None or _snapshot.version != version:
+        with _lock:
+            if _snapshot is None or _snapshot.version != version:
+                t0 = time.time()
+                _snapshot = CompoundSnapshot(version)
+                logging.info('Loaded a snapshot of %d compounds (data '
+                             'version %s) in %.1f sec' %
+                             (len(_snapshot), version, time.time() - t0))
+    return _snapshot
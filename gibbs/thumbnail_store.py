@@ -0,0 +1,149 @@
+import base64
+import binascii
+import hashlib
+import json
+import logging
+import os
+import threading
+from django.apps import apps
+from util import data_version
+
+RELPATH = os.path.dirname(os.path.realpath(__file__))
+
+# The compound thumbnails, exported from the database by init_db. Each PNG
+# is named after the SHA1 of its content, so identical structures share a
+# file and a file never changes once written. INDEX_FNAME maps KEGG IDs to
+# these digests.
+THUMBNAIL_DIRNAME = os.path.join(RELPATH, '../data/thumbnails')
+INDEX_FNAME = 'index.json'
+
+# Maps InChI hashes to the digests of their drawings (or None if they cannot
+# be drawn), see database_io.GenerateCompoundThumbnails.
+RENDERED_FNAME = 'rendered.json'
+
+
+def FileName(dirname, digest):
+    return os.path.join(dirname, digest + '.png')
+
+
+def WriteFile(dirname, image_data):
+    """
+        Writes PNG data to its content-addressed file (unless it exists
+        already) and returns its digest.
+    """
+    digest = hashlib.sha1(image_data).hexdigest()
+    fname = FileName(dirname, digest)
+    if not os.path.exists(fname):
+        with open(fname + '.tmp', 'wb') as fp:
+            fp.write(image_data)
+        os.rename(fname + '.tmp', fname)
+    return digest
+
+
+def DecodeThumbnail(thumbnail):
+    """Returns the PNG data of a Compound.thumbnail, or None if it is empty."""
+    if not thumbnail or thumbnail == 'error':
+        return None
+    try:
+        return base64.b64decode(thumbnail)
+    except (binascii.Error, ValueError):
+        return None
+
+
+def Export(dirname=THUMBNAIL_DIRNAME):
+    """Write the thumbnail of every compound to a content-addressed file.
+
+    Files that already exist are not written again. The index is written to
+    a temporary file and then renamed, so that a running server never sees a
+    partial one, and files which are no longer in the index (or in the
+    drawings of GenerateCompoundThumbnails) are deleted.
+
+    Returns:
+        The number of compounds with a thumbnail.
+    """
+    os.makedirs(dirname, exist_ok=True)
+    index = {}
+    compounds = apps.get_model('gibbs.Compound').objects.values_list(
+        'kegg_id', 'thumbnail')
+    for kegg_id, thumbnail in compounds.iterator():
+        image_data = DecodeThumbnail(thumbnail)
+        if image_data is None:
+            continue
+        index[kegg_id] = WriteFile(dirname, image_data)
+
+    index_fname = os.path.join(dirname, INDEX_FNAME)
+    with open(index_fname + '.tmp', 'w') as fp:
+        json.dump(index, fp, sort_keys=True)
+    os.rename(index_fname + '.tmp', index_fname)
+
+    digests = set(index.values())
+    rendered_fname = os.path.join(dirname, RENDERED_FNAME)
+    if os.path.exists(rendered_fname):
+        with open(rendered_fname) as fp:
+            digests.update(d for d in json.load(fp).values() if d)
+    used = set(os.path.basename(FileName(dirname, d)) for d in digests)
+    for fname in os.listdir(dirname):
+        if fname.endswith('.png') and fname not in used:
+            os.remove(os.path.join(dirname, fname))
+    return len(index)
+
+
+class ThumbnailIndex(object):
+    """
+        Maps KEGG IDs to the exported thumbnail files.
+
+        Like the reaction index, it is loaded once per process and reloaded
+        when the data version stamp changes. If the thumbnails were never
+        exported, it is empty.
+    """
+
+    def __init__(self, version=None, dirname=THUMBNAIL_DIRNAME):
+        self.version = version
+        self.dirname = dirname
+        self._digests = {}
+        index_fname = os.path.join(dirname, INDEX_FNAME)
+        if os.path.exists(index_fname):
+            with open(index_fname) as fp:
+                self._digests = json.load(fp)
+
+    def __len__(self):
+        return len(self._digests)
+
+    def GetDigest(self, kegg_id):
+        """Returns the SHA1 of the compound's thumbnail, or None."""
+        return self._digests.get(kegg_id)
+
+    def GetFileName(self, kegg_id):
+        """Returns the file of the compound's thumbnail, or None."""
+        digest = self._digests.get(kegg_id)
+        if digest is None:
+            return None
+        return FileName(self.dirname, digest)
+
+    def Read(self, kegg_id):
+        """Returns the PNG data of the compound's thumbnail, or None."""
+        fname = self.GetFileName(kegg_id)
+        if fname is None:
+            return None
+        try:
+            with open(fname, 'rb') as fp:
+                return fp.read()
+        except (IOError, OSError):
+            return None
+
+
+_index = None
+_lock = threading.Lock()
+
+
+def Get():
+    """Returns the thumbnail index of the current data version."""
+    global _index
+    version = data_version.Get()
+    if _index is None or _index.version != version:
+        with _lock:
+            if _index is None or _index.version != version:
+                _index = ThumbnailIndex(version)
+                logging.info('Loaded an index of %d thumbnails (data '
+                             'version %s)' % (len(_index), version))
+    return _index
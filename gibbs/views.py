@@ -1,18 +1,26 @@
 import base64
+import hashlib
 import logging
 import os
 import json
-from django.http import HttpResponse, HttpResponseBadRequest
+import numpy
+from django.http import HttpResponse, HttpResponseBadRequest, FileResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.shortcuts import render
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
 from django.http import Http404
 from django.apps import apps
-from equilibrator.settings import STATIC_ROOT
+from equilibrator.settings import STATIC_ROOT, RESPONSE_CACHE_SIZE, \
+    RESPONSE_CACHE_DIR
 from gibbs.forms import CompoundForm, EnzymeForm, SearchForm, \
                         SuggestForm
-from gibbs.forms import ReactionForm, ReactionGraphForm
-from gibbs import conditions, service_config
-from util import django_utils, constants
+from gibbs.forms import ReactionForm, ReactionGraphForm, ReactionCurveForm
+from gibbs import conditions, reaction_index, service_config, \
+    thumbnail_store
+from matching import name_index
+from util import django_utils, constants, data_version, lru_cache, \
+    response_cache
 
 NO_STRUCTURE_THUMBNAIL = os.path.join(STATIC_ROOT, 'images',
                                       'structure_not_available.png')
@@ -39,7 +47,10 @@ def EnzymePage(request):
         logging.error(form.errors)
         raise Http404
 
-    enz = apps.get_model('gibbs.Enzyme').objects.get(ec=form.cleaned_ec)
+    # the enzymes in the index have their names and reactions preloaded
+    enz = reaction_index.Get().GetEnzyme(form.cleaned_ec)
+    if enz is None:
+        raise Http404
     template_data = {'is_superuser': django_utils.IsSuperUser(request),
                      'enzyme': enz}
     return render(request, 'enzyme_page.html', template_data)
@@ -102,27 +113,178 @@ def SuggestJson(request):
     query = str(form.cleaned_query)
     suggestions = []
     if query:
-        matcher = service_config.Get().search_matcher
-        matches = matcher.Match(query)
-        suggestions = [m.ToDictForJSON() for m in matches]
+        # names starting with the query come from the precomputed prefix
+        # index, and only other queries go through the matcher
+        completions = name_index.Get().GetCompletions(query)
+        if completions:
+            suggestions = [{'value': name, 'data': {'cat': category}}
+                           for name, category in completions]
+        else:
+            matcher = service_config.Get().search_matcher
+            matches = matcher.Match(query)
+            suggestions = [m.ToDictForJSON() for m in matches]
     output = {'query': query,
               'suggestions': suggestions}
     json_data = json.dumps(output)
     return HttpResponse(json_data, content_type='application/json')
 
+# How long browsers may use a thumbnail before revalidating it (in seconds)
+_THUMBNAIL_MAX_AGE = 3600
+
+
+def _ThumbnailResponse(request, etag, last_modified, image_data=None,
+                       fname=None):
+    """
+        Returns a 304 if the client has this thumbnail already, and
+        otherwise the image (from image_data or the file fname).
+    """
+    etag = quote_etag(etag)
+    response = get_conditional_response(request, etag=etag,
+                                        last_modified=last_modified)
+    if response is None:
+        if fname is not None:
+            response = FileResponse(open(fname, 'rb'),
+                                    content_type='image/png')
+        else:
+            response = HttpResponse(image_data, content_type='image/png')
+    response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+    response['Cache-Control'] = 'public, max-age=%d' % _THUMBNAIL_MAX_AGE
+    return response
+
+
 @csrf_exempt
 def CompoundImage(request):
     data = request.GET
     compound_id = data.get('compoundId', None)
     if compound_id is None:
         return HttpResponseBadRequest('No request data.')
+
+    # thumbnails exported by init_db are served without the database
+    thumbnails = thumbnail_store.Get()
+    fname = thumbnails.GetFileName(compound_id)
+    if fname is not None:
+        try:
+            last_modified = int(os.stat(fname).st_mtime)
+        except OSError:
+            logging.warning('missing thumbnail file: %s' % fname)
+        else:
+            return _ThumbnailResponse(request,
+                                      thumbnails.GetDigest(compound_id),
+                                      last_modified, fname=fname)
+
     compounds = apps.get_model('gibbs.Compound').objects.filter(
         kegg_id=compound_id)
     if not compounds:
         return HttpResponseBadRequest('No such compound.')
     compound = compounds[0]
     image_data = base64.b64decode(compound.thumbnail)
-    return HttpResponse(image_data, content_type='image/png')
+    return _ThumbnailResponse(request, hashlib.sha1(image_data).hexdigest(),
+                              None, image_data=image_data)
+
+
+# The most thumbnails returned by one CompoundImagesJson request
+_MAX_IMAGES_PER_REQUEST = 100
+
+# The thumbnail data URIs of CompoundImagesJson, by KEGG ID and data
+# version ('' for compounds without a thumbnail)
+_IMAGES_CACHE = lru_cache.LRUCache(max_size=2000)
+
+
+def _GetThumbnails(kegg_ids):
+    """
+        Returns a dictionary mapping KEGG IDs to their PNG thumbnails (or
+        None), reading the exported files and querying the database (once)
+        only for compounds that were not exported.
+    """
+    thumbnails = thumbnail_store.Get()
+    images = {k: thumbnails.Read(k) for k in kegg_ids}
+    missing = [k for k, image_data in images.items() if image_data is None]
+    if missing:
+        for kegg_id, thumbnail in \
+                apps.get_model('gibbs.Compound').objects.filter(
+                    kegg_id__in=missing).values_list('kegg_id', 'thumbnail'):
+            images[kegg_id] = thumbnail_store.DecodeThumbnail(thumbnail)
+    return images
+
+
+def CompoundImagesJson(request):
+    """
+        Returns the thumbnails of many compounds as data URIs, so that a
+        search result page loads all of its images with one request.
+
+        The KEGG IDs are given as a comma-separated compoundIds parameter.
+        Compounds without a thumbnail are mapped to null.
+    """
+    compound_ids = request.GET.get('compoundIds', '')
+    kegg_ids = tuple(sorted(set(k for k in compound_ids.split(',') if k)))
+    if not kegg_ids:
+        return HttpResponseBadRequest('No request data.')
+    if len(kegg_ids) > _MAX_IMAGES_PER_REQUEST:
+        return HttpResponseBadRequest('Too many compounds.')
+
+    version = data_version.Get()
+    images = {k: _IMAGES_CACHE.Get((k, version)) for k in kegg_ids}
+    missing = [k for k, uri in images.items() if uri is None]
+    if missing:
+        for kegg_id, image_data in _GetThumbnails(missing).items():
+            uri = ''
+            if image_data is not None:
+                uri = 'data:image/png;base64,' + \
+                    base64.b64encode(image_data).decode('ascii')
+            _IMAGES_CACHE.Set((kegg_id, version), uri)
+            images[kegg_id] = uri
+    json_data = json.dumps({'images': {k: uri or None
+                                       for k, uri in images.items()}},
+                           sort_keys=True)
+
+    etag = quote_etag(hashlib.sha1(json_data.encode('utf-8')).hexdigest())
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = HttpResponse(json_data, content_type='application/json')
+    response['ETag'] = etag
+    response['Cache-Control'] = 'public, max-age=%d' % _THUMBNAIL_MAX_AGE
+    return response
+
+
+# Rendered reaction and compound pages, by canonical request
+_PAGE_CACHE = response_cache.ResponseCache(
+    max_size=RESPONSE_CACHE_SIZE, cache_dir=RESPONSE_CACHE_DIR)
+
+
+def _CanonicalPageKey(page, form, aq_params):
+    """
+        Returns a key of everything a reaction or compound page depends on.
+
+        Coefficients and concentrations are compared as numbers (so '1' and
+        '1.0' are the same), and an empty phase is the same as a missing one.
+        The conditions come from the form or the cookies (see
+        AqueousParams.FromForm), so different cookies give different keys.
+        The order of the reactants is kept, since the page shows them in the
+        order they were given.
+    """
+    n_react = len(form.cleaned_reactantsCoeff)
+    phases = list(form.cleaned_reactantsPhase) or [None] * n_react
+    concentrations = list(form.cleaned_reactantsConcentration) or \
+        [None] * n_react
+    reactants = tuple(
+        (kegg_id, float(coeff), name or None, phase or None,
+         None if conc is None else float(conc))
+        for kegg_id, coeff, name, phase, conc in
+        zip(form.cleaned_reactantsId, form.cleaned_reactantsCoeff,
+            form.cleaned_reactantsName, phases, concentrations))
+    conds = (float(aq_params.pH), float(aq_params.pMg),
+             float(aq_params.ionic_strength),
+             float(aq_params.e_reduction_potential),
+             int(aq_params.max_priority), aq_params.mode)
+    return (page, reactants, conds, form.cleaned_submit)
+
+
+def _CachedPageResponse(content, aq_params):
+    response = HttpResponse(content)
+    aq_params.SetCookies(response)
+    return response
 
 
 def CompoundPage(request):
@@ -132,6 +294,14 @@ def CompoundPage(request):
         logging.error(form.errors)
         raise Http404
     aq_params = conditions.AqueousParams.FromForm(form, request.COOKIES)
+
+    key = _CanonicalPageKey('compound', form, aq_params)
+    content = _PAGE_CACHE.Get(key)
+    if content is not None:
+        if form.cleaned_submit == 'Reset':
+            return _CachedPageResponse(content, conditions.AqueousParams())
+        return _CachedPageResponse(content, aq_params)
+
     rxn = apps.get_model('gibbs.Reaction').FromForm(form, aq_params)
     if len(rxn.reactants) != 1:
         logging.error('There must be only 1 reactant in a "compound" page')
@@ -156,6 +326,7 @@ def CompoundPage(request):
                           'alberty_link': compound.GetNewPriorityLink(99),
                           'cc_link': compound.GetNewPriorityLink(1)})
     response = render(request, 'compound_page.html', template_data)
+    _PAGE_CACHE.Set(key, response.content)
     rxn.aq_params.SetCookies(response)
     return response
 
@@ -174,8 +345,20 @@ def ReactionPage(request):
         logging.error(form.errors)
         return HttpResponseBadRequest('Invalid reaction form.')
     aq_params = conditions.AqueousParams.FromForm(form, request.COOKIES)
-    rxn = apps.get_model('gibbs.Reaction').FromForm(form, aq_params)
 
+    if form.cleaned_submit not in _REACTION_TEMPLATES_BY_SUBMIT:
+        logging.error('Unknown submit term for reaction page: ' +
+                      form.cleaned_submit)
+        raise Http404
+
+    key = _CanonicalPageKey('reaction', form, aq_params)
+    content = _PAGE_CACHE.Get(key)
+    if content is not None:
+        if form.cleaned_submit == 'Reset':
+            return _CachedPageResponse(content, conditions.AqueousParams())
+        return _CachedPageResponse(content, aq_params)
+
+    rxn = apps.get_model('gibbs.Reaction').FromForm(form, aq_params)
     if form.cleaned_submit == 'Reverse':
         rxn.SwapSides()
     elif form.cleaned_submit == 'Reset':
@@ -183,12 +366,9 @@ def ReactionPage(request):
         rxn.ResetConcentrations()
     query = rxn.GetQueryString()
     # Render the template.
-    if form.cleaned_submit not in _REACTION_TEMPLATES_BY_SUBMIT:
-        logging.error('Unknown submit term for reaction page: ' +
-                      form.cleaned_submit)
-        raise Http404
     template_name = _REACTION_TEMPLATES_BY_SUBMIT[form.cleaned_submit]
     response = render(request, template_name, rxn.GetTemplateData(query))
+    _PAGE_CACHE.Set(key, response.content)
     rxn.aq_params.SetCookies(response)
     return response
 
@@ -218,3 +398,55 @@ def ReactionGraph(request):
                      'query': rxn.GetQueryString()}
     template_data.update(rxn.aq_params.GetTemplateData())
     return render(request, 'reaction_graph.html', template_data)
+
+
+# The default (min, max, steps) of the grid for each varied condition,
+# matching the ranges of the graph page.
+_CURVE_DEFAULT_GRIDS = {'ph': (4.0, 10.0, 61),
+                        'pmg': (0.0, 14.0, 57),
+                        'is': (0.0, 0.35, 351)}
+
+# JSON responses of ReactionCurveJson, by canonical reaction and grid
+_CURVE_CACHE = lru_cache.LRUCache(max_size=2000)
+
+
+def ReactionCurveJson(request):
+    """Returns dG'0 and dG' of a reaction over a grid of conditions."""
+    form = ReactionCurveForm(request.GET)
+    if not form.is_valid():
+        logging.error(form.errors)
+        return HttpResponseBadRequest('Invalid reaction form.')
+
+    vary = form.cleaned_vary
+    grid_min, grid_max, grid_steps = _CURVE_DEFAULT_GRIDS[vary]
+    if form.cleaned_grid_min is not None:
+        grid_min = form.cleaned_grid_min
+    if form.cleaned_grid_max is not None:
+        grid_max = form.cleaned_grid_max
+    if form.cleaned_grid_steps is not None:
+        grid_steps = form.cleaned_grid_steps
+    if vary == 'is' and min(grid_min, grid_max) < 0:
+        return HttpResponseBadRequest('Ionic strength must be non-negative.')
+
+    aq_params = conditions.AqueousParams.FromForm(form, request.COOKIES)
+    rxn = apps.get_model('gibbs.Reaction').FromForm(form, aq_params)
+
+    key = (rxn.CanonicalKey(), aq_params.Key(), vary,
+           grid_min, grid_max, grid_steps)
+    json_data = _CURVE_CACHE.Get(key)
+    if json_data is None:
+        values = numpy.linspace(grid_min, grid_max, grid_steps)
+        curves = rxn.DeltaGPrimeCurve(vary, values)
+        if curves is None:
+            return HttpResponseBadRequest('Missing formation energy data.')
+        output = {'query': rxn.GetQueryString(),
+                  'vary': vary,
+                  'ph': aq_params.pH,
+                  'pmg': aq_params.pMg,
+                  'ionic_strength': aq_params.ionic_strength,
+                  'values': values.round(6).tolist(),
+                  'dg0_prime': curves[0].round(4).tolist(),
+                  'dg_prime': curves[1].round(4).tolist()}
+        json_data = json.dumps(output)
+        _CURVE_CACHE.Set(key, json_data)
+    return HttpResponse(json_data, content_type='application/json')
@@ -18,7 +18,7 @@ def MakeParser():
     parser.add_argument('--export_csv', type=bool,
                         help='export final database to CSV file',
                         default=False)
-    parser.add_argument('--draw_thunb', type=bool,
+    parser.add_argument('--draw_thumb', type=bool,
                         help='draw chemical structure thumbnails',
                         default=False)
     return parser
@@ -48,6 +48,9 @@ def main():
     else:
         load_from_sqldump(db_user, db_name)
 
+    write_cc_preprocess()
+    write_thumbnails()
+
     if HAYSTACK_BACKEND == 'solr':
         logging.info('> Clearing Solr index\n')
         execute_from_command_line(['', 'clear_index', '--noinput'])
@@ -55,11 +58,31 @@ def main():
         logging.info('> Building Solr index\n')
         execute_from_command_line(['', 'update_index'])
 
+    logging.info('> Updating the data version stamp')
+    from util import data_version
+    data_version.Write()
+
 def load_from_sqldump(db_user, db_name):
     logging.info('> Loading data from sqldump into MySQL')
     cmd = "gunzip -c data/sqldump.txt.gz | mysql -u %s %s" % (db_user, db_name)
     os.system(cmd)
 
+def write_cc_preprocess():
+    from gibbs import cc_preprocess
+    if not os.path.exists(cc_preprocess.CC_PREPROCESS_FNAME):
+        logging.warning('> Cannot find %s, skipping the uncompressed copy' %
+                        cc_preprocess.CC_PREPROCESS_FNAME)
+        return
+    logging.info('> Writing memory-mappable CC preprocessing matrices')
+    cc_preprocess.WriteUncompressed()
+
+def write_thumbnails():
+    from gibbs import thumbnail_store
+    logging.info('> Exporting compound thumbnails to %s' %
+                 thumbnail_store.THUMBNAIL_DIRNAME)
+    n = thumbnail_store.Export()
+    logging.info('> Exported %d thumbnails' % n)
+
 def load_from_raw_files(draw_thumb, export_csv):
     from util import database_io
     transaction.set_autocommit(False)
@@ -1,21 +1,36 @@
 import logging
-from matching import matcher
+from matching import matcher, name_index
 from haystack.query import SearchQuerySet
+from gibbs import reaction_index, snapshot
+from util import data_version, lru_cache
 
 
 class HaystackApproxMatcher(matcher.Matcher):
     """A matcher that uses the Haystack search plugin.
 
     Current behavior:
-        First uses the haystack autocomplete. If there are results, returns.
+        First looks up the candidates sharing the most character n-grams
+        with the query in the in-process name index. If there are any,
+        returns them (they are ranked by edit distance later on).
+        Otherwise uses the haystack autocomplete. If there are results, returns.
         If no results, then there are no exact matches for your search,
         in which case we break the query into 4-grams and search for those.
         We then let the parent class logic dedup those and they are ranked
         according to their edit-distance to the query, as per _GetScore below.
     """
 
+    # How many n-gram candidates to score, per result
+    NGRAM_CANDIDATES_PER_RESULT = 5
+
     def _FindNameMatches(self, query):
         """Override database search."""
+        res = name_index.Get().FindApproximate(
+            query, self._max_results * self.NGRAM_CANDIDATES_PER_RESULT)
+        if res:
+            logging.debug('N-gram index found %d candidates for "%s"',
+                          len(res), query)
+            return res
+
         # Try plain old autocomplete. If it works, great.
         logging.debug('Trying Autocomplete for query "%s"', query)
         res = SearchQuerySet().autocomplete(title_autocomplete=query)
@@ -45,18 +60,56 @@ class HaystackApproxMatcher(matcher.Matcher):
         return [r.object for r in res]
 
 class CascadingMatcher(matcher.Matcher):
-    """A matcher that tries multiple matching strategies."""
+    """A matcher that tries multiple matching strategies.
+
+    The results of each query are kept in an LRU cache as compact
+    (key, category, ID, score) tuples, and turned back into Matches using
+    the in-process compound snapshot and reaction index. Queries without
+    any match are kept in a separate cache, whose entries expire (so names
+    added to the database are eventually found without a restart). Both
+    caches are keyed by the data version as well, and their hit rates are
+    returned by CacheStats().
+    """
 
     def __init__(self, max_results=10, min_score=0.0,
-                 match_enzymes=True, return_fast=False):
+                 match_enzymes=True, return_fast=False,
+                 cache_size=10000, negative_cache_size=10000,
+                 negative_ttl=600):
         matcher.Matcher.__init__(self, max_results, min_score, match_enzymes)
         self._return_fast = return_fast
         self._exact_matcher = matcher.Matcher(
             max_results, min_score, match_enzymes)
         self._approx_matcher = HaystackApproxMatcher(15, min_score)
+        self._cache = lru_cache.LRUCache(max_size=cache_size)
+        self._negative_cache = lru_cache.LRUCache(
+            max_size=negative_cache_size, ttl=negative_ttl)
 
-    def Match(self, query):
-        """Override base matching implementation."""
+    def _CacheKey(self, query):
+        return (self._PreprocessQuery(query), self._max_results,
+                self._min_score, self._match_enzymes, self._return_fast,
+                data_version.Get())
+
+    @staticmethod
+    def _ToTuples(matches):
+        return tuple((m.key, m.TypeStr(), m.Key(), m.score) for m in matches)
+
+    @staticmethod
+    def _FromTuples(tuples):
+        """Rebuilds the Matches of _ToTuples from the in-process indexes."""
+        compounds = snapshot.Get().GetCompounds(
+            [x for _, category, x, _ in tuples if category == 'Compound'])
+        enzymes = reaction_index.Get()
+        matches = []
+        for key, category, x, score in tuples:
+            if category == 'Compound':
+                value = compounds.get(x)
+            else:
+                value = enzymes.GetEnzyme(x)
+            if value is not None:
+                matches.append(matcher.Match(key, value, score))
+        return matches
+
+    def _MatchUncached(self, query):
         matches = self._exact_matcher.Match(query)
 
         # In some cases it's advantageous to return exact matches immediately,
@@ -71,3 +124,27 @@ class CascadingMatcher(matcher.Matcher):
         matches = self._FilterMatches(matches)
         matches = self._SortAndClip(matches)
         return matches
+
+    def Match(self, query):
+        """Override base matching implementation."""
+        if not self._AcceptQuery(query):
+            raise matcher.IllegalQueryError('%s is not a valid query' % query)
+
+        key = self._CacheKey(query)
+        tuples = self._cache.Get(key)
+        if tuples is not None:
+            return self._FromTuples(tuples)
+        if self._negative_cache.Get(key) is not None:
+            return []
+
+        matches = self._MatchUncached(query)
+        if matches:
+            self._cache.Set(key, self._ToTuples(matches))
+        else:
+            self._negative_cache.Set(key, True)
+        return matches
+
+    def CacheStats(self):
+        """Returns the counters of the match and the negative caches."""
+        return {'matches': self._cache.Stats(),
+                'negative': self._negative_cache.Stats()}
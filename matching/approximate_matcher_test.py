@@ -65,6 +65,21 @@ class TestMatcher(unittest.TestCase):
                     self.test_names, m, max_results, min_score,
                     check_sorted=False)
 
+    def testCascadingMatcherCache(self):
+        m = approximate_matcher.CascadingMatcher(max_results=5)
+        for name in self.test_names:
+            first = m.Match(name)
+            second = m.Match(name)
+            self.assertEqual([(r.key, r.Key(), r.score) for r in first],
+                             [(r.key, r.Key(), r.score) for r in second])
+        stats = m.CacheStats()
+        self.assertEqual(len(self.test_names), stats['matches']['hits'] +
+                         stats['negative']['hits'])
+
+        self.assertEqual([], m.Match('qqqqqqqqqqqqqqqqqqqq'))
+        self.assertEqual([], m.Match('qqqqqqqqqqqqqqqqqqqq'))
+        self.assertGreaterEqual(m.CacheStats()['negative']['hits'], 1)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,101 @@
+def _PatternMasks(pattern):
+    """Returns a dictionary mapping each character to its bit positions."""
+    masks = {}
+    for i, c in enumerate(pattern):
+        masks[c] = masks.get(c, 0) | (1 << i)
+    return masks
+
+
+def _Distance(masks, m, text, max_distance):
+    """
+        Myers' bit-parallel Levenshtein distance (as described by Hyyrö),
+        between a pattern of length m (given by its masks) and text.
+
+        Each column of the dynamic programming table is encoded by two bit
+        vectors of its vertical +1/-1 differences, so one text character
+        costs a few integer operations regardless of the pattern length.
+
+        Returns:
+            The distance, or None if it is larger than max_distance.
+    """
+    n = len(text)
+    if m == 0:
+        return n if n <= max_distance else None
+    if abs(m - n) > max_distance:
+        return None
+
+    full = (1 << m) - 1
+    high = 1 << (m - 1)
+    pv = full
+    mv = 0
+    score = m
+    for j, c in enumerate(text):
+        eq = masks.get(c, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | ~(xh | pv)
+        mh = pv & xh
+        if ph & high:
+            score += 1
+        elif mh & high:
+            score -= 1
+        # the first row of the table is 0, 1, 2, ... (global alignment)
+        ph = ((ph << 1) | 1) & full
+        mh = (mh << 1) & full
+        pv = (mh | ~(xv | ph)) & full
+        mv = ph & xv
+        # each remaining character lowers the distance by at most 1
+        if score - (n - j - 1) > max_distance:
+            return None
+    return score if score <= max_distance else None
+
+
+def Distance(a, b, max_distance=None):
+    """
+        Returns the Levenshtein distance between two strings, or None if it
+        is larger than max_distance.
+    """
+    if max_distance is None:
+        max_distance = max(len(a), len(b))
+    return _Distance(_PatternMasks(a), len(a), b, max_distance)
+
+
+class Scorer(object):
+    """
+        Scores candidate strings by their edit distance to a query:
+
+            score = (max_len - distance) / max_len
+
+        where max_len is the length of the longer string. Since candidates
+        scoring less than min_score are discarded anyway, min_score is
+        turned into a maximal distance for each candidate, and the distance
+        computation stops as soon as it is exceeded.
+    """
+
+    def __init__(self, query, min_score=0.0):
+        """
+            Args:
+                query: the (pre-processed) query string.
+                min_score: candidates scoring less than this get a score of
+                           0.0 (their exact score is not computed).
+        """
+        self.query = str(query).lower()
+        self.min_score = min_score
+        self._masks = _PatternMasks(self.query)
+
+    def Score(self, candidate):
+        candidate = str(candidate).lower()
+        max_len = max(len(self.query), len(candidate))
+        if max_len == 0:
+            return 1.0
+        # the largest distance for which the score is at least min_score
+        max_distance = int(max_len * (1.0 - self.min_score) + 1e-9)
+        dist = _Distance(self._masks, len(self.query), candidate,
+                         max_distance)
+        if dist is None:
+            return 0.0
+        return float(max_len - dist) / max_len
+
+    def ScoreAll(self, candidates):
+        """Returns the scores of a list of candidates."""
+        return [self.Score(c) for c in candidates]
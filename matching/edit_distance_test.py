@@ -0,0 +1,51 @@
+#!/usr/bin/python
+
+import random
+import unittest
+from matching import edit_distance
+
+
+def _FullDistance(a, b):
+    """The textbook dynamic programming edit distance."""
+    prev = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        cur = [i]
+        for j, cb in enumerate(b, 1):
+            cur.append(min(prev[j] + 1, cur[j - 1] + 1,
+                           prev[j - 1] + (ca != cb)))
+        prev = cur
+    return prev[-1]
+
+
+class EditDistanceTest(unittest.TestCase):
+
+    def testDistance(self):
+        self.assertEqual(0, edit_distance.Distance('', ''))
+        self.assertEqual(3, edit_distance.Distance('kitten', 'sitting'))
+        self.assertEqual(5, edit_distance.Distance('', 'water'))
+        self.assertIsNone(edit_distance.Distance('kitten', 'sitting', 2))
+
+    def testRandomStrings(self):
+        rng = random.Random(2018)
+        for _ in range(2000):
+            a = ''.join(rng.choice('acgt ') for _ in range(rng.randint(0, 15)))
+            b = ''.join(rng.choice('acgt ') for _ in range(rng.randint(0, 15)))
+            expected = _FullDistance(a, b)
+            self.assertEqual(expected, edit_distance.Distance(a, b))
+            max_distance = rng.randint(0, 10)
+            if expected <= max_distance:
+                self.assertEqual(
+                    expected, edit_distance.Distance(a, b, max_distance))
+            else:
+                self.assertIsNone(edit_distance.Distance(a, b, max_distance))
+
+    def testScorer(self):
+        scorer = edit_distance.Scorer('Glucose', min_score=0.5)
+        self.assertEqual([1.0, 6.0 / 7, 0.0],
+                         scorer.ScoreAll(['glucose', 'glucoze', 'ATP']))
+        scorer = edit_distance.Scorer('glucose')
+        self.assertAlmostEqual(4.0 / 7, scorer.Score('gluc'))
+
+
+if __name__ == '__main__':
+    unittest.main()
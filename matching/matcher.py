@@ -1,7 +1,7 @@
 import logging
-from haystack.query import SearchQuerySet
 from django.apps import apps
-from nltk.metrics import edit_distance
+from gibbs import reaction_index, snapshot
+from matching import edit_distance, name_index
 
 
 class IllegalQueryError(Exception):
@@ -122,17 +122,20 @@ class Matcher(object):
     def _FindNameMatches(self, query):
         """Find all the matches for this query.
 
+        Exact matches are looked up in the in-process name index, so no
+        query is sent to the search backend.
+
         Args:
             query: the query to match.
 
         Returns:
-            A list of CommonName objects matching the query.
+            A list of CommonName objects (or name_index.NameEntry tuples)
+            matching the query.
         """
-        res = SearchQuerySet().filter(text__exact=query)
-        if res.count() > 0:
-            logging.debug('%s exact matches for "%s" found',
-                          res.count(), query)
-            return [m.object for m in res]
+        entry = name_index.Get().Get(query)
+        if entry is not None:
+            logging.debug('Exact match for "%s" found', query)
+            return [entry]
         else:
             logging.debug('No exact match for "%s"', query)
             return []
@@ -141,13 +144,17 @@ class Matcher(object):
         """Given the list of CommonNames, make the Matches.
 
         Args:
-            common_names: a list of CommonNames.
+            common_names: a list of CommonNames or NameEntry tuples.
 
         Returns:
             A list of Match objects.
         """
         matches = []
         for name in common_names:
+            if isinstance(name, name_index.NameEntry):
+                matches.extend(self._MakeEntryMatchObjects(name))
+                continue
+
             for compound in name.compound_set.all():
                 matches.append(Match(name.name, compound, 0.0))
 
@@ -157,6 +164,20 @@ class Matcher(object):
 
         return matches
 
+    def _MakeEntryMatchObjects(self, entry):
+        """Make the Matches of a NameEntry from the in-process indexes."""
+        compounds = snapshot.Get().GetCompounds(entry.kegg_ids)
+        matches = [Match(entry.name, compounds[kegg_id], 0.0)
+                   for kegg_id in entry.kegg_ids if kegg_id in compounds]
+
+        if self._match_enzymes:
+            index = reaction_index.Get()
+            for ec in entry.ec_numbers:
+                enzyme = index.GetEnzyme(ec)
+                if enzyme is not None:
+                    matches.append(Match(entry.name, enzyme, 0.0))
+        return matches
+
     def _GetScore(self, query, match):
         """Get the score for a query-match pair.
 
@@ -167,11 +188,23 @@ class Matcher(object):
         Returns:
             A score between 0.0 and 1.0.
         """
-        str_query = str(query).lower()
-        str_candidate = str(match.key).lower()
-        dist = float(edit_distance(str_query, str_candidate))
-        max_len = float(max(len(str_query), len(str_candidate)))
-        return (max_len - dist) / max_len
+        return edit_distance.Scorer(query).Score(match.key)
+
+    def _MakeScorer(self, query):
+        """Make the scorer of all the matches of a query.
+
+        The default edit_distance.Scorer skips the exact score of matches
+        below the minimum score. Subclasses that override _GetScore should
+        override this to return None.
+
+        Args:
+            query: the query string.
+
+        Returns:
+            An object with a ScoreAll(keys) method, or None to score each
+            match with _GetScore.
+        """
+        return edit_distance.Scorer(query, self._min_score)
 
     def _ScoreMatches(self, query, matches):
         """Set the match scores for all matches.
@@ -180,8 +213,15 @@ class Matcher(object):
             query: the query string.
             matches: a list of match objects with uninitialized scores.
         """
-        for m in matches:
-            m.score = self._GetScore(query, m)
+        scorer = self._MakeScorer(query)
+        if scorer is None:
+            for m in matches:
+                m.score = self._GetScore(query, m)
+            return
+
+        for m, score in zip(matches,
+                            scorer.ScoreAll([m.key for m in matches])):
+            m.score = score
 
     def _FilterMatches(self, matches):
         """Filter the match list for min score.
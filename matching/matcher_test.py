@@ -25,6 +25,10 @@ class FirstLastCharacterMatcher(matcher.Matcher):
     at the last character slightly worse.
     """
 
+    def _MakeScorer(self, query):
+        """Score each candidate with _GetScore."""
+        return None
+
     def _GetScore(self, query, match):
         """Override the single-candidate matching implementation."""
         candidate = str(match.key)
@@ -60,6 +64,53 @@ class TestMatcher(unittest.TestCase):
             results = m.Match(name)
             self.assertTrue(len(results) <= 1)
 
+    def testExactNameIndex(self):
+        model = apps.get_model('gibbs.CommonName')
+        name = model.objects.filter(compound__isnull=False)[0]
+        kegg_ids = set(c.kegg_id for c in name.compound_set.all())
+
+        m = matcher.Matcher(10, match_enzymes=False)
+        results = m.Match('  %s ' % name.name.upper())
+        self.assertTrue(results)
+        for result in results:
+            self.assertTrue(result.IsCompound())
+            self.assertIn(result.Key(), kegg_ids)
+            self.assertEqual(1.0, result.score)
+
+    def testNGramIndex(self):
+        from matching import name_index
+
+        model = apps.get_model('gibbs.CommonName')
+        name = model.objects.filter(compound__isnull=False)[0].name
+        index = name_index.Get()
+        # a typo in the middle of the name
+        i = len(name) // 2
+        typo = name[:i] + 'x' + name[i + 1:]
+        candidates = index.FindApproximate(typo, max_results=50)
+        self.assertLessEqual(len(candidates), 50)
+        self.assertIn(name_index.Normalize(name),
+                      [name_index.Normalize(c.name) for c in candidates])
+        self.assertEqual([], index.FindApproximate('\u2603' * 8))
+
+    def testPrefixCompletions(self):
+        from matching import name_index
+
+        index = name_index.Get()
+        # 'phospho' starts many names, so they are not sorted
+        for prefix in ('a', 'glu', 'glucos', 'phospho', 'adenosine'):
+            completions = index.GetCompletions(prefix)
+            self.assertLessEqual(len(completions),
+                                 name_index.MAX_COMPLETIONS)
+            lengths = []
+            for name, category in completions:
+                normalized = name_index.Normalize(name)
+                self.assertTrue(normalized.startswith(prefix))
+                self.assertIn(category,
+                              (name_index.COMPOUND, name_index.ENZYME))
+                lengths.append(len(normalized))
+            self.assertEqual(sorted(lengths), lengths)
+            self.assertEqual(len(set(completions)), len(completions))
+
     def testSortingMatcher(self):
         logging.info('Testing SortingMatcher')
         m = FirstLastCharacterMatcher(10)
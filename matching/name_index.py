@@ -0,0 +1,255 @@
+import bisect
+import logging
+import threading
+import time
+from collections import namedtuple
+import numpy
+from django.apps import apps
+from util import data_version
+
+
+# The compounds and enzymes sharing a normalized common name. name is one of
+# the original (not normalized) names.
+NameEntry = namedtuple('NameEntry', ['name', 'kegg_ids', 'ec_numbers'])
+
+
+# The length of the character n-grams used for approximate matching
+NGRAM_LENGTH = 4
+
+# Completions are precomputed for prefixes up to this length. Longer
+# prefixes match few enough names to rank them on demand.
+PRECOMPUTED_PREFIX_LENGTH = 4
+
+# The number of completions kept for each prefix
+MAX_COMPLETIONS = 10
+
+# Longer prefixes matching at most this many names are completed by sorting
+# them, others by scanning the names with the same short prefix in order
+MAX_SORTED_COMPLETIONS = 100
+
+# The categories of completions, as in matcher.Match.TypeStr
+COMPOUND = 'Compound'
+ENZYME = 'Enzyme'
+
+
+def Normalize(name):
+    """Lower-cases a name and collapses its whitespace."""
+    return ' '.join(str(name).lower().split())
+
+
+def NGrams(normalized_name, n=NGRAM_LENGTH):
+    """
+        Returns the set of character n-grams of a (normalized) name, padded
+        with a space on each side so that short names have one too.
+    """
+    padded = ' %s ' % normalized_name
+    if len(padded) <= n:
+        return {padded}
+    return set(padded[i:i + n] for i in range(len(padded) - n + 1))
+
+
+class NameIndex(object):
+    """
+        An in-process map from normalized common names to the KEGG IDs of
+        compounds and the EC numbers of enzymes with that name.
+
+        It replaces the search backend for exact name matching, and like the
+        compound snapshot it is loaded once per process and reloaded only
+        when the data version stamp changes.
+
+        It also holds an inverted index from character n-grams to the names
+        that contain them, for approximate matching (see FindApproximate),
+        and the top completions of every short prefix, for autocomplete
+        (see GetCompletions).
+    """
+
+    def __init__(self, version=None):
+        self.version = version
+        Compound = apps.get_model('gibbs.Compound')
+        Enzyme = apps.get_model('gibbs.Enzyme')
+        CommonName = apps.get_model('gibbs.CommonName')
+
+        names = dict(CommonName.objects.values_list('id', 'name'))
+        compound_id_to_kegg_id = dict(
+            Compound.objects.values_list('id', 'kegg_id'))
+        enzyme_id_to_ec = dict(Enzyme.objects.values_list('id', 'ec'))
+
+        kegg_ids = {}
+        for compound_id, name_id in \
+                Compound.common_names.through.objects.values_list(
+                    'compound_id', 'commonname_id'):
+            kegg_ids.setdefault(name_id, []).append(
+                compound_id_to_kegg_id[compound_id])
+
+        ec_numbers = {}
+        for enzyme_id, name_id in \
+                Enzyme.common_names.through.objects.values_list(
+                    'enzyme_id', 'commonname_id'):
+            ec_numbers.setdefault(name_id, []).append(
+                enzyme_id_to_ec[enzyme_id])
+
+        entries = {}
+        for name_id, name in sorted(names.items()):
+            _, entry_kegg_ids, entry_ecs = entries.setdefault(
+                Normalize(name), (name, [], []))
+            for kegg_id in kegg_ids.get(name_id, []):
+                if kegg_id not in entry_kegg_ids:
+                    entry_kegg_ids.append(kegg_id)
+            for ec in ec_numbers.get(name_id, []):
+                if ec not in entry_ecs:
+                    entry_ecs.append(ec)
+
+        self._entries = {key: NameEntry(name, tuple(k), tuple(e))
+                         for key, (name, k, e) in entries.items()}
+        self._keys = sorted(self._entries)
+        self._BuildNGramIndex()
+        self._BuildPrefixIndex()
+
+    def _BuildNGramIndex(self):
+        postings = {}
+        n_ngrams = []
+        for i, key in enumerate(self._keys):
+            ngrams = NGrams(key)
+            n_ngrams.append(len(ngrams))
+            for ngram in ngrams:
+                postings.setdefault(ngram, []).append(i)
+        self._n_ngrams = numpy.array(n_ngrams, dtype=float)
+        self._postings = {ngram: numpy.array(ids, dtype=numpy.int32)
+                          for ngram, ids in postings.items()}
+
+    def _BuildPrefixIndex(self):
+        """
+            Ranks all the names for autocomplete, shortest first (since a
+            query scores higher against shorter names that start with it),
+            and stores the best completions of every short prefix. Longer
+            names are also grouped by their short prefix, in rank order, for
+            completing longer prefixes.
+        """
+        self._rank = [0] * len(self._keys)
+        by_rank = sorted(range(len(self._keys)),
+                         key=lambda i: (len(self._keys[i]), self._keys[i]))
+        for r, i in enumerate(by_rank):
+            self._rank[i] = r
+
+        completions = {}
+        self._ranked_by_prefix = {}
+        for i in by_rank:
+            key = self._keys[i]
+            if len(key) > PRECOMPUTED_PREFIX_LENGTH:
+                self._ranked_by_prefix.setdefault(
+                    key[:PRECOMPUTED_PREFIX_LENGTH], []).append(i)
+            for length in range(1, min(len(key), PRECOMPUTED_PREFIX_LENGTH)
+                                + 1):
+                top, seen = completions.setdefault(key[:length], ([], set()))
+                if len(top) < MAX_COMPLETIONS:
+                    self._AddCompletions(i, top, seen)
+        self._completions = {prefix: tuple(top)
+                             for prefix, (top, _) in completions.items()}
+
+    def _AddCompletions(self, i, top, seen):
+        """
+            Appends the (name, category) completions of the i-th name to top,
+            skipping compounds and enzymes that are already there. A name
+            shared by several compounds (or enzymes) is added only once.
+        """
+        entry = self._entries[self._keys[i]]
+        for category, ids in ((COMPOUND, entry.kegg_ids),
+                              (ENZYME, entry.ec_numbers)):
+            new_ids = [x for x in ids if (category, x) not in seen]
+            if not new_ids or len(top) >= MAX_COMPLETIONS:
+                continue
+            seen.update((category, x) for x in new_ids)
+            if ('name', entry.name, category) not in seen:
+                seen.add(('name', entry.name, category))
+                top.append((entry.name, category))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def Get(self, query):
+        """Returns the NameEntry of a name, or None if there is none."""
+        return self._entries.get(Normalize(query))
+
+    def GetCompletions(self, prefix):
+        """
+            Returns the best names starting with a prefix, as a tuple of
+            (name, category) pairs, with at most one name per compound or
+            enzyme. Short names are first.
+        """
+        prefix = Normalize(prefix)
+        if not prefix:
+            return ()
+        if len(prefix) <= PRECOMPUTED_PREFIX_LENGTH:
+            return self._completions.get(prefix, ())
+
+        lo = bisect.bisect_left(self._keys, prefix)
+        hi = bisect.bisect_left(self._keys, prefix + '\uffff')
+        if hi - lo <= MAX_SORTED_COMPLETIONS:
+            candidates = sorted(range(lo, hi), key=self._rank.__getitem__)
+        else:
+            # many names match, so the first ones in rank order are found
+            # early
+            candidates = (
+                i for i in self._ranked_by_prefix[
+                    prefix[:PRECOMPUTED_PREFIX_LENGTH]]
+                if self._keys[i].startswith(prefix))
+
+        top = []
+        seen = set()
+        for i in candidates:
+            if len(top) >= MAX_COMPLETIONS:
+                break
+            self._AddCompletions(i, top, seen)
+        return tuple(top)
+
+    def FindApproximate(self, query, max_results=10):
+        """
+            Returns the names sharing the most n-grams with the query.
+
+            Names are ranked by the Dice coefficient of their n-gram sets,
+            i.e. 2 * |shared| / (|query n-grams| + |name n-grams|), and only
+            those sharing at least one n-gram are returned.
+
+            Args:
+                query: the string query.
+                max_results: the maximal number of candidates.
+
+            Returns:
+                A list of NameEntry tuples, the best candidate first.
+        """
+        query_ngrams = NGrams(Normalize(query))
+        ids = [self._postings[g] for g in query_ngrams if g in self._postings]
+        if not ids:
+            return []
+
+        shared = numpy.bincount(numpy.concatenate(ids),
+                                minlength=len(self._keys))
+        dice = 2.0 * shared / (len(query_ngrams) + self._n_ngrams)
+        candidates = numpy.nonzero(shared)[0]
+        if len(candidates) > max_results:
+            top = numpy.argpartition(-dice[candidates],
+                                     max_results - 1)[:max_results]
+            candidates = candidates[top]
+        # ties are broken by name, so the result is deterministic
+        candidates = sorted(candidates,
+                            key=lambda i: (-dice[i], self._keys[i]))
+        return [self._entries[self._keys[i]] for i in candidates]
+
+
+_index = None
+_lock = threading.Lock()
+
+
+def Get():
+    """Returns the name index of the current data version."""
+    global _index
+    version = data_version.Get()
+    if _index is None or _index.version != version:
+        with _lock:
+            if _index is None or _index.version != version:
+                t0 = time.time()
+                _index = NameIndex(version)
+                logging.info('Loaded an index of %d common names (data '
+                             'version %s) in %.1f sec' %
+                             (len(_index), version, time.time() - t0))
+    return _index
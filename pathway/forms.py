@@ -12,3 +12,4 @@ class AnalyzePathwayModelForm(forms.Form):
     pathway_file = forms.FileField(required=True)
     pH = forms.FloatField(required=False)
     ionic_strength = forms.FloatField(required=False)
+    calc_uncertainty = forms.BooleanField(required=False)
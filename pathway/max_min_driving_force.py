@@ -44,7 +44,7 @@ class ParsedPathway(object):
     """
 
     def __init__(self, reactions, fluxes, dG0_r_primes,
-                 bounds=None, aq_params=None):
+                 bounds=None, aq_params=None, dG0_r_std=None):
         """Initialize.
 
         Args:
@@ -55,6 +55,9 @@ class ParsedPathway(object):
                 Uses default bounds if None provided.
             aq_params: specify the pH, ionic strength, etc. at which the
                 dG values are calculated. May be omitted.
+            dG0_r_std: (optional) the square root of the covariance matrix
+                of the reaction energies. If omitted, the energies are
+                treated as exact.
         """
         assert len(reactions) == len(fluxes)
         assert len(reactions) == len(dG0_r_primes)
@@ -65,6 +68,7 @@ class ParsedPathway(object):
 
         self.fluxes = numpy.array(fluxes)
         self.dG0_r_prime = numpy.array(dG0_r_primes)
+        self.dG0_r_std = dG0_r_std
 
         self.bounds = bounds or DEFAULT_BOUNDS
 
@@ -114,13 +118,16 @@ class ParsedPathway(object):
 
     @classmethod
     def from_csv_file(cls, f,
-                      bounds=None, aq_params=None):
+                      bounds=None, aq_params=None, calc_uncertainty=False):
         """Returns a pathway parsed from an input file.
 
         Caller responsible for closing f.
 
         Args:
             f: file-like object containing CSV data describing the pathway.
+            calc_uncertainty: if True, the MDF takes into account the
+                (95% confidence) uncertainty of the reaction energies, using
+                their full covariance matrix.
         """
         rxn_matcher = service_config.Get().reaction_matcher
         query_parser = service_config.Get().query_parser
@@ -157,20 +164,53 @@ class ParsedPathway(object):
             best_match = matches.GetBestMatch()
             rxn = apps.get_model('gibbs.reaction').FromIds(
                 best_match, fetch_db_names=True)
-
-            if not rxn.IsBalanced():
-                raise UnbalancedReaction(
-                    "ReactionFormula '%s' is not balanced" % formula)
-            if not rxn.IsElectronBalanced():
-                raise UnbalancedReaction(
-                    "ReactionFormula '%s' is not redox balanced" % formula)
-
             reactions.append(rxn)
 
+        cls._check_balanced(reactions, reaction_df.ReactionFormula)
+
         dgs = [r.DeltaG0Prime(aq_params) for r in reactions]
+
+        dG0_r_std = None
+        if calc_uncertainty:
+            dG0_r_std = cls._get_dG0_r_std(reactions)
+
         return ParsedPathway(
             reactions, fluxes, dgs,
-            bounds=bounds, aq_params=aq_params)
+            bounds=bounds, aq_params=aq_params, dG0_r_std=dG0_r_std)
+
+    @staticmethod
+    def _get_dG0_r_std(reactions):
+        """Returns the 95% confidence covariance square root, or None.
+
+        Args:
+            reactions: a list of Reaction objects.
+        """
+        dG0_r_std = apps.get_model('gibbs.reaction').DeltaGCovarianceSqrt(
+            reactions)
+        if dG0_r_std is None:
+            logging.warning('cannot compute the covariance of the '
+                            'pathway reactions, ignoring uncertainty')
+            return None
+        return 1.96 * dG0_r_std
+
+    @staticmethod
+    def _check_balanced(reactions, formulas):
+        """Raises UnbalancedReaction for the first unbalanced reaction.
+
+        Args:
+            reactions: a list of Reaction objects.
+            formulas: the ReactionFormula of each reaction (for the error).
+        """
+        is_balanced, is_electron_balanced = \
+            apps.get_model('gibbs.reaction').AreBalanced(reactions)
+        for formula, atoms_ok, electrons_ok in zip(
+                formulas, is_balanced, is_electron_balanced):
+            if not atoms_ok:
+                raise UnbalancedReaction(
+                    "ReactionFormula '%s' is not balanced" % formula)
+            if not electrons_ok:
+                raise UnbalancedReaction(
+                    "ReactionFormula '%s' is not redox balanced" % formula)
 
     def _get_compounds(self):
         """Returns a dictionary of compounds by KEGG ID."""
@@ -209,8 +249,8 @@ class ParsedPathway(object):
     @property
     def reactions_balanced(self):
         """Returns true if all pathway reactions are electron and atom-wise balanced."""
-        atom_balaned = [r.IsBalanced() for r in self.reactions]
-        electron_balaned = [r.IsElectronBalanced() for r in self.reactions]
+        atom_balaned, electron_balaned = \
+            apps.get_model('gibbs.reaction').AreBalanced(self.reactions)
 
         balanced = numpy.logical_and(atom_balaned, electron_balaned)
         return numpy.all(balanced)
@@ -225,6 +265,7 @@ class ParsedPathway(object):
         model = PathwayThermoModel(self.S.T, self.fluxes, dGs,
                                    self.compound_kegg_ids,
                                    self.reaction_kegg_ids,
+                                   dG0_r_std=self.dG0_r_std,
                                    concentration_bounds=self.bounds)
         return model
 
@@ -239,8 +280,14 @@ class ParsedPathway(object):
 
     @classmethod
     def from_full_sbtab(self, reaction_sbtab, flux_sbtab,
-                        bounds_sbtab, keqs_sbtab):
-        """Returns an initialized ParsedPathway."""
+                        bounds_sbtab, keqs_sbtab, calc_uncertainty=False):
+        """Returns an initialized ParsedPathway.
+
+        Args:
+            calc_uncertainty: if True, the MDF takes into account the
+                (95% confidence) uncertainty of the reaction energies, using
+                their full covariance matrix.
+        """
         bounds = Bounds.from_sbtab(bounds_sbtab)
 
         reaction_df = reaction_sbtab.toDataFrame()
@@ -267,16 +314,10 @@ class ParsedPathway(object):
                 cid = name_to_cid[name]
                 rxn_ds.append(self._reactant_dict(coeff, cid, negate=False))
             rxn = apps.get_model('gibbs.reaction').FromIds(rxn_ds, fetch_db_names=True)
-
-            if not rxn.IsBalanced():
-                raise UnbalancedReaction(
-                    "ReactionFormula '%s' is not balanced" % rxn_formula)
-            if not rxn.IsElectronBalanced():
-                raise UnbalancedReaction(
-                    "ReactionFormula '%s' is not redox balanced" % rxn_formula)
-
             reactions.append(rxn)
 
+        self._check_balanced(reactions, reaction_df['ReactionFormula'])
+
         reaction_ids = reaction_df['ID']
         fluxes = flux_df[flux_df['QuantityType'] == 'flux']
         reaction_fluxes = dict(zip(fluxes['Reaction'], fluxes['Value']))
@@ -305,8 +346,13 @@ class ParsedPathway(object):
                 c, ionic_strength_units)
             aq_params.ionic_strength = c
 
+        dG0_r_std = None
+        if calc_uncertainty:
+            dG0_r_std = self._get_dG0_r_std(reactions)
+
         pp = ParsedPathway(reactions, fluxes_ordered, dgs,
-                           bounds=bounds, aq_params=aq_params)
+                           bounds=bounds, aq_params=aq_params,
+                           dG0_r_std=dG0_r_std)
         return pp
 
     def to_full_sbtab(self):
@@ -28,7 +28,8 @@ def PathwayResultPage(request):
         sio = io.StringIO(f_data, newline=None)  # universal newline mode
         reactions, fluxes, keqs, bounds = pathway_result_page.read_sbtabs(sio)
         pp = ParsedPathway.from_full_sbtab(
-            reactions, fluxes, bounds, keqs)
+            reactions, fluxes, bounds, keqs,
+            calc_uncertainty=form.cleaned_data['calc_uncertainty'])
         logging.info('Parsed pathway.')
     except PathwayParseError as ppe:
         logging.error(ppe)
@@ -18,6 +18,26 @@ var toggleCustomConcentrations = function() {
     $(".customConcentrations").toggle(showConcentrations);
 }
 
+// Load all the compound thumbnails of a page with a single request.
+var loadCompoundThumbnails = function() {
+    var images = $("img.compoundThumbnail");
+    if (images.length == 0) {
+        return;
+    }
+    var keggIds = images.map(function() {
+        return $(this).data("kegg-id");
+    }).get();
+    $.getJSON("/compound_images", {compoundIds: keggIds.join(",")},
+              function(data) {
+        images.each(function() {
+            var src = data.images[$(this).data("kegg-id")];
+            if (src) {
+                $(this).attr("src", src);
+            }
+        });
+    });
+}
+
 function toggle_visibility(id) {
     var e = document.getElementById(id);
     if (e.style.display == 'block')
@@ -96,4 +116,6 @@ $(document).ready(function(){
 
     // Enable buttons where desired.
     $('.buttonSet').buttonset();
+
+    loadCompoundThumbnails();
 });
@@ -0,0 +1,51 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import gzip
+import json
+import os
+import unittest
+import pyparsing
+from gibbs import formula_parser
+
+CC_FILENAME = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                           '../data/cc_compounds.json.gz')
+
+
+class TestFormulaParser(unittest.TestCase):
+    """Tests for formula_parser.FormulaParser"""
+
+    def setUp(self):
+        self.parser = formula_parser.FormulaParser()
+
+    def test_tokenizer_matches_pyparsing(self):
+        with gzip.open(CC_FILENAME, 'rt') as fp:
+            formulas = set(d['formula'] for d in json.load(fp)
+                           if d.get('formula'))
+        self.assertTrue(formulas)
+        for formula in sorted(formulas):
+            try:
+                atom_bag = self.parser.ParseAtomBag(formula)
+            except pyparsing.ParseException:
+                # e.g. salts with a leading multiplier, such as '2As.3O'
+                self.assertRaises(formula_parser._TokenizerError,
+                                  formula_parser.TokenizeAtomBag, formula)
+                continue
+            self.assertEqual(atom_bag, self.parser.GetAtomBag(formula),
+                             msg=formula)
+
+    def test_unusual_formulas(self):
+        for formula in ['C14H20O4(C5H8)n', 'C10R11H16N5O12P3S', 'CoCl2',
+                        'CO2', 'Uub', 'C6H12O6.H2O', 'C6 H12', 'H']:
+            self.assertEqual(self.parser.ParseAtomBag(formula),
+                             self.parser.GetAtomBag(formula), msg=formula)
+
+    def test_cache_returns_copies(self):
+        atom_bag = self.parser.GetAtomBag('C2H6O')
+        atom_bag['C'] = 0
+        self.assertEqual({'C': 2, 'H': 6, 'O': 1},
+                         self.parser.GetAtomBag('C2H6O'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -125,6 +125,94 @@ class GibbsTester(TestCase):
                                    'ph: %f, i_s: %f, expected dG: %f, actual dG: %f' %
                                    (pH, ionic_strength, expected_dg0, actual_dg0))
     
+    def test_delta_g0_grid(self):
+        from gibbs.models.compound import Specie, SpeciesGroup
+        from util import constants
+        import numpy
+
+        species = [Specie(number_of_hydrogens=12, net_charge=0,
+                          number_of_mgs=0, formation_energy=-10.5),
+                   Specie(number_of_hydrogens=11, net_charge=-1,
+                          number_of_mgs=0, formation_energy=-12.1),
+                   Specie(number_of_hydrogens=10, net_charge=-1,
+                          number_of_mgs=1, formation_energy=-470.0)]
+        species_group = SpeciesGroup()
+        species_group._all_species = species
+
+        pH, pMg, ionic_strength = numpy.meshgrid([6.0, 7.0, 8.0],
+                                                 [2.0, 3.0, 14.0],
+                                                 [0.0, 0.1, 0.25])
+        grid = species_group.GetSpeciesArrays().DeltaG0Prime(
+            pH, pMg, ionic_strength)
+        self.assertEqual(pH.shape, grid.shape)
+
+        # the per-species transform, written out without legendre
+        def Transform(s, pH, pMg, ionic_strength):
+            sqrt_I = numpy.sqrt(ionic_strength)
+            dG_prime = s.formation_energy
+            dG_prime += s.number_of_hydrogens * constants.RTlog10 * pH
+            dG_prime -= 2.91482 * (s.net_charge ** 2 - s.number_of_hydrogens) \
+                * sqrt_I / (1 + 1.6 * sqrt_I)
+            dG_prime += s.number_of_mgs * \
+                (constants.RTlog10 * pMg - constants.MG_FORMATION_ENERGY)
+            return dG_prime
+
+        for idx in numpy.ndindex(*grid.shape):
+            total = -Transform(species[0], pH[idx], pMg[idx],
+                               ionic_strength[idx]) / constants.RT
+            for s in species[1:]:
+                total = numpy.logaddexp(
+                    total, -Transform(s, pH[idx], pMg[idx],
+                                      ionic_strength[idx]) / constants.RT)
+            self.assertAlmostEqual(-constants.RT * total, grid[idx], 6)
+
+    def test_reaction_dg0_prime_conditions(self):
+        from gibbs.models.reaction import Reaction
+        from gibbs.conditions import AqueousParams
+
+        # ATP + H2O = ADP + Pi
+        reactants = [{'kegg_id': 'C00002', 'coeff': -1},
+                     {'kegg_id': 'C00001', 'coeff': -1},
+                     {'kegg_id': 'C00008', 'coeff': 1},
+                     {'kegg_id': 'C00009', 'coeff': 1}]
+        rxn = Reaction.FromIds(reactants)
+        dg0_default = rxn.DeltaG0Prime()
+        dg0_acidic = rxn.DeltaG0Prime(AqueousParams(pH=6.0))
+        self.assertNotAlmostEqual(dg0_default, dg0_acidic, 1)
+
+        # the values must not depend on the order of the calls
+        other = Reaction.FromIds(reactants)
+        self.assertAlmostEqual(dg0_acidic,
+                               other.DeltaG0Prime(AqueousParams(pH=6.0)), 6)
+        self.assertAlmostEqual(dg0_default, other.DeltaG0Prime(), 6)
+
+    def test_priorities_without_queries(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from gibbs.models.reaction import Reaction
+        from gibbs.conditions import AqueousParams
+        from gibbs import snapshot
+
+        snapshot.Get()
+        reactants = [{'kegg_id': 'C00002', 'coeff': -1},
+                     {'kegg_id': 'C00001', 'coeff': -1},
+                     {'kegg_id': 'C00008', 'coeff': 1},
+                     {'kegg_id': 'C00009', 'coeff': 1}]
+        with CaptureQueriesContext(connection) as queries:
+            rxn = Reaction.FromIds(reactants)
+            for max_priority in (1, 99, 1):
+                rxn.aq_params = AqueousParams(max_priority=max_priority)
+                rxn.DeltaG0Prime()
+        self.assertEqual([], [q['sql'] for q in queries.captured_queries
+                              if 'speciesgroup' in q['sql']])
+
+    def test_snapshot_defers_thumbnails(self):
+        from gibbs import snapshot
+
+        compound = snapshot.Get().GetCompound('C00031')
+        self.assertIn('thumbnail', compound.get_deferred_fields())
+        self.assertIn(compound.has_thumbnail, (True, False))
+
     def test_hashable_reaction_string(self):
         """
             Ensure that hashable strings for different reactions are different
@@ -232,6 +320,259 @@ class GibbsTester(TestCase):
         rxn = StoredReaction.FromJson(parsed_json)
         self.assertEqual(expected_string, str(rxn))
 
+    def test_uncertainty_batch(self):
+        from gibbs.models.reaction import Reaction, StoredReaction
+
+        stored_reactions = StoredReaction.objects.all()[:50]
+        single = [r.ToReaction() for r in stored_reactions]
+        batch = [r.ToReaction() for r in stored_reactions]
+
+        expected = []
+        for rxn in single:
+            try:
+                expected.append(rxn.DeltaGUncertainty())
+            except Exception:
+                expected.append(None)
+
+        actual = Reaction.DeltaGUncertainties(batch)
+        for rxn, e, a in zip(single, expected, actual):
+            if e is None:
+                self.assertIsNone(a, msg=str(rxn))
+            else:
+                self.assertAlmostEqual(e, a, 3, msg=str(rxn))
+
+    def test_covariance_sqrt_not_psd(self):
+        from gibbs import cc_preprocess
+        import numpy
+
+        arrays = {'C1': numpy.array([[1.0, 2.0], [2.0, 1.0]]),
+                  'C2': numpy.zeros((2, 1)),
+                  'C3': numpy.array([[1.0]]),
+                  'G1': numpy.zeros((2, 1)), 'G2': numpy.zeros((1, 1)),
+                  'G3': numpy.zeros((1, 1)), 'S': numpy.zeros((2, 1)),
+                  'cids': numpy.array(['C00001', 'C00002'])}
+        data = cc_preprocess.PreprocessingData(arrays)
+        with self.assertLogs(level='WARNING'):
+            L = data.GetCovarianceSqrt()
+        # only the eigenvalues 3 and 1 are kept
+        self.assertEqual((3, 2), L.shape)
+
+    def test_atom_balance_matrix(self):
+        from gibbs.models.reaction import Reaction, StoredReaction,\
+            ReactantFormulaMissingError
+
+        reactions = [r.ToReaction()
+                     for r in StoredReaction.objects.all()[:50]]
+        for rxn in reactions:
+            try:
+                expected = Reaction._ParseCollectionAtomDiff(rxn.reactants)
+            except ReactantFormulaMissingError:
+                self.assertRaises(ReactantFormulaMissingError,
+                                  rxn._GetAtomDiff)
+                continue
+            actual = rxn._GetAtomDiff()
+            self.assertEqual(sorted(expected), sorted(actual), msg=str(rxn))
+            for element, count in expected.items():
+                self.assertAlmostEqual(count, actual[element], 6)
+
+        is_balanced, is_electron_balanced = Reaction.AreBalanced(reactions)
+        self.assertEqual([r.IsBalanced() for r in reactions],
+                         list(is_balanced))
+        self.assertEqual([r.IsElectronBalanced() for r in reactions],
+                         list(is_electron_balanced))
+
+    def test_balance_with_cofactors(self):
+        from gibbs.models.reaction import Reaction
+
+        # ATP => ADP is missing one water (on the left) and one Pi
+        rxn = Reaction.FromIds([{'kegg_id': 'C00002', 'coeff': -1},
+                                {'kegg_id': 'C00008', 'coeff': 1}])
+        self.assertFalse(rxn.IsBalanced())
+        self.assertFalse(rxn.CanBalanceWithWater())
+        self.assertFalse(rxn.CanBalanceWithCoA())
+
+        # ATP + H2O => ADP is missing one Pi
+        rxn._AddCompound('C00001', -1)
+        self.assertTrue(rxn.CanBalanceWithPi())
+        self.assertFalse(rxn.CanBalanceWithWater())
+        variants = rxn.GetBalancedVariants()
+        self.assertEqual(['pi'], sorted(variants))
+        self.assertTrue(variants['pi'].IsBalanced())
+        self.assertEqual(1, variants['pi'].GetSparseRepresentation()['C00009'])
+
+        # acetyl-CoA + H2O => acetate is missing one CoA
+        rxn = Reaction.FromIds([{'kegg_id': 'C00024', 'coeff': -1},
+                                {'kegg_id': 'C00001', 'coeff': -1},
+                                {'kegg_id': 'C00033', 'coeff': 1}])
+        self.assertTrue(rxn.TryBalanceWithCoA())
+        self.assertTrue(rxn.IsBalanced())
+
+        # ethanol => acetaldehyde is an oxidation half-reaction
+        rxn = Reaction.FromIds([{'kegg_id': 'C00469', 'coeff': -1},
+                                {'kegg_id': 'C00084', 'coeff': 1}])
+        self.assertTrue(rxn.IsBalanced())
+        self.assertFalse(rxn.IsElectronBalanced())
+        self.assertTrue(rxn.GetBalancedVariants()['nad'].IsElectronBalanced())
+        self.assertEqual(['nad'], sorted(rxn.GetBalanceLinks(names=['nad'])))
+        self.assertEqual({}, rxn.GetBalancedVariants(names=['water']))
+
+    def test_reaction_hash_index(self):
+        from gibbs.models.reaction import StoredReaction
+
+        for stored_reaction in StoredReaction.objects.all()[:50]:
+            rxn = stored_reaction.ToReaction()
+            matches = StoredReaction.objects.filter(
+                reaction_hash=rxn.GetHash()).order_by('id')
+            self.assertEqual(matches[0].kegg_id, rxn.stored_reaction_id)
+            expected = set(e.ec for m in matches for e in m.enzyme_set.all())
+            self.assertEqual(expected,
+                             set(e.ec for e in rxn.catalyzing_enzymes))
+
+        # the hash must be recomputed after the reaction changes
+        rxn = StoredReaction.objects.all()[0].ToReaction()
+        old_hash = rxn.GetHash()
+        rxn._AddCompound('C00001', 1)
+        self.assertNotEqual(old_hash, rxn.GetHash())
+
+    def test_reaction_index_duplicate_ec(self):
+        from gibbs.models.reaction import Enzyme, StoredReaction
+        from gibbs import reaction_index
+
+        enzyme = Enzyme.objects.filter(reactions__isnull=False)[0]
+        known = set(r.id for r in enzyme.reactions.all())
+        stored_reaction = StoredReaction.objects.exclude(id__in=known)[0]
+        # a second row with the same EC, linked to another reaction
+        duplicate = Enzyme.objects.create(ec=enzyme.ec)
+        duplicate.reactions.add(stored_reaction)
+
+        index = reaction_index.ReactionHashIndex()
+        self.assertIn(enzyme.ec, index.Get(
+            stored_reaction.reaction_hash).ec_numbers)
+        self.assertIn(stored_reaction.reaction_hash,
+                      [r.reaction_hash for r in
+                       index.GetEnzymeReactions(enzyme.ec)])
+
+    def test_generate_hashes_in_bulk(self):
+        from gibbs.models.reaction import StoredReaction
+
+        stored_reactions = list(StoredReaction.objects.all()[:50])
+        single = [StoredReaction(kegg_id=r.kegg_id, reactants=r.reactants)
+                  for r in stored_reactions]
+        for r in single:
+            r.GenerateHash()
+
+        batch = StoredReaction.GenerateHashes(
+            StoredReaction(kegg_id=r.kegg_id, reactants=r.reactants)
+            for r in stored_reactions)
+        self.assertEqual(len(single), len(batch))
+        for s, b in zip(single, batch):
+            self.assertEqual(s.reaction_hash, b.reaction_hash)
+            self.assertEqual(s.reaction_string, b.reaction_string)
+            self.assertEqual(s.link, b.link)
+
+    def test_enzyme_reactions(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from gibbs.models.reaction import Enzyme
+        from gibbs import reaction_index
+
+        enzyme = Enzyme.objects.filter(reactions__isnull=False)[0]
+        expected = set(r.GetHash() for r in enzyme.reactions.all())
+        actual = [r.reaction_hash for r in enzyme.all_reactions]
+        self.assertEqual(len(actual), len(set(actual)))
+        self.assertEqual(expected, set(actual))
+
+        reaction_index.Get()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/enzyme?ec=%s' % enzyme.ec)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual([], [q['sql'] for q in queries.captured_queries
+                              if 'storedreaction' in q['sql'] or
+                              'commonname' in q['sql']])
+
+    def test_page_response_cache(self):
+        from gibbs import views
+
+        views._PAGE_CACHE.Clear()
+        url = '/compound?compoundId=C00031'
+        response = self.client.get(url)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(1, views._PAGE_CACHE.Stats()['size'])
+
+        # the same page from the cache, with the same cookies
+        cached = self.client.get(url)
+        self.assertEqual(response.content, cached.content)
+        self.assertEqual(response.cookies['pH'].value,
+                         cached.cookies['pH'].value)
+        self.assertEqual(1, views._PAGE_CACHE.Stats()['hits'])
+
+        # conditions from cookies must not be served from the same entry
+        self.client.cookies['pH'] = '6.0'
+        response = self.client.get(url)
+        self.assertEqual(2, views._PAGE_CACHE.Stats()['size'])
+        self.assertEqual('6.0', response.cookies['pH'].value)
+
+    def test_thumbnail_export(self):
+        import shutil
+        import tempfile
+        from gibbs import thumbnail_store
+        from gibbs.models.compound import Compound
+
+        dirname = tempfile.mkdtemp()
+        try:
+            n = thumbnail_store.Export(dirname)
+            index = thumbnail_store.ThumbnailIndex(dirname=dirname)
+            self.assertEqual(n, len(index))
+            for compound in Compound.objects.all()[:20]:
+                self.assertEqual(
+                    thumbnail_store.DecodeThumbnail(compound.thumbnail),
+                    index.Read(compound.kegg_id))
+        finally:
+            shutil.rmtree(dirname)
+
+    def test_compound_image_conditional_get(self):
+        response = self.client.get('/compound_image?compoundId=C00031')
+        self.assertEqual(200, response.status_code)
+        etag = response['ETag']
+
+        response = self.client.get('/compound_image?compoundId=C00031',
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304, response.status_code)
+
+    def test_compound_images_json(self):
+        import base64
+
+        url = '/compound_images?compoundIds=C00031,C00002,C00031'
+        response = self.client.get(url)
+        self.assertEqual(200, response.status_code)
+        images = json.loads(response.content.decode('utf-8'))['images']
+        self.assertEqual(['C00002', 'C00031'], sorted(images))
+
+        single = self.client.get('/compound_image?compoundId=C00031')
+        prefix = 'data:image/png;base64,'
+        if images['C00031'] is not None:
+            self.assertTrue(images['C00031'].startswith(prefix))
+            self.assertEqual(single.content, base64.b64decode(
+                images['C00031'][len(prefix):]))
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(304, response.status_code)
+        self.assertEqual(400, self.client.get('/compound_images').status_code)
+
+    def test_analyze_cc(self):
+        from gibbs.models.reaction import Preprocessing, StoredReaction
+
+        rxn = StoredReaction.objects.all()[0].ToReaction()
+        res = rxn.analyze_cc
+        self.assertLessEqual(len(res), Preprocessing.ANALYZE_TOP_K)
+        abs_weights = [abs(d['w']) for d in res]
+        self.assertEqual(abs_weights, sorted(abs_weights, reverse=True))
+
+        x, g = Preprocessing.GetReactionVectors(rxn.reactants)
+        full = Preprocessing.Analyze(x, g, top_k=None)
+        self.assertAlmostEqual(abs(full[0]['w']), abs_weights[0], 6)
+        self.assertEqual(full[0]['reaction_string'], res[0]['reaction_string'])
+
     def testMinus(self):
         from gibbs.models.compound import Compound, CompoundWithCoeff
         from util import constants
@@ -253,6 +594,35 @@ class GibbsTester(TestCase):
         self.assertAlmostEqual(dgm, -378.4, 1)
         self.assertAlmostEqual(dg0, -361.3, 1)
 
+    def test_reaction_curve_json(self):
+        from gibbs.models.reaction import Reaction
+        from gibbs.conditions import AqueousParams
+
+        # ATP + H2O = ADP + Pi
+        url = ('/graph_reaction_json?reactantsId=C00002&reactantsCoeff=-1'
+               '&reactantsId=C00001&reactantsCoeff=-1'
+               '&reactantsId=C00008&reactantsCoeff=1'
+               '&reactantsId=C00009&reactantsCoeff=1'
+               '&vary=ph&grid_min=5&grid_max=9&grid_steps=5')
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content.decode())
+        self.assertEqual([5.0, 6.0, 7.0, 8.0, 9.0], data['values'])
+
+        rxn = Reaction.FromIds([{'kegg_id': 'C00002', 'coeff': -1},
+                                {'kegg_id': 'C00001', 'coeff': -1},
+                                {'kegg_id': 'C00008', 'coeff': 1},
+                                {'kegg_id': 'C00009', 'coeff': 1}])
+        for pH, dg0_prime in zip(data['values'], data['dg0_prime']):
+            self.assertAlmostEqual(
+                rxn.DeltaG0Prime(AqueousParams(pH=pH)), dg0_prime, 3)
+
+        # negative ionic strengths are rejected at either end of the grid
+        base_url = url.split('&vary=')[0]
+        for grid in ('grid_min=-0.1&grid_max=0.2', 'grid_min=0&grid_max=-1'):
+            response = self.client.get(base_url + '&vary=is&' + grid)
+            self.assertEqual(response.status_code, 400)
+
     def test_atp_search_results(self):
         response = self.client.post('/search?query=ATP')
         self.assertEqual(response.status_code, 200)
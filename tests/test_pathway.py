@@ -6,6 +6,7 @@ from unittest import TestCase, main
 from equilibrator import settings
 import re
 import logging
+import numpy
 from util.SBtab import SBtabTools
 import pathway
 from pathway.bounds import Bounds
@@ -32,6 +33,26 @@ class PathwayTester(TestCase):
         mdf_res = path.calc_mdf()
         self.assertAlmostEqual(mdf_res.mdf, 2.626, 2)
 
+    def test_csv_file_uncertainty(self):
+        with open(self.csv_fname, 'r') as f:
+            path = pathway.ParsedPathway.from_csv_file(f)
+        with open(self.csv_fname, 'r') as f:
+            path_std = pathway.ParsedPathway.from_csv_file(
+                f, calc_uncertainty=True)
+
+        n_reactions = len(path_std.reactions)
+        self.assertEqual(path_std.dG0_r_std.shape, (n_reactions, n_reactions))
+
+        # the diagonal of the covariance matches the single reaction values
+        cov = path_std.dG0_r_std * path_std.dG0_r_std.T
+        for i, rxn in enumerate(path_std.reactions):
+            self.assertAlmostEqual(numpy.sqrt(cov[i, i]),
+                                   rxn.DeltaGUncertainty(), 3)
+
+        # allowing the energies to vary can only increase the MDF
+        self.assertGreaterEqual(path_std.calc_mdf().mdf + 1e-6,
+                                path.calc_mdf().mdf)
+
     def test_sbtab_file(self):
         rxns, fluxes, keqs, bounds = SBtabTools.openMultipleSBtab(self.sbtab_fname)
         bs = Bounds.from_sbtab(bounds)
@@ -45,6 +66,17 @@ class PathwayTester(TestCase):
         mdf_res = path.calc_mdf()
         self.assertAlmostEqual(mdf_res.mdf, 1.69, 2)
 
+    def test_sbtab_file_uncertainty(self):
+        rxns, fluxes, keqs, bounds = SBtabTools.openMultipleSBtab(self.sbtab_fname)
+        path = pathway.ParsedPathway.from_full_sbtab(rxns, fluxes, bounds, keqs)
+        path_std = pathway.ParsedPathway.from_full_sbtab(
+            rxns, fluxes, bounds, keqs, calc_uncertainty=True)
+
+        n_reactions = len(path_std.reactions)
+        self.assertEqual(path_std.dG0_r_std.shape, (n_reactions, n_reactions))
+        self.assertGreaterEqual(path_std.calc_mdf().mdf + 1e-6,
+                                path.calc_mdf().mdf)
+
     def test_unit_string(self):
         test_data = [(1.0, 'M', 1.0),
                      (1.0, 'mM', 1e-3),
@@ -90,6 +122,14 @@ class PathwayTester(TestCase):
                            str(response.content))
         for m in match:
             self.assertAlmostEqual(float(m), 1.7, 1)
+
+    def test_web_server_uncertainty(self):
+        with open(self.sbtab_fname, 'r') as f:
+            response = self.client.post('/pathway/results',
+                                        {'pathway_file': f,
+                                         'calc_uncertainty': 'on'})
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNotNone(response.context['mdf_result'])
         
 if __name__ == "__main__":
     main()
@@ -0,0 +1,49 @@
+import logging
+import os
+import time
+import uuid
+
+RELPATH = os.path.dirname(os.path.realpath(__file__))
+
+# A stamp file which is rewritten by init_db every time the database is
+# loaded. Processes that cache database content compare the stamp they
+# loaded with the current one and reload when it changes.
+DATA_VERSION_FNAME = os.path.join(RELPATH, '../data/data_version.txt')
+
+# file name -> (mtime, version) of the last stamp read by this process
+_last_read = {}
+
+
+def Write(fname=DATA_VERSION_FNAME):
+    """Writes a new, unique data version stamp and returns it."""
+    version = '%s-%s' % (time.strftime('%Y%m%d%H%M%S'), uuid.uuid4().hex[:8])
+    tmp_fname = fname + '.tmp'
+    with open(tmp_fname, 'w') as fp:
+        fp.write(version + '\n')
+    os.rename(tmp_fname, fname)
+    logging.debug('data version is now %s' % version)
+    return version
+
+
+def Get(fname=DATA_VERSION_FNAME):
+    """Returns the current data version stamp.
+
+    The file is read again only if its modification time changed, so this
+    costs a single stat() call in the common case.
+
+    Returns:
+        The version string, or None if no stamp was ever written.
+    """
+    try:
+        mtime = os.stat(fname).st_mtime_ns
+    except OSError:
+        return None
+
+    last_mtime, last_version = _last_read.get(fname, (None, None))
+    if mtime == last_mtime:
+        return last_version
+
+    with open(fname) as fp:
+        version = fp.read().strip()
+    _last_read[fname] = (mtime, version)
+    return version
@@ -0,0 +1,36 @@
+#!/usr/bin/python
+
+import os
+import shutil
+import tempfile
+import unittest
+from util import data_version
+
+
+class DataVersionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.fname = os.path.join(self.dirname, 'data_version.txt')
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def testMissingStamp(self):
+        self.assertIsNone(data_version.Get(self.fname))
+
+    def testWriteAndGet(self):
+        v1 = data_version.Write(self.fname)
+        self.assertEqual(v1, data_version.Get(self.fname))
+        self.assertEqual(v1, data_version.Get(self.fname))
+
+        # make sure the modification time changes
+        st = os.stat(self.fname)
+        v2 = data_version.Write(self.fname)
+        os.utime(self.fname, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+        self.assertNotEqual(v1, v2)
+        self.assertEqual(v2, data_version.Get(self.fname))
+
+
+if __name__ == '__main__':
+    unittest.main()
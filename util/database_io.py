@@ -1,11 +1,16 @@
+import base64
+import hashlib
 import logging
 import json
 import gzip
+import multiprocessing
 import os
 import csv
 from django.apps import apps
-from gibbs import conditions
+from django.db.models import Case, TextField, Value, When
+from gibbs import conditions, thumbnail_store
 from util import constants
+from util.thumbnail import InChI2Thumbnail, INDIGO_AVAILABLE
 
 DEFAULT_CITATION_DATA_FILENAME = 'data/citation_data.json'
 COMPOUND_NAME_FILE = 'data/kegg_compound_names.tsv'
@@ -297,13 +302,14 @@ def LoadAlbertyEnergies(alberty_json_filenane=ALBERTY_FILENAME, priority=2):
             continue
 
 def DrawThumbnails():
-    for c in apps.get_model('gibbs.Compound').objects.all():
-        c.WriteStructureThumbnail()
-        c.save()
+    GenerateCompoundThumbnails(n_processes=1)
 
-def LoadKeggReactions(cid_replace, reactions_json_filename=REACTION_FILE):
+def LoadKeggReactions(cid_replace, reactions_json_filename=REACTION_FILE,
+                      batch_size=2000):
     parsed_json = json.load(gzip.open(reactions_json_filename))
+    reaction_model = apps.get_model('gibbs.StoredReaction')
 
+    rxns = []
     for rd in parsed_json:
         try:
             rid = rd['RID']
@@ -316,14 +322,18 @@ def LoadKeggReactions(cid_replace, reactions_json_filename=REACTION_FILE):
                                   rid))
                     coeff_cid_pair[1] = cid_replace[coeff_cid_pair[1]]
 
-            rxn = apps.get_model('gibbs.StoredReaction').FromJson(rd)
-            rxn.GenerateHash()
-            rxn.save()
+            rxns.append(reaction_model.FromJson(rd))
         except Exception as e:
             logging.warning('Missing data for reaction %s', rid)
             logging.warning(e)
             continue
 
+    # the compounds of each batch are fetched together, and the reactions
+    # are inserted together
+    for i in range(0, len(rxns), batch_size):
+        batch = reaction_model.GenerateHashes(rxns[i:i + batch_size])
+        reaction_model.objects.bulk_create(batch)
+
 def LoadKeggEnzymes(enzymes_json_filename=ENZYME_FILE):
     parsed_json = json.load(gzip.open(enzymes_json_filename))
 
@@ -360,14 +370,113 @@ def LoadKeggEnzymes(enzymes_json_filename=ENZYME_FILE):
             continue
 
 
-def GenerateCompoundThumbnails():
+def _RenderThumbnail(item):
+    """Draws one InChI, in a worker process of GenerateCompoundThumbnails."""
+    inchi_hash, inchi = item
+    return inchi_hash, InChI2Thumbnail(inchi, output_format='png')
+
+
+def _LoadRenderedThumbnails(dirname):
+    """
+        Returns a dictionary mapping InChI hashes to the digests of their
+        thumbnail files (or None if drawing failed) from the last run.
+    """
+    fname = os.path.join(dirname, thumbnail_store.RENDERED_FNAME)
+    if not os.path.exists(fname):
+        return {}
+    with open(fname) as fp:
+        rendered = json.load(fp)
+    # drop drawings whose files were deleted since
+    return {h: d for h, d in rendered.items() if d is None or
+            os.path.exists(thumbnail_store.FileName(dirname, d))}
+
+
+def _UpdateThumbnails(thumbnails):
+    """Writes many thumbnails with a single UPDATE statement."""
+    compound_model = apps.get_model('gibbs.Compound')
+    whens = [When(id=compound_id, then=Value(thumbnail))
+             for compound_id, thumbnail in thumbnails]
+    compound_model.objects.filter(id__in=[i for i, _ in thumbnails]).update(
+        thumbnail=Case(*whens, output_field=TextField()))
+
+
+def GenerateCompoundThumbnails(n_processes=None, batch_size=500,
+                               dirname=thumbnail_store.THUMBNAIL_DIRNAME):
+    """
+        Draws the structures of all the compounds.
+
+        Indigo is not thread-safe, so the InChIs are drawn in a pool of
+        processes. Every drawing is also stored as a content-addressed file
+        (see thumbnail_store), together with the hash of its InChI, so that
+        the next run draws only new or changed InChIs. The thumbnails are
+        written to the database in batches, and only where they changed.
+
+        Args:
+            n_processes: the number of worker processes (default: the number
+                         of CPUs). If 1, the structures are drawn serially.
+            batch_size: the number of compounds per UPDATE statement.
+            dirname: the thumbnail directory.
+    """
+    if not INDIGO_AVAILABLE:
+        # otherwise all the structures would be marked as failed drawings
+        logging.error('Indigo is not installed, cannot draw structures.')
+        return
+
+    os.makedirs(dirname, exist_ok=True)
+    rendered = _LoadRenderedThumbnails(dirname)
+
+    rows = []
+    to_draw = {}
+    for compound_id, inchi, thumbnail in \
+            apps.get_model('gibbs.Compound').objects.values_list(
+                'id', 'inchi', 'thumbnail').iterator():
+        inchi_hash = None
+        if inchi is not None:
+            inchi_hash = hashlib.sha1(str(inchi).encode('utf-8')).hexdigest()
+            if inchi_hash not in rendered:
+                to_draw[inchi_hash] = str(inchi)
+        rows.append((compound_id, inchi_hash, thumbnail))
+
+    logging.info('Drawing %d new or changed structures (out of %d '
+                 'compounds)' % (len(to_draw), len(rows)))
+    if n_processes == 1:
+        drawings = map(_RenderThumbnail, to_draw.items())
+        pool = None
+    else:
+        pool = multiprocessing.get_context('fork').Pool(n_processes)
+        drawings = pool.imap_unordered(_RenderThumbnail, to_draw.items(),
+                                       chunksize=16)
+    try:
+        for inchi_hash, image_data in drawings:
+            rendered[inchi_hash] = None
+            if image_data is not None:
+                rendered[inchi_hash] = thumbnail_store.WriteFile(
+                    dirname, image_data)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    fname = os.path.join(dirname, thumbnail_store.RENDERED_FNAME)
+    with open(fname + '.tmp', 'w') as fp:
+        json.dump(rendered, fp, sort_keys=True)
+    os.rename(fname + '.tmp', fname)
+
+    # thumbnail is 'error' if the structure cannot be drawn
+    changed = []
+    for compound_id, inchi_hash, thumbnail in rows:
+        digest = rendered.get(inchi_hash)
+        new_thumbnail = 'error'
+        if digest is not None:
+            with open(thumbnail_store.FileName(dirname, digest), 'rb') as fp:
+                new_thumbnail = base64.b64encode(fp.read()).decode('ascii')
+        if new_thumbnail != thumbnail:
+            changed.append((compound_id, new_thumbnail))
+
+    logging.info('Writing %d new thumbnails to the database' % len(changed))
+    for i in range(0, len(changed), batch_size):
+        _UpdateThumbnails(changed[i:i + batch_size])
 
-    for compound in apps.get_model('gibbs.Compound').objects.all():
-        # thumbnail starts as None when the compound is created
-        # so an empty string will mean there was an error and the thumbnail
-        # cannot be created
-        compound.WriteStructureThumbnail()
-        compound.save()
 
 def LoadAdditionalCompoundData(json_filename=DEFAULT_ADDITIONAL_DATA_FILENAME):
     parsed_json = json.load(open(json_filename, 'r'))
@@ -452,15 +561,15 @@ def export_reactions(priority, name, ionic_strength, pMg, pH_list):
                                         "pH",
                                         "ionic strength [M]", "temperature [K]", "!Comment"])
 
-    for r in apps.get_model('gibbs.StoredReaction').objects.all():
-        rxn = r.ToReaction()
-        try:
-            dG0_std = rxn.DeltaGUncertainty()
-            if dG0_std is not None:
-                dG0_std = round(dG0_std, 1)
-        except Exception as e:
-            logging.debug(str(e))
-            dG0_std = None
+    stored_reactions = list(apps.get_model('gibbs.StoredReaction').objects.all())
+    rxns = [r.ToReaction() for r in stored_reactions]
+
+    # calculate all the uncertainties in one batch
+    dG0_stds = apps.get_model('gibbs.Reaction').DeltaGUncertainties(rxns)
+
+    for r, rxn, dG0_std in zip(stored_reactions, rxns, dG0_stds):
+        if dG0_std is not None:
+            dG0_std = round(dG0_std, 1)
 
         if dG0_std is None or dG0_std > 200:
             for pH in pH_list:
@@ -0,0 +1,105 @@
+import threading
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class LRUCache(object):
+    """A bounded, thread-safe cache which evicts the least recently used key.
+
+    Values may be None. Entries can optionally expire after a time-to-live
+    (in seconds), either for the whole cache or per entry. The number of
+    hits and misses is counted so the hit rate can be monitored.
+    """
+
+    def __init__(self, max_size=1000, ttl=None):
+        """Initialize.
+
+        Args:
+            max_size: the maximal number of entries.
+            ttl: (optional) the default time-to-live of entries in seconds.
+        """
+        assert max_size > 0
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.Get(key, _MISSING, count=False) is not _MISSING
+
+    def Get(self, key, default=None, count=True):
+        """Returns the value of key (or default) and marks it as used."""
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is not _MISSING:
+                value, expires = entry
+                if expires is not None and expires < time.monotonic():
+                    del self._data[key]
+                    entry = _MISSING
+                else:
+                    self._data.move_to_end(key)
+
+            if count:
+                if entry is _MISSING:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+
+        if entry is _MISSING:
+            return default
+        return value
+
+    def Set(self, key, value, ttl=None):
+        """Stores a value, evicting the least recently used if full.
+
+        Args:
+            key: a hashable key.
+            value: the value to store.
+            ttl: (optional) overrides the default time-to-live.
+        """
+        ttl = ttl if ttl is not None else self.ttl
+        expires = None if ttl is None else time.monotonic() + ttl
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def GetOrCompute(self, key, func):
+        """Returns the cached value of key, calling func() on a miss.
+
+        func is called without holding the lock, so two threads might
+        compute the same value concurrently (which is harmless).
+        """
+        value = self.Get(key, _MISSING)
+        if value is _MISSING:
+            value = func()
+            self.Set(key, value)
+        return value
+
+    def Clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def HitRate(self):
+        total = self.hits + self.misses
+        if total == 0:
+            return 0.0
+        return float(self.hits) / total
+
+    def Stats(self):
+        """Returns a dictionary with the size and hit/miss counters."""
+        return {'size': len(self._data),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.HitRate()}
@@ -0,0 +1,50 @@
+#!/usr/bin/python
+
+import time
+import unittest
+from util import lru_cache
+
+
+class LRUCacheTest(unittest.TestCase):
+
+    def testEviction(self):
+        cache = lru_cache.LRUCache(max_size=2)
+        cache.Set('a', 1)
+        cache.Set('b', 2)
+        self.assertEqual(1, cache.Get('a'))  # 'b' is now the oldest
+        cache.Set('c', 3)
+        self.assertEqual(2, len(cache))
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertIn('c', cache)
+
+    def testCounters(self):
+        cache = lru_cache.LRUCache(max_size=10)
+        calls = []
+
+        def Compute():
+            calls.append(1)
+            return None
+
+        for _ in range(3):
+            self.assertIsNone(cache.GetOrCompute('x', Compute))
+        self.assertEqual(1, len(calls))
+        self.assertEqual(2, cache.hits)
+        self.assertEqual(1, cache.misses)
+        self.assertAlmostEqual(2.0 / 3, cache.Stats()['hit_rate'])
+
+        cache.Clear()
+        self.assertEqual(0, len(cache))
+        self.assertEqual(0, cache.hits)
+
+    def testTimeToLive(self):
+        cache = lru_cache.LRUCache(max_size=10, ttl=60)
+        cache.Set('long', 1)
+        cache.Set('short', 2, ttl=0.01)
+        time.sleep(0.02)
+        self.assertEqual(1, cache.Get('long'))
+        self.assertEqual('gone', cache.Get('short', 'gone'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+import hashlib
+import logging
+import os
+import re
+import shutil
+import threading
+import uuid
+from util import data_version
+from util.lru_cache import LRUCache
+
+# The shared tier lives in this sub-directory of the configured cache_dir,
+# so that the cache never deletes files it did not write.
+SUBDIR_NAME = 'equilibrator_response_cache'
+
+# The names of the per-version directories (see data_version.Write), and
+# 'None' if no version stamp was ever written
+_VERSION_DIRNAME_RE = re.compile(r'^([0-9]{14}-[0-9a-f]{8}|None)$')
+
+
+class ResponseCache(object):
+    """A two-tier cache of rendered responses, invalidated by data version.
+
+    The first tier is a per-process LRUCache. The optional second tier is a
+    directory shared by all the processes on the host, with one file per
+    response under <cache_dir>/SUBDIR_NAME/<data version>. When init_db
+    writes a new version stamp, the memory tier is cleared and the files of
+    older versions are deleted. Nothing else under cache_dir is touched, so
+    it can be a shared directory such as /tmp.
+
+    Keys must be hashable and have a stable repr(), since the file name is a
+    digest of it. Values are bytes.
+    """
+
+    def __init__(self, max_size=1000, cache_dir=None,
+                 version_fname=data_version.DATA_VERSION_FNAME):
+        """Initialize.
+
+        Args:
+            max_size: the maximal number of responses kept in memory.
+            cache_dir: (optional) the directory of the shared tier.
+            version_fname: the data version stamp file.
+        """
+        self.cache_dir = cache_dir
+        self._root = cache_dir and os.path.join(cache_dir, SUBDIR_NAME)
+        self.version_fname = version_fname
+        self._memory = LRUCache(max_size=max_size)
+        self._version = None
+        self._lock = threading.Lock()
+
+    def _CheckVersion(self):
+        """Returns the current data version, dropping older entries."""
+        version = data_version.Get(self.version_fname)
+        if version != self._version:
+            with self._lock:
+                if version != self._version:
+                    self._memory.Clear()
+                    self._PruneFiles(keep=str(version))
+                    self._version = version
+        return version
+
+    def _PruneFiles(self, keep=None):
+        """Deletes the version directories, except the one named keep."""
+        if not self._root or not os.path.isdir(self._root):
+            return
+        for dirname in os.listdir(self._root):
+            if dirname != keep and _VERSION_DIRNAME_RE.match(dirname):
+                shutil.rmtree(os.path.join(self._root, dirname),
+                              ignore_errors=True)
+
+    def _FileName(self, version, key):
+        digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        return os.path.join(self._root, str(version), digest)
+
+    def Get(self, key):
+        """Returns the cached content of key, or None."""
+        version = self._CheckVersion()
+        content = self._memory.Get((version, key))
+        if content is not None or not self.cache_dir:
+            return content
+
+        try:
+            with open(self._FileName(version, key), 'rb') as fp:
+                content = fp.read()
+        except (IOError, OSError):
+            return None
+        self._memory.Set((version, key), content)
+        return content
+
+    def Set(self, key, content):
+        """Stores the content of key in both tiers."""
+        version = self._CheckVersion()
+        self._memory.Set((version, key), content)
+        if not self.cache_dir:
+            return
+
+        fname = self._FileName(version, key)
+        tmp_fname = '%s.%s.tmp' % (fname, uuid.uuid4().hex[:8])
+        try:
+            os.makedirs(os.path.dirname(fname), exist_ok=True)
+            with open(tmp_fname, 'wb') as fp:
+                fp.write(content)
+            os.rename(tmp_fname, fname)
+        except (IOError, OSError) as e:
+            logging.warning('cannot write a cached response to %s: %s' %
+                            (fname, e))
+
+    def Clear(self):
+        """Empties the memory tier and deletes all the shared files."""
+        with self._lock:
+            self._memory.Clear()
+            self._PruneFiles()
+
+    def Stats(self):
+        return self._memory.Stats()
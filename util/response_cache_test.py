@@ -0,0 +1,84 @@
+#!/usr/bin/python
+
+import os
+import shutil
+import tempfile
+import unittest
+from util import data_version, response_cache
+
+
+class ResponseCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.version_fname = os.path.join(self.dirname, 'data_version.txt')
+        self.cache_dir = os.path.join(self.dirname, 'responses')
+        data_version.Write(self.version_fname)
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def _NewVersion(self):
+        # make sure the modification time changes
+        st = os.stat(self.version_fname)
+        data_version.Write(self.version_fname)
+        os.utime(self.version_fname,
+                 ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+
+    def testMemoryOnly(self):
+        cache = response_cache.ResponseCache(
+            max_size=10, version_fname=self.version_fname)
+        key = ('reaction', (('C00002', -1.0),), 'Update')
+        self.assertIsNone(cache.Get(key))
+        cache.Set(key, b'<html/>')
+        self.assertEqual(b'<html/>', cache.Get(key))
+        self.assertFalse(os.path.exists(self.cache_dir))
+
+    def testSharedFiles(self):
+        writer = response_cache.ResponseCache(
+            max_size=10, cache_dir=self.cache_dir,
+            version_fname=self.version_fname)
+        reader = response_cache.ResponseCache(
+            max_size=10, cache_dir=self.cache_dir,
+            version_fname=self.version_fname)
+        writer.Set('a', b'page a')
+        self.assertEqual(b'page a', reader.Get('a'))
+        self.assertIsNone(reader.Get('b'))
+
+    def testInvalidatedByDataVersion(self):
+        cache = response_cache.ResponseCache(
+            max_size=10, cache_dir=self.cache_dir,
+            version_fname=self.version_fname)
+        cache.Set('a', b'page a')
+        self.assertEqual(b'page a', cache.Get('a'))
+
+        self._NewVersion()
+        self.assertIsNone(cache.Get('a'))
+        cache.Set('a', b'new page a')
+        # the files of the old version were deleted
+        self.assertEqual([data_version.Get(self.version_fname)],
+                         os.listdir(os.path.join(
+                             self.cache_dir, response_cache.SUBDIR_NAME)))
+
+    def testLeavesOtherFiles(self):
+        # the cache directory may be shared, e.g. /tmp
+        other_fname = os.path.join(self.cache_dir, 'other.txt')
+        other_dirname = os.path.join(self.cache_dir, '20180101000000-aaaaaaaa')
+        os.makedirs(other_dirname)
+        with open(other_fname, 'w') as fp:
+            fp.write('not a cached response')
+
+        cache = response_cache.ResponseCache(
+            max_size=10, cache_dir=self.cache_dir,
+            version_fname=self.version_fname)
+        cache.Set('a', b'page a')
+        self._NewVersion()
+        cache.Set('a', b'new page a')
+        cache.Clear()
+        self.assertTrue(os.path.exists(other_fname))
+        self.assertTrue(os.path.isdir(other_dirname))
+        self.assertIsNone(cache.Get('a'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -8,6 +8,7 @@ try:
     _indigo = Indigo()
     _renderer = IndigoRenderer(_indigo)
     _indigo_inchi = IndigoInchi(_indigo)
+    INDIGO_AVAILABLE = True
 
     def InChI2Thumbnail(inchi, output_format='png'):
         _indigo.setOption('render-output-format', output_format)
@@ -31,6 +32,7 @@ try:
             return None
 
 except ImportError:
+    INDIGO_AVAILABLE = False
 
     def InChI2Thumbnail(inchi, output_format='png'):
         logging.error('Indigo is not installed, cannot draw structures.')